@@ -0,0 +1,143 @@
+"""
+Benchmark the CPU time and number of ffmpeg processes needed to stream 1, 4 and 16
+channels, with and without the shared transcoder pool.
+
+By default every channel plays a library of its own, generated with different tones so
+that no two channels play the same audio: the pool can't share any transcodes, and only
+bounds the number of ffmpeg processes. With --shared every channel plays the same
+library (in a different order), so the pool mostly serves cache hits; that is the best
+case, not the usual one. The sink discards the audio as fast as it can, so the numbers
+measure transcoding cost rather than real-time pacing.
+
+Usage:
+
+    % python benchmark/bench_channels.py [TRACKS] [SECONDS_PER_TRACK] [--shared]
+"""
+import os
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import psutil
+
+from croaker.streamer import AudioStreamer
+from croaker.transcoder import TranscoderPool
+
+
+class NullSink:
+    def send(self, chunk):
+        pass
+
+    def sync(self):
+        pass
+
+    def set_metadata(self, metadata):
+        pass
+
+
+def make_library(path: Path, count: int, seconds: int, first_tone: int = 0):
+    path.mkdir(exist_ok=True)
+    tracks = []
+    for i in range(first_tone, first_tone + count):
+        track = path / f"track{i}.flac"
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"sine=frequency={220 + 20 * i}:duration={seconds}", str(track)],
+            check=True,
+        )
+        tracks.append(track)
+    return tracks
+
+
+class ProcessSampler(threading.Thread):
+    """
+    Poll the number of child processes until stopped, recording the peak.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        me = psutil.Process()
+        while self.running:
+            self.peak = max(self.peak, len(me.children()))
+            time.sleep(0.01)
+
+
+def reap_children():
+    for child in psutil.Process().children():
+        child.kill()
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            time.sleep(0.01)
+
+
+def run(libraries, pooled: bool):
+    pool = TranscoderPool(max_workers=2) if pooled else None
+    streamers = []
+    for c, library in enumerate(libraries):
+        q = queue.Queue()
+        for i in range(len(library)):
+            q.put(str(library[(i + c) % len(library)]).encode())
+        streamer = AudioStreamer(q, threading.Event(), threading.Event(), threading.Event(), transcoder=pool)
+        streamer._shout = NullSink()
+        streamers.append(streamer)
+
+    def play(streamer):
+        for _ in range(streamer.queue.qsize()):
+            streamer.stream_queued_audio()
+
+    sampler = ProcessSampler()
+    sampler.start()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=play, args=(s,)) for s in streamers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    sampler.running = False
+    reap_children()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if pool:
+        pool.shutdown()
+
+    return {
+        "cpu": (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+        "wall": elapsed,
+        "peak_procs": sampler.peak,
+    }
+
+
+def main(count: int = 8, seconds: int = 30, shared: bool = False):
+    with tempfile.TemporaryDirectory() as tmp:
+        if shared:
+            libraries = [make_library(Path(tmp), count, seconds)] * 16
+        else:
+            libraries = [make_library(Path(tmp) / f"channel{c}", count, seconds, c * count) for c in range(16)]
+        print(f"{count} tracks of {seconds}s each, {'one library' if shared else 'a library per channel'}\n")
+        print(f"{'channels':>8} {'mode':>8} {'ffmpeg cpu':>11} {'wall':>8} {'peak procs':>11}")
+        for channels in (1, 4, 16):
+            for pooled in (False, True):
+                result = run(libraries[:channels], pooled)
+                print(
+                    f"{channels:>8} {'pool' if pooled else 'direct':>8} "
+                    f"{result['cpu']:>10.2f}s {result['wall']:>7.2f}s {result['peak_procs']:>11}"
+                )
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--shared"]
+    main(*[int(arg) for arg in args], shared="--shared" in sys.argv[1:])
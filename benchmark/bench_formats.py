@@ -0,0 +1,65 @@
+"""
+Compare the MP3 and Ogg/Opus output paths: how many bytes a minute of each costs a
+listener, and how fast FrameAlignedStream and OggPageStream can split already-encoded
+audio into chunks.
+
+The source is a generated mix of tones and noise, which is harder to compress than
+silence or a single sine wave. Parser throughput is measured on audio held in memory,
+so it excludes ffmpeg.
+
+Usage:
+
+    % python benchmark/bench_formats.py [SECONDS]
+"""
+import io
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from croaker.transcoder import FrameAlignedStream, OggPageStream
+
+
+def make_source(path: Path, seconds: int):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", f"sine=frequency=220:duration={seconds}", "-f", "lavfi"]
+        + ["-i", f"sine=frequency=331:duration={seconds}", "-f", "lavfi"]
+        + ["-i", f"anoisesrc=duration={seconds}:amplitude=0.05:color=pink"]
+        + ["-filter_complex", "amix=inputs=3,aformat=channel_layouts=stereo", str(path)],
+        check=True,
+    )
+
+
+def parse(stream_class, data: bytes, **kwargs):
+    stream = stream_class(io.BytesIO(data), chunk_size=4096, **kwargs)
+    started = time.perf_counter()
+    chunks = sum(1 for _ in stream)
+    return time.perf_counter() - started, chunks, stream.position
+
+
+def main(seconds: int = 120):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "source.flac"
+        make_source(source, seconds)
+        print(f"{seconds}s of generated audio\n")
+        print(f"{'format':>12} {'KB/min':>8} {'chunks':>7} {'parse MB/s':>11} {'x real time':>12}")
+        for name, stream_class, kwargs in (
+            ("mp3 192k", FrameAlignedStream, {"bit_rate": 192000}),
+            ("mp3 96k", FrameAlignedStream, {"bit_rate": 96000}),
+            ("opus 64k", OggPageStream, {"bit_rate": 64000}),
+            ("opus 32k", OggPageStream, {"bit_rate": 32000}),
+        ):
+            data = subprocess.run(
+                stream_class.ffmpeg_args(source, **kwargs), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            ).stdout
+            elapsed, chunks, position = parse(stream_class, data, **kwargs)
+            print(
+                f"{name:>12} {len(data) / 1024 / (seconds / 60):>8.0f} {chunks:>7} "
+                f"{len(data) / elapsed / 1e6:>11.1f} {position / elapsed:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
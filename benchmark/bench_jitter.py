@@ -0,0 +1,116 @@
+"""
+Measure send-timing jitter for a streamer that transcodes in threads in the server
+process and one that uses a TranscodeWorker process, with and without a synthetic
+control-plane load competing for the GIL.
+
+The sink paces sends to real time the way libshout's sync() does, and records how
+late each send was relative to the moment the audio already sent ran out.
+
+Usage:
+
+    % python benchmark/bench_jitter.py [SECONDS] [LOAD_THREADS]
+"""
+import json
+import logging
+import queue
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from croaker.streamer import AudioStreamer
+from croaker.worker import TranscodeWorker
+
+
+class PacedSink:
+    def __init__(self, bit_rate=192000):
+        self.bit_rate = bit_rate
+        self.sent = 0
+        self.start = None
+        self.lateness = []
+
+    def send(self, chunk):
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        else:
+            self.lateness.append(now - (self.start + self.sent * 8 / self.bit_rate))
+        self.sent += len(chunk)
+
+    def sync(self):
+        delay = self.start + self.sent * 8 / self.bit_rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_metadata(self, metadata):
+        pass
+
+
+def control_plane_load(stop: threading.Event):
+    """
+    Busy the interpreter with the kind of work the control server does: parsing
+    commands, formatting responses and logging.
+    """
+    log = logging.getLogger("bench")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    playlist = {"name": "battle", "tracks": [f"/music/battle/track{i}.mp3" for i in range(200)]}
+    while not stop.is_set():
+        data = json.loads(json.dumps(playlist))
+        "\n".join(f" * {track}" for track in data["tracks"]).upper().split("\n")
+        log.debug("Received: %s", data["name"])
+
+
+def run(track: Path, seconds: int, process_mode: bool, load_threads: int):
+    worker = TranscodeWorker() if process_mode else None
+    q = queue.Queue()
+    q.put(str(track).encode())
+    streamer = AudioStreamer(q, threading.Event(), threading.Event(), threading.Event(), transcoder=worker)
+    sink = PacedSink()
+    streamer._shout = sink
+
+    stop = threading.Event()
+    load = [threading.Thread(target=control_plane_load, args=(stop,), daemon=True) for _ in range(load_threads)]
+    for t in load:
+        t.start()
+    streamer.scheduler.after(seconds, "stop", lambda: None)
+    streamer.stream_queued_audio()
+    stop.set()
+    for t in load:
+        t.join()
+    if worker:
+        worker.shutdown()
+
+    late = sorted(ms * 1000 for ms in sink.lateness)
+    return {
+        "mean": statistics.mean(late),
+        "stdev": statistics.stdev(late),
+        "p99": late[int(len(late) * 0.99)],
+        "max": late[-1],
+    }
+
+
+def main(seconds: int = 15, load_threads: int = 4):
+    with tempfile.TemporaryDirectory() as tmp:
+        track = Path(tmp) / "track.flac"
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"sine=frequency=440:duration={seconds + 5}", str(track)],
+            check=True,
+        )
+        print(f"{seconds}s of audio per run; {load_threads} control-plane load threads\n")
+        print(f"{'mode':>8} {'load':>5} {'mean':>8} {'stdev':>8} {'p99':>8} {'max':>8}  (send lateness, ms)")
+        for threads in (0, load_threads):
+            for process_mode in (False, True):
+                r = run(track, seconds, process_mode, threads)
+                print(
+                    f"{'process' if process_mode else 'thread':>8} {threads:>5} "
+                    f"{r['mean']:>8.2f} {r['stdev']:>8.2f} {r['p99']:>8.2f} {r['max']:>8.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,98 @@
+"""
+Measure how much faster than real time the mixer runs with 1 to 16 ambience layers on a
+single CPU core.
+
+The "mix" column times Mixer.mix() alone, summing layers of PCM that are already in
+memory. The "stream" column times the whole pipeline: an ffmpeg decoder for the music
+and for every layer, the mix, and the ffmpeg encoder, drained as fast as possible. The
+benchmark and all of its ffmpeg processes are pinned to one core, so "x real time" is
+how many seconds of audio one core can produce per second.
+
+Usage:
+
+    % python benchmark/bench_mixer.py [SECONDS]
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from croaker import mixer
+
+
+def make_tracks(path: Path, count: int, seconds: int):
+    tracks = []
+    for i in range(count):
+        track = path / f"layer{i}.flac"
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"anoisesrc=duration={seconds}:amplitude=0.2:seed={i}", "-ac", "2", str(track)],
+            check=True,
+        )
+        tracks.append(track)
+    return tracks
+
+
+class MemoryLayer(mixer.Layer):
+    def __init__(self, *args, pcm: bytes = b"", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pcm = pcm
+
+    def decode(self, track):
+        return io.BytesIO(self.pcm)
+
+
+def bench_mix(layers: int, seconds: int):
+    rng = np.random.default_rng(0)
+    pcm = rng.integers(-8000, 8000, size=seconds * 44100 * mixer.CHANNELS, dtype="<i2").tobytes()
+    mix = mixer.Mixer(fade_time=seconds / 2)
+    for i in range(layers):
+        mix.layers[f"layer{i}"] = MemoryLayer(f"layer{i}", ["pcm"], gain=0.5, pcm=pcm)
+        mix.fade(f"layer{i}", 0.25)
+    music = MemoryLayer("music", ["pcm"], loop=False, pcm=pcm)
+
+    started = time.process_time()
+    while not music.done:
+        mix.mix(music, mix.block_size)
+    return seconds / (time.process_time() - started)
+
+
+def bench_stream(music: Path, tracks: list, seconds: int):
+    mix = mixer.Mixer()
+    for i, track in enumerate(tracks):
+        mix.add(f"layer{i}", [track], gain=0.5, seconds=1)
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = time.process_time()
+    started = time.perf_counter()
+    stream = mix.open(music, chunk_size=4096)
+    for _ in stream:
+        pass
+    elapsed = time.perf_counter() - started
+    stream.close()
+    mix.shutdown()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    used = time.process_time() - cpu + (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+    return stream.position / elapsed, used / stream.position
+
+
+def main(seconds: int = 30):
+    os.sched_setaffinity(0, {sorted(os.sched_getaffinity(0))[0]})
+    with tempfile.TemporaryDirectory() as tmp:
+        music, *tracks = make_tracks(Path(tmp), 17, seconds)
+        print(f"{seconds}s of audio per run, pinned to one core\n")
+        print(f"{'layers':>6} {'mix':>14} {'stream':>14} {'cpu per s':>10}")
+        for layers in (1, 2, 4, 8, 16):
+            mixed = bench_mix(layers, seconds)
+            streamed, cpu = bench_stream(music, tracks[:layers], seconds)
+            print(f"{layers:>6} {mixed:>7.0f}x real {streamed:>7.1f}x real {cpu * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
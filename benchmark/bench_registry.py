@@ -0,0 +1,85 @@
+"""
+Measure how long the track registry takes to build over a large library, and to check
+it again once built, against hashing every file in full.
+
+The library is FILES tracks of 2 to 8 MB, one in twenty of them copied, linked into
+PLAYLISTS playlists of 500 entries each, so most tracks appear in several playlists.
+Each track has a unique random header and is otherwise sparse, so the library takes
+little disk space, and all of it is in the page cache: the times are for stat, hashing
+and Python overhead, not for reading from disk.
+
+Usage:
+
+    % python benchmark/bench_registry.py [FILES] [PLAYLISTS]
+"""
+
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from croaker.registry import TrackRegistry
+
+
+def make_library(root: Path, files: int, playlists: int, seed: int = 0):
+    rng = random.Random(seed)
+    sources = root / "sources"
+    sources.mkdir()
+    tracks = []
+    for i in range(files):
+        track = sources / f"track{i}.mp3"
+        with track.open("wb") as f:
+            f.write(rng.randbytes(64 * 1024))
+            f.truncate(rng.randint(2, 8) * 1024**2)
+        tracks.append(track)
+        if i % 20 == 0:
+            copy = sources / f"track{i} (copy).mp3"
+            copy.write_bytes(track.read_bytes())
+            tracks.append(copy)
+    entries = []
+    for i in range(playlists):
+        playlist = root / "playlists" / f"playlist{i}"
+        playlist.mkdir(parents=True)
+        for track in rng.sample(tracks, min(500, len(tracks))):
+            entries.append(playlist / track.name)
+            entries[-1].symlink_to(track)
+    return tracks, entries
+
+
+def full_digest(path: Path):
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+
+def main(files: int = 2000, playlists: int = 40):
+    with tempfile.TemporaryDirectory() as tmp:
+        tracks, entries = make_library(Path(tmp), files, playlists)
+        size = sum(track.stat().st_size for track in tracks)
+        print(f"{len(entries)} playlist entries, {len(tracks)} files, {size / 1024**3:.1f} GB\n")
+
+        registry = TrackRegistry()
+        cold, _ = timed(lambda: registry.scan(entries))
+        warm, _ = timed(lambda: registry.scan(entries))
+        full, _ = timed(lambda: [full_digest(track) for track in tracks])
+        distinct = len({record.digest for record in registry._files.values()})
+
+        print(f"{'':>26} {'seconds':>8} {'files hashed':>13}")
+        print(f"{'registry, first scan':>26} {cold:>8.2f} {registry.hashed:>13}")
+        print(f"{'registry, unchanged':>26} {warm:>8.2f} {0:>13}")
+        print(f"{'full hash of every file':>26} {full:>8.2f} {len(tracks):>13}")
+        print(f"\n{distinct} distinct tracks; {len(entries) - distinct} entries share a track with another")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
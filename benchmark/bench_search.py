@@ -0,0 +1,82 @@
+"""
+Measure how long the track index takes to build over a large library, and how long a
+FIND takes against it.
+
+The library is synthetic: TRACKS tracks with titles, artists and albums drawn from a
+small vocabulary of words, spread over playlists of 200 tracks each, and passed to
+TrackIndex.add() directly so that the disk isn't measured. Each query is timed over
+many runs and reported as the median and worst case in milliseconds.
+
+Usage:
+
+    % python benchmark/bench_search.py [TRACKS]
+"""
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from croaker import metadata
+from croaker.search import TrackIndex
+
+WORDS = (
+    "goblin dragon tavern battle forest night storm castle shadow river mountain dungeon crypt ship harbor "
+    "market temple desert swamp king queen knight wizard witch ghost giant troll elf dwarf march waltz "
+    "theme chase lament hymn dance song ballad fanfare overture requiem nocturne reel jig shanty drums"
+).split()
+
+QUERIES = {
+    "common word": "theme",
+    "rare word": "track99999",
+    "short prefix": "go",
+    "two terms": "goblin ch",
+    "three terms": "dragon night wal",
+    "rare together": "requiem jig shanty drums",
+    "no match": "zzyzx",
+}
+
+
+def make_library(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    playlists = {}
+    tags = {}
+    for i in range(count):
+        track = Path(f"/library/playlist{i // 200}/track{i}.mp3")
+        playlists.setdefault(f"playlist{i // 200}", []).append(track)
+        tags[str(track)] = metadata.TrackMetadata(
+            path=str(track),
+            mtime=0,
+            title=" ".join(rng.choices(WORDS, k=rng.randint(2, 4))).title(),
+            artist=" ".join(rng.choices(WORDS, k=2)).title(),
+            album=" ".join(rng.choices(WORDS, k=3)).title(),
+        )
+    return playlists, tags
+
+
+def timed(index: TrackIndex, query: str, runs: int = 200):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        found = index.search(query)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), max(times), len(found)
+
+
+def main(count: int = 100_000):
+    playlists, tags = make_library(count)
+    index = TrackIndex(refresh_interval=float("inf"))
+    index._refreshed = time.monotonic()
+    started = time.perf_counter()
+    for name, tracks in playlists.items():
+        index.add(name, tracks, tags=tags)
+    elapsed = time.perf_counter() - started
+    print(f"Indexed {len(index)} tracks in {len(playlists)} playlists in {elapsed:.2f}s\n")
+    print(f"{'query':>14} {'':<26} {'median ms':>10} {'max ms':>8} {'results':>8}")
+    for name, query in QUERIES.items():
+        median, worst, found = timed(index, query)
+        print(f"{name:>14} {query!r:<26} {median:>10.3f} {worst:>8.3f} {found:>8}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,206 @@
+import functools
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+from time import sleep
+
+from croaker import metadata
+from croaker.events import EventBus
+from croaker.playlist import load_playlist
+from croaker.streamer import AudioStreamer
+
+logger = logging.getLogger("channel")
+
+
+class Channel:
+    """
+    A single stream, with its own icecast mount, queue and control state. Every channel
+    in a server shares the same playlists and transcoder pool. If the channel has a
+    mixer, ambience layers can be mixed with its music.
+    """
+
+    def __init__(self, name: str, mount: str, transcoder=None, mixer=None):
+        self.name = name
+        self.mount = mount
+        self.format = mount_format(mount)
+        self.transcoder = transcoder
+        self.mixer = mixer
+        self._queue = queue.Queue()
+        self.skip_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.load_event = threading.Event()
+        self.events = EventBus()
+        self._streamer = None
+        self.playlist = None
+
+    @property
+    def streamer(self):
+        if not self._streamer:
+            self._streamer = AudioStreamer(
+                self._queue,
+                self.skip_event,
+                self.stop_event,
+                self.load_event,
+                events=self.events,
+                mount=self.mount,
+                transcoder=self.transcoder,
+                mixer=self.mixer,
+                format=self.format,
+            )
+            self._streamer.name = f"AudioStreamer-{self.name}"
+        return self._streamer
+
+    def ffwd(self):
+        logger.debug(f"Sending SKIP signal to {self.name} streamer...")
+        self.skip_event.set()
+
+    def stop(self):
+        logger.debug(f"Sending STOP signal to {self.name} streamer...")
+        self.stop_event.set()
+
+    def clear_queue(self):
+        logger.debug("Requesting a reload...")
+        self.streamer.load_requested.set()
+        sleep(0.5)
+
+    def load(self, playlist_name: str):
+        logger.debug(f"Switching {self.name} to {playlist_name = }")
+        if not load_playlist(playlist_name).path.exists():
+            raise ValueError(f"No such playlist: {playlist_name}")
+        if self.playlist:
+            self.clear_queue()
+        self.enqueue(playlist_name)
+
+    def enqueue(self, playlist_name: str):
+        self.playlist = load_playlist(playlist_name)
+        logger.debug(f"Loaded new playlist {self.playlist.name}")
+        self.events.publish("load", playlist=playlist_name)
+        metadata.cache().warm(self.playlist.tracks)
+        for track in self.playlist.tracks:
+            self._queue.put(str(track).encode())
+
+    def cue(self, track: Path):
+        """
+        Play the track right away, then carry on with the queue.
+        """
+        logger.debug(f"Cueing {track} on {self.name}")
+        self.streamer.cue(track)
+
+    def schedule(self, playlist_name: str, when: float = None):
+        """
+        Schedule a switch to the specified playlist at the wall-clock time when, or at
+        the end of the current track if when is None.
+        """
+        if not load_playlist(playlist_name).path.exists():
+            raise ValueError(f"No such playlist: {playlist_name}")
+        action = functools.partial(self.enqueue, playlist_name)
+        if when is None:
+            return self.streamer.scheduler.next_track(playlist_name, action)
+        return self.streamer.scheduler.at(when, playlist_name, action)
+
+    def scheduled(self):
+        return self.streamer.scheduler.pending
+
+    def cancel(self):
+        logger.debug("Cancelling scheduled transitions.")
+        return self.streamer.scheduler.cancel()
+
+    def _require_mixer(self):
+        if not self.mixer:
+            raise ValueError("Mixing is not enabled; set MIXER=1.")
+
+    def add_layer(self, playlist_name: str, gain: float = 1.0, seconds: float = None):
+        """
+        Fade in the specified playlist as a looping ambience layer.
+        """
+        self._require_mixer()
+        layer = load_playlist(playlist_name)
+        if not layer.path.exists():
+            raise ValueError(f"No such playlist: {playlist_name}")
+        self.mixer.add(playlist_name, layer.tracks, gain=gain, seconds=seconds)
+        self.events.publish("layer_add", layer=playlist_name, gain=gain)
+
+    def fade_layer(self, name: str, gain: float, seconds: float = None):
+        self._require_mixer()
+        self.mixer.fade(name, gain, seconds=seconds)
+        self.events.publish("layer_fade", layer=name, gain=gain)
+
+    def remove_layer(self, name: str, seconds: float = None):
+        self._require_mixer()
+        self.mixer.remove(name, seconds=seconds)
+        self.events.publish("layer_remove", layer=name)
+
+    def layers(self):
+        self._require_mixer()
+        return str(self.mixer)
+
+    def state(self):
+        """
+        Describe the channel's playlist, queue, scheduled switches, layers and, if its
+        streamer has been paused for a handoff, where it was paused, so that a new daemon
+        can restore() it.
+        """
+        with self._queue.mutex:
+            queued = [track.decode() for track in self._queue.queue]
+        return {
+            "playlist": self.playlist.name if self.playlist else None,
+            "queue": queued,
+            "scheduled": [{"playlist": t.playlist, "at": t.at} for t in self.scheduled()],
+            "layers": self.mixer.gains() if self.mixer else {},
+            "stream": self.streamer.handoff_state,
+        }
+
+    def restore(self, state: dict):
+        """
+        Pick up where another daemon's channel left off, given its state(). Call this
+        before the streamer is started.
+        """
+        if state["playlist"]:
+            self.playlist = load_playlist(state["playlist"])
+        stream = state["stream"] or {}
+        if stream.get("next"):
+            self._queue.put(stream["next"].encode())
+        for track in state["queue"]:
+            self._queue.put(track.encode())
+        for transition in state["scheduled"]:
+            self.schedule(transition["playlist"], transition["at"])
+        if self.mixer:
+            for name, gain in state["layers"].items():
+                if name == "music":
+                    self.mixer.fade(name, gain, seconds=0)
+                else:
+                    self.mixer.add(name, load_playlist(name).tracks, gain=gain, seconds=0)
+        if stream.get("track"):
+            self.streamer.resume_from(Path(stream["track"]), stream["title"], stream["position"])
+
+    def __str__(self):
+        playlist = self.playlist.name if self.playlist else "-"
+        return f"{self.name} ({self.mount}): {playlist}"
+
+
+def configured_channels():
+    """
+    Return a dict of channel names and icecast mounts, as configured by CHANNELS.
+    If CHANNELS isn't set, there's a single channel named "default" on ICECAST_MOUNT.
+    """
+    spec = os.environ.get("CHANNELS", "").strip()
+    if not spec:
+        return {"default": os.environ["ICECAST_MOUNT"]}
+    channels = {}
+    for entry in spec.split(","):
+        name, sep, mount = entry.strip().partition("=")
+        if not sep or not name or not mount:
+            raise ValueError(f"Expected CHANNELS to be a list of NAME=MOUNT pairs; got {entry!r}")
+        channels[name] = mount
+    return channels
+
+
+def mount_format(mount: str):
+    """
+    Return the stream format for the mount: Ogg/Opus if it ends in .ogg or .opus, otherwise ICECAST_FORMAT.
+    """
+    if mount.lower().endswith((".ogg", ".opus")):
+        return "ogg"
+    return os.environ.get("ICECAST_FORMAT", "mp3")
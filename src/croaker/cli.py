@@ -12,6 +12,7 @@ from typing_extensions import Annotated
 
 from croaker import path
 from croaker.playlist import Playlist
+from croaker.registry import TrackRegistry
 from croaker.server import server
 
 SETUP_HELP = f"""
@@ -24,6 +25,9 @@ CROAKER_ROOT={path.root()}
 # Where the record the daemon's PID
 #PIDFILE={path.root()}/croaker.pid
 
+# Where to cache track titles and durations
+#METADATA_CACHE={path.root()}/metadata.db
+
 # Command and Control TCP Server bind address
 HOST=0.0.0.0
 PORT=8003
@@ -37,6 +41,34 @@ ICECAST_MOUNT=
 ICECAST_HOST=
 ICECAST_PORT=
 ICECAST_URL=
+
+# Stream more than one channel, as a comma-separated list of NAME=MOUNT pairs.
+# If unset, there is a single channel on ICECAST_MOUNT. Mounts ending in .ogg or
+# .opus are streamed as Ogg/Opus; the rest use ICECAST_FORMAT (mp3 or ogg). Ogg
+# listeners see the titles in each track's own tags, rather than Croaker's.
+#CHANNELS=table1=table1,table2=table2
+
+# The maximum number of ffmpeg processes shared by all channels
+#TRANSCODERS=2
+
+# Set to "process" to transcode in a separate worker process for each channel,
+# instead of in threads sharing the server process. The worker processes still
+# run no more than TRANSCODERS ffmpeg processes between them.
+#TRANSCODE_MODE=thread
+
+# Set to 1 to mix ambience layers (see the LAYR command) with each channel's music.
+# Mixed channels decode and encode everything themselves instead of using TRANSCODERS.
+#MIXER=0
+
+# Commands take effect between chunks of audio. Set to a number of seconds to size
+# the chunks to match, growing them while icecast keeps up and shrinking them when
+# it doesn't or a command arrives. If unset, chunks are a fixed 4096 bytes.
+#CHUNK_LATENCY=0.25
+
+# A chunk that fails to send is always sent again after reconnecting. Set to a number
+# of seconds to also resend the audio sent that long before the connection dropped,
+# which may or may not have reached icecast.
+#RESEND_WINDOW=0
 """
 
 app = typer.Typer()
@@ -85,11 +117,12 @@ def setup(context: typer.Context):
 def start(
     context: typer.Context,
     daemonize: bool = typer.Option(True, help="Daemonize the server."),
+    handoff: bool = typer.Option(True, help="Take over the streams of a running server instead of stopping it."),
 ):
     """
     Start the Croaker command and control server.
     """
-    server.start(daemonize=daemonize)
+    server.start(daemonize=daemonize, handoff=handoff)
 
 
 @app.command()
@@ -125,5 +158,22 @@ def add(
     print(pl)
 
 
+@app.command()
+def duplicates():
+    """
+    Report tracks that more than one playlist entry leads to.
+
+    Every playlist entry is resolved to the file it links to, and the files are compared
+    by a sample of their contents, so copies of a track are found as well as links to it.
+    Croaker only reads and transcodes each track once, however many entries lead to it;
+    copies can be replaced by symlinks to save disk space.
+    """
+    tracks = TrackRegistry()
+    root = path.playlist_root()
+    for name in sorted(p.name for p in root.iterdir() if p.is_dir()) if root.exists() else []:
+        tracks.scan(Playlist(name=name).get_audio_files())
+    print(tracks.report())
+
+
 if __name__ == "__main__":
     app.main()
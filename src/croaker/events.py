@@ -0,0 +1,94 @@
+import json
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from time import time
+
+logger = logging.getLogger("events")
+
+
+@dataclass
+class Event:
+    """
+    Something that happened on the stream, such as a track starting or a playlist being loaded.
+    """
+
+    name: str
+    timestamp: float = field(default_factory=time)
+    data: dict = field(default_factory=dict)
+
+    def __str__(self):
+        return json.dumps({"event": self.name, "timestamp": self.timestamp, **self.data})
+
+
+class Subscription:
+    """
+    A bounded queue of events for a single subscriber. If the subscriber falls behind, the oldest
+    events are discarded to make room for new ones.
+    """
+
+    def __init__(self, maxsize: int = 100):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, event: Event):
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:  # pragma: no cover
+                    pass
+
+    def get(self, timeout: float = None):
+        """
+        Return the next event, or None if nothing was published before the timeout expired.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """
+    Publish events to any number of subscribers without ever blocking the publisher.
+
+    Usage:
+
+        >>> bus = EventBus()
+        >>> sub = bus.subscribe()
+        >>> bus.publish("track_start", title="Goblin Chase")
+        >>> print(sub.get())
+        {"event": "track_start", "timestamp": 1713730000.0, "title": "Goblin Chase"}
+    """
+
+    def __init__(self, maxsize: int = 100):
+        self.maxsize = maxsize
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        sub = Subscription(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers.append(sub)
+        logger.debug(f"Added subscriber; {len(self._subscribers)} total.")
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+        logger.debug(f"Removed subscriber; {len(self._subscribers)} remaining.")
+
+    def publish(self, name: str, **data):
+        event = Event(name=name, data=data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.put(event)
+        return event
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import socket
+import threading
+from pathlib import Path
+
+logger = logging.getLogger("handoff")
+
+REQUEST = b"HANDOFF\n"
+ACK = b"OK\n"
+
+
+def request_handoff(path: Path, timeout: float = 10.0):
+    """
+    Ask the daemon listening on the Unix socket at path to hand over to this process.
+    Return the state it was in and its listening socket, or (None, None) if there is no
+    daemon listening.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None, None
+
+    with conn:
+        conn.sendall(REQUEST)
+        data = b""
+        fds = []
+        while not data.endswith(b"\n"):
+            msg, received, _, _ = socket.recv_fds(conn, 65536, 1)
+            if not msg:
+                raise ConnectionError("The running daemon closed the connection without handing over.")
+            data += msg
+            fds += received
+        if not fds:
+            raise ConnectionError("The running daemon didn't send its listening socket.")
+        state = json.loads(data)
+        listener = socket.socket(fileno=fds[0])
+        conn.sendall(ACK)
+    logger.debug(f"Received listening socket {listener.getsockname()} from PID {state['pid']}")
+    return state, listener
+
+
+class HandoffListener(threading.Thread):
+    """
+    Wait on a Unix socket for a newly started daemon to ask to take over. The server is
+    asked to pause its streams and describe them; that state and the server's listening
+    socket are then sent to the new daemon, and the server is told whether the new
+    daemon acknowledged them, so that it can either exit or carry on streaming.
+
+    Usage:
+
+        >>> HandoffListener(Path("croaker.sock"), server).start()
+        ...
+        >>> state, listener = request_handoff(Path("croaker.sock"))
+    """
+
+    def __init__(self, path: Path, server, timeout: float = 10.0):
+        super().__init__(name="HandoffListener", daemon=True)
+        self.path = path
+        self.server = server
+        self.timeout = timeout
+        if self.path.exists():
+            self.path.unlink()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        self.sock.listen(1)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                if self.handle(conn):
+                    self.close()
+                    return
+
+    def handle(self, conn: socket.socket):
+        """
+        Hand over to the daemon on the other end of the connection, returning True if it took over.
+        """
+        conn.settimeout(self.timeout)
+        try:
+            if conn.recv(len(REQUEST)) != REQUEST:
+                return False
+            state = self.server.handoff()
+        except Exception as exc:
+            logger.error("Could not prepare a handoff.", exc_info=exc)
+            return False
+
+        succeeded = False
+        try:
+            data = json.dumps(state).encode() + b"\n"
+            sent = socket.send_fds(conn, [data], [self.server.fileno()])
+            if sent < len(data):
+                conn.sendall(data[sent:])
+            succeeded = conn.recv(len(ACK)) == ACK
+        except OSError as exc:
+            logger.error("Handoff failed.", exc_info=exc)
+        logger.info(f"Handoff {'succeeded' if succeeded else 'failed'}.")
+        self.server.finish_handoff(state, succeeded)
+        return succeeded
+
+    def close(self):
+        self.sock.close()
+        if self.path.exists():
+            self.path.unlink()
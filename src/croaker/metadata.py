@@ -0,0 +1,255 @@
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+import mutagen
+
+import croaker.path
+from croaker.registry import registry
+
+logger = logging.getLogger("metadata")
+
+_caches = {}
+
+
+@dataclass(frozen=True)
+class TrackMetadata:
+    """
+    The tags and duration of a single audio file.
+    """
+
+    path: str
+    mtime: int
+    title: str
+    artist: Optional[str] = None
+    album: Optional[str] = None
+    duration: Optional[float] = None
+
+    @property
+    def display(self):
+        """
+        The title as it should appear in the stream metadata.
+        """
+        if self.artist:
+            return f"{self.artist} - {self.title}"
+        return self.title
+
+    @property
+    def length(self):
+        if self.duration is None:
+            return "?:??"
+        minutes, seconds = divmod(round(self.duration), 60)
+        return f"{minutes}:{seconds:02d}"
+
+    def __str__(self):
+        return f"{self.display} ({self.length})"
+
+
+def parse(track: Path):
+    """
+    Read the tags from an audio file. Anything mutagen can't make sense of gets a title
+    derived from the file name and an unknown duration.
+    """
+    track = Path(track)
+    mtime = track.stat().st_mtime_ns
+    try:
+        media = mutagen.File(track, easy=True)
+    except Exception as exc:
+        logger.debug(f"Could not parse tags from {track}: {exc}")
+        media = None
+    if not media:
+        return TrackMetadata(path=str(track), mtime=mtime, title=track.stem)
+
+    def tag(name):
+        values = (media.tags or {}).get(name)
+        return str(values[0]) if values else None
+
+    return TrackMetadata(
+        path=str(track),
+        mtime=mtime,
+        title=tag("title") or track.stem,
+        artist=tag("artist"),
+        album=tag("album"),
+        duration=getattr(media.info, "length", None),
+    )
+
+
+class MetadataCache:
+    """
+    Parse track metadata once per file and keep it in a sqlite database keyed by path
+    and modification time, with an in-memory copy of everything looked up so far.
+
+    Parsing is slow enough that it should never happen while the streamer is switching
+    tracks, so the streamer only ever calls cached(), and the server calls warm() to
+    parse tracks in the background when a playlist is loaded.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._memory = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+        # the number of tracks parsed and stored so far, and when each was last stored; see changed_since()
+        self.changes = 0
+        self._changed = {}
+        self._pruned = False
+
+    @property
+    def db(self):
+        if not self._db:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "path TEXT PRIMARY KEY, mtime INTEGER, title TEXT, artist TEXT, album TEXT, duration REAL)"
+            )
+        return self._db
+
+    def cached(self, track: Path):
+        """
+        Return the metadata for the track if it has already been loaded and the file hasn't
+        changed since, without parsing it or reading the database.
+        """
+        meta = self._memory.get(str(track))
+        if not meta:
+            return None
+        try:
+            mtime = Path(track).stat().st_mtime_ns
+        except OSError:
+            return meta
+        return meta if meta.mtime == mtime else None
+
+    def lookup(self, track: Path):
+        """
+        Return the metadata for the track from memory or the database, without parsing it,
+        or None if it has never been parsed or has changed since.
+        """
+        meta = self.cached(track)
+        if meta:
+            return meta
+        try:
+            path = Path(track).resolve()
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            row = self.db.execute(
+                "SELECT path, mtime, title, artist, album, duration FROM tracks WHERE path = ? AND mtime = ?",
+                (str(path), mtime),
+            ).fetchone()
+        if not row:
+            return None
+        meta = TrackMetadata(*row)
+        self._memory[str(path)] = self._memory[str(track)] = meta
+        return meta
+
+    def get(self, track: Path):
+        """
+        Return the metadata for the track, parsing the file if it isn't cached or has changed.
+        Metadata is stored by the path of the physical file the track leads to, so it is
+        parsed once however many playlists link to the file.
+        """
+        track = Path(track)
+        try:
+            physical = registry().get(track)
+        except OSError:
+            return TrackMetadata(path=str(track), mtime=0, title=track.stem)
+
+        meta = self._memory.get(str(physical.path))
+        if not meta or meta.mtime != physical.mtime:
+            meta = self._load(physical.path, physical.mtime)
+            self._memory[str(physical.path)] = meta
+        self._memory[str(track)] = meta
+        return meta
+
+    def _load(self, path: Path, mtime: int):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT path, mtime, title, artist, album, duration FROM tracks WHERE path = ? AND mtime = ?",
+                (str(path), mtime),
+            ).fetchone()
+        if row:
+            return TrackMetadata(*row)
+        meta = parse(path)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)",
+                (meta.path, meta.mtime, meta.title, meta.artist, meta.album, meta.duration),
+            )
+            self.changes += 1
+            self._changed[meta.path] = self.changes
+        return meta
+
+    def changed_since(self, changes: int):
+        """
+        Return the paths of the physical files whose metadata has been stored since the cache had made the
+        specified number of changes.
+        """
+        with self._lock:
+            return {path for path, change in self._changed.items() if change > changes}
+
+    def stored(self):
+        """
+        Return a dict of the metadata for every track in the database, by the path of its
+        physical file, without touching the tracks.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT path, mtime, title, artist, album, duration FROM tracks").fetchall()
+        return {row[0]: TrackMetadata(*row) for row in rows}
+
+    def prune(self):
+        """
+        Delete the rows of files that are gone, and the rows kept by the paths of playlist
+        entries (symlinks) rather than the files they lead to, and return the number deleted.
+        """
+        with self._lock:
+            paths = [row[0] for row in self.db.execute("SELECT path FROM tracks").fetchall()]
+        stale = [(path,) for path in paths if os.path.islink(path) or not os.path.exists(path)]
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM tracks WHERE path = ?", stale)
+        for (path,) in stale:
+            self._memory.pop(path, None)
+        self._pruned = True
+        return len(stale)
+
+    def warm(self, tracks: Iterable[Path]):
+        """
+        Load the metadata for the tracks in a background thread, first tidying up after
+        files that have been removed.
+        """
+
+        def load():
+            if not self._pruned:
+                logger.debug(f"Deleted {self.prune()} stale rows from the metadata cache.")
+            registry().prune()
+            for track in tracks:
+                try:
+                    self.get(track)
+                except Exception as exc:  # pragma: no cover
+                    logger.error(f"Could not load metadata for {track}", exc_info=exc)
+            logger.debug("Finished loading track metadata.")
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+
+def cache():
+    """
+    Return the MetadataCache for the current environment.
+    """
+    path = croaker.path.metadata_cache()
+    if path not in _caches:
+        _caches[path] = MetadataCache(path)
+    return _caches[path]
@@ -0,0 +1,537 @@
+import logging
+import math
+import subprocess
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import sleep
+from typing import List, Optional
+
+import ffmpeg
+import numpy as np
+
+from croaker.transcoder import FrameAlignedStream
+
+logger = logging.getLogger("mixer")
+
+# every layer is decoded to interleaved 16-bit stereo PCM
+CHANNELS = 2
+SAMPLE_SIZE = 2 * CHANNELS
+
+# the number of samples of silence libmp3lame emits before the first sample of its input
+ENCODER_DELAY = 1105
+
+
+def parse_gain(value: str):
+    """
+    Parse a gain given to a command, which must be a number no less than zero.
+    """
+    gain = float(value)
+    if not math.isfinite(gain) or gain < 0:
+        raise ValueError(f"Gain must be a number no less than 0, not {value}")
+    return gain
+
+
+class Gain:
+    """
+    A gain that can be faded linearly to a new value over a number of samples.
+    """
+
+    def __init__(self, value: float = 1.0, sample_rate: int = 44100):
+        self.value = value
+        self.target = value
+        self.sample_rate = sample_rate
+        self._remaining = 0
+
+    @property
+    def fading(self):
+        return self._remaining > 0
+
+    def fade(self, target: float, seconds: float = 0):
+        self.target = target
+        self._remaining = int(seconds * self.sample_rate)
+        if not self._remaining:
+            self.value = target
+
+    def envelope(self, frames: int):
+        """
+        Return the gain to apply to each of the next frames samples, as a column that
+        can be multiplied with a block of stereo samples, or as a scalar if it's constant.
+        """
+        if not self._remaining:
+            return self.value
+        steps = min(frames, self._remaining)
+        ramp = self.value + (self.target - self.value) * np.arange(1, steps + 1, dtype=np.float32) / self._remaining
+        envelope = np.full(frames, self.target, dtype=np.float32)
+        envelope[:steps] = ramp
+        self.value = float(ramp[-1])
+        self._remaining -= steps
+        return envelope[:, np.newaxis]
+
+
+class Layer:
+    """
+    Decode one or more tracks in turn to PCM with ffmpeg, optionally looping over them
+    forever. If start is given, the first track is decoded from that many seconds in.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tracks: List[Path],
+        gain: float = 1.0,
+        loop: bool = True,
+        sample_rate: int = 44100,
+        start: float = 0.0,
+    ):
+        self.name = name
+        self.start = start
+        self._rewind_to = start
+        self.tracks = list(tracks)
+        self.gain = Gain(gain, sample_rate=sample_rate)
+        self.loop = loop
+        self.sample_rate = sample_rate
+        self.done = False
+        self.removing = False
+        self._index = 0
+        self._source = None
+        self._proc = None
+
+    def decode(self, track: Path):
+        """
+        Start decoding the track and return a filehandle to the PCM output.
+        """
+        seek = {"ss": self.start} if self.start else {}
+        self.start = 0.0
+        args = (
+            ffmpeg.input(str(track), **seek)
+            .output("pipe:", format="s16le", ac=CHANNELS, ar=self.sample_rate)
+            .global_args("-hide_banner", "-vn")
+            .compile()
+        )
+        self._proc = subprocess.Popen(args, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        logger.debug(f"Spawned ffmpeg (PID {self._proc.pid}) to decode {track} for layer {self.name}")
+        return self._proc.stdout
+
+    def _open_next(self):
+        if self._index >= len(self.tracks):
+            if not self.loop or not self.tracks:
+                return False
+            self._index = 0
+        self._source = self.decode(self.tracks[self._index])
+        self._index += 1
+        return True
+
+    def read(self, frames: int):
+        """
+        Return the next frames samples as a float32 array of shape (frames, CHANNELS),
+        padded with silence if the layer has run out of audio.
+        """
+        size = frames * SAMPLE_SIZE
+        data = b""
+        empty = 0
+        while len(data) < size and not self.done:
+            if not self._source and not self._open_next():
+                self.done = True
+                break
+            chunk = self._source.read(size - len(data))
+            if chunk:
+                data += chunk
+                empty = 0
+                continue
+            self._close_source()
+
+            # don't spin forever on a loop of tracks that won't decode
+            empty += 1
+            if empty > len(self.tracks):
+                logger.warning(f"Layer {self.name} has no audio; giving up.")
+                self.done = True
+
+        pcm = np.zeros(frames * CHANNELS, dtype=np.float32)
+        samples = np.frombuffer(data, dtype="<i2", count=len(data) // 2)
+        pcm[: len(samples)] = samples
+        return pcm.reshape(frames, CHANNELS)
+
+    def _close_source(self):
+        if self._proc:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+        if self._source:
+            self._source.close()
+            self._source = None
+
+    def rewind(self):
+        """
+        Go back to the beginning, so that the next read starts decoding the first track again.
+        """
+        self._close_source()
+        self.start = self._rewind_to
+        self._index = 0
+        self.done = False
+
+    def close(self):
+        self._close_source()
+        self.done = True
+
+    def __str__(self):
+        state = " (removing)" if self.removing else ""
+        return f"{self.name}: {self.gain.value:.2f}{state}"
+
+
+@dataclass
+class MixedStream(FrameAlignedStream):
+    """
+    A FrameAlignedStream of a music track mixed with the mixer's ambience layers, read
+    from the encoder that the mixer keeps running for as long as the channel plays, so
+    that the ambience carries on without a gap from one track to the next.
+
+    A stream's audio runs from the point in the mix where the previous track's music
+    ended, or was cut off, to the point where its own music ends; see Mixer.feed(). A
+    stream that the streamer has opened ahead of time doesn't consume anything until then.
+    """
+
+    mixer: "Mixer" = None
+    music: Layer = None
+
+    # the points in the mix, in samples, at which this stream's audio begins and ends
+    first: Optional[int] = field(default=None, init=False)
+    end: Optional[int] = field(default=None, init=False)
+    _started: threading.Event = field(default_factory=threading.Event, init=False)
+    _closed: threading.Event = field(default_factory=threading.Event, init=False)
+
+    def __iter__(self):
+        self.mixer.play(self)
+        yield from super().__iter__()
+
+    @property
+    def frames(self):
+        mixer = self.mixer
+        while not self._started.wait(timeout=0.1):
+            if self._closed.is_set() or not mixer.running:
+                return
+        while self.end is None or mixer.encoded < self.end + ENCODER_DELAY:
+            frame = self._read_one_frame()
+            if not frame:
+                return
+            mixer.encoded += self.samples_per_frame(frame)
+
+            # skip what's left of the audio of a track that was cut off
+            if mixer.encoded <= self.first + ENCODER_DELAY:
+                continue
+            yield frame
+
+    def close(self):
+        self._closed.set()
+        with self.mixer._lock:
+            if self in self.mixer._queue:
+                self.mixer._queue.remove(self)
+            if self.mixer._playing is self:
+                self.mixer._playing = None
+            mixing = self.mixer._mixing is self
+
+        # music that is being mixed belongs to the mixing thread, which closes it
+        if not mixing:
+            self.music.close()
+
+    @classmethod
+    def encoder_args(cls, **kwargs):
+        """
+        Return the ffmpeg command line that will encode PCM on stdin to an mp3 stream on stdout.
+        """
+        sample_rate = kwargs.get("sample_rate", cls.sample_rate)
+        return (
+            # raw PCM needs no probing, and probing holds back the first few seconds of output
+            ffmpeg.input("pipe:", format="s16le", ac=CHANNELS, ar=sample_rate, probesize=32, analyzeduration=0)
+            .output(
+                "pipe:",
+                format="mp3",
+                write_xing=0,
+                id3v2_version=0,
+                # don't hold encoded frames back in ffmpeg's output buffer
+                flush_packets=1,
+                **{
+                    "b:a": kwargs.get("bit_rate", cls.bit_rate),
+                    "ar": sample_rate,
+                },
+            )
+            .global_args("-hide_banner")
+            .compile()
+        )
+
+    @classmethod
+    def from_source(cls, infile: Path, mixer: "Mixer" = None, **kwargs):
+        """
+        Return a stream of the source mixed with the mixer's layers, to be mixed once it is played.
+        """
+        music = Layer(
+            "music",
+            [infile],
+            loop=False,
+            sample_rate=kwargs.get("sample_rate", cls.sample_rate),
+            start=kwargs.get("start", 0.0),
+        )
+        stream = cls(None, mixer=mixer, music=music, **kwargs)
+        with mixer._lock:
+            mixer._queue.append(stream)
+        return stream
+
+
+class Mixer:
+    """
+    Mix music with any number of looping ambience layers, each with its own gain, and
+    encode the result once for the mount. Layers can be added, faded and removed while
+    the stream is playing.
+
+    One thread mixes and one ffmpeg encodes for as long as the channel plays, staying no
+    more than lookahead seconds ahead of the streams reading the encoder's output, so that
+    changes to the layers are heard promptly. Only the mixing thread reads the layers.
+
+    Usage:
+
+        >>> mixer = Mixer()
+        >>> mixer.add("rain", [Path("rain.flac")], gain=0.5)
+        >>> for segment in mixer.open(Path("tavern.mp3")):
+            ...
+        >>> mixer.fade("music", 0.3, seconds=2)
+        >>> mixer.remove("rain", seconds=5)
+    """
+
+    def __init__(
+        self, sample_rate: int = 44100, block_size: int = 4608, lookahead: float = 0.5, fade_time: float = 2.0
+    ):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.lookahead = lookahead
+        self.fade_time = fade_time
+        self.music = Gain(1.0, sample_rate=sample_rate)
+        self.layers = {}
+
+        # layers that have been removed or replaced, to be closed by the mixing thread
+        self._retired = []
+        self._lock = threading.Lock()
+
+        # the encoder, the thread feeding it, the streams that are open, in the order they
+        # were opened, the one being played and the one whose music is being mixed
+        self._encoder = None
+        self._feeder = None
+        self._queue = []
+        self._playing = None
+        self._mixing = None
+        self._stopped = threading.Event()
+
+        # the samples of audio written to the encoder, and read back out of it, so far
+        self.mixed = 0
+        self.encoded = 0
+
+        # the point in the mix at which the last stream's music ended or was cut off
+        self._boundary = 0
+
+    @property
+    def running(self):
+        return bool(self._feeder and self._feeder.is_alive())
+
+    def _gain(self, name: str):
+        if name == "music":
+            return self.music
+        if name not in self.layers:
+            raise ValueError(f"No such layer: {name}")
+        return self.layers[name].gain
+
+    def add(self, name: str, tracks: List[Path], gain: float = 1.0, seconds: float = None):
+        """
+        Add a looping layer, fading it in from silence. An existing layer of the same name is replaced.
+        """
+        if name == "music":
+            raise ValueError("The music layer can't be replaced.")
+        layer = Layer(name, tracks, gain=0.0, sample_rate=self.sample_rate)
+        layer.gain.fade(gain, self.fade_time if seconds is None else seconds)
+        with self._lock:
+            if name in self.layers:
+                self._retired.append(self.layers[name])
+            self.layers[name] = layer
+        logger.debug(f"Added layer {layer}")
+        return layer
+
+    def fade(self, name: str, gain: float, seconds: float = None):
+        """
+        Fade the named layer, or the music, to the specified gain.
+        """
+        with self._lock:
+            self._gain(name).fade(gain, self.fade_time if seconds is None else seconds)
+
+    def remove(self, name: str, seconds: float = None):
+        """
+        Fade the named layer out and remove it.
+        """
+        if name == "music":
+            raise ValueError("The music layer can't be removed.")
+        with self._lock:
+            self._gain(name).fade(0.0, self.fade_time if seconds is None else seconds)
+            self.layers[name].removing = True
+
+    def play(self, stream: MixedStream):
+        """
+        Start mixing the stream's music, in place of whatever was playing, starting the encoder if it isn't running.
+        """
+        with self._lock:
+            if not self.running:
+                self._start()
+            stream.source = self._encoder.stdout
+            self._playing = stream
+
+    def _start(self):
+        """
+        Start the encoder and the thread that feeds it. Must be called with the lock held.
+        """
+        args = MixedStream.encoder_args(sample_rate=self.sample_rate)
+        self._encoder = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        logger.debug(f"Spawned ffmpeg (PID {self._encoder.pid}) with args {args = }")
+        self.mixed = self.encoded = self._boundary = 0
+        self._stopped.clear()
+        self._feeder = threading.Thread(target=self.feed, name="Mixer", daemon=True)
+        self._feeder.start()
+
+    def feed(self):
+        """
+        Mix a block at a time and write it to the encoder until the mixer is shut down.
+
+        Each block has the music of the stream being played in it, until that music ends
+        or the stream is closed. From then on it has the music of the next stream that has
+        been opened, so the next track starts without waiting for the streamer to play it;
+        if the streamer plays a different stream instead, the next one is rewound for later,
+        and the stream being played starts from there.
+        """
+        lookahead = self.lookahead * self.sample_rate
+        delay = None
+        try:
+            while not self._stopped.is_set():
+                # The encoder holds on to some audio before it emits anything, so only start
+                # throttling once output has begun, allowing for however much that was.
+                if delay is None and self.encoded:
+                    delay = self.mixed - self.encoded
+                    logger.debug(f"Encoder delay is {delay / self.sample_rate:.3f}s.")
+                if delay is not None and self.mixed - self.encoded > delay + lookahead:
+                    sleep(0.01)
+                    continue
+                with self._lock:
+                    stream = self._next_stream()
+                    if stream is not self._mixing:
+                        self._switch(stream)
+                music = stream.music if stream else None
+                self._encoder.stdin.write(self.mix(music, self.block_size))
+                with self._lock:
+                    self.mixed += self.block_size
+                    if music and music.done:
+                        self._end(stream)
+        except (BrokenPipeError, ValueError):
+            logger.debug("Encoder closed while mixing.")
+        finally:
+            with self._lock:
+                if self._mixing:
+                    self._retired.append(self._mixing.music)
+                    self._mixing = None
+                retired, self._retired = self._retired, []
+            for layer in retired:
+                layer.close()
+            try:
+                self._encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _next_stream(self):
+        """
+        Return the stream whose music should be mixed next. Must be called with the lock held.
+        """
+        if self._playing and self._playing.end is None:
+            return self._playing
+        return next((stream for stream in self._queue if stream.end is None), None)
+
+    def _switch(self, stream: Optional[MixedStream]):
+        """
+        Stop mixing the current stream's music, and start mixing the stream's from the point
+        at which the last one stopped. Must be called with the lock held.
+        """
+        current, self._mixing = self._mixing, stream
+        if current:
+            self._boundary = self.mixed
+            if current._closed.is_set():
+                self._retired.append(current.music)
+            else:
+                logger.debug(f"Rewinding {current.music.tracks[0]} to play it later.")
+                current.music.rewind()
+                current.first = None
+                current._started.clear()
+        if stream:
+            stream.first = self._boundary
+            stream._started.set()
+
+    def _end(self, stream: MixedStream):
+        """
+        End the stream's audio at the current point in the mix. Must be called with the lock held.
+        """
+        stream.end = self._boundary = self.mixed
+        self._retired.append(stream.music)
+        self._mixing = None
+
+    def mix(self, music: Optional[Layer], frames: int):
+        """
+        Return the next frames samples of the music, if any, and every layer, summed with their gains, as 16-bit PCM.
+
+        The layers are read without holding the lock, so that decoding never holds up
+        commands that add, fade or remove layers.
+        """
+        with self._lock:
+            layers = list(self.layers.values())
+        blocks = [layer.read(frames) for layer in layers]
+        out = music.read(frames) if music else np.zeros((frames, CHANNELS), dtype=np.float32)
+
+        with self._lock:
+            out *= self.music.envelope(frames)
+            for layer, block in zip(layers, blocks):
+                out += block * layer.gain.envelope(frames)
+                if layer.done or (layer.removing and not layer.gain.fading):
+                    logger.debug(f"Removing layer {layer.name}")
+                    if self.layers.get(layer.name) is layer:
+                        del self.layers[layer.name]
+                    self._retired.append(layer)
+            retired, self._retired = self._retired, []
+        for layer in retired:
+            layer.close()
+
+        np.clip(out, -32768, 32767, out=out)
+        return out.astype("<i2").tobytes()
+
+    def open(self, infile: Path, **kwargs):
+        """
+        Return a stream of the source mixed with the current layers.
+        """
+        return MixedStream.from_source(infile, mixer=self, sample_rate=self.sample_rate, **kwargs)
+
+    def gains(self):
+        """
+        Return the gain each layer, and the music, is at or fading to, leaving out layers being removed.
+        """
+        with self._lock:
+            gains = {name: layer.gain.target for name, layer in self.layers.items() if not layer.removing}
+            gains["music"] = self.music.target
+        return gains
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._encoder:
+            self._encoder.kill()
+            self._encoder.wait()
+        if self._feeder:
+            self._feeder.join(timeout=5)
+        with self._lock:
+            retired = list(self.layers.values()) + self._retired
+            self.layers.clear()
+            self._retired = []
+        for layer in retired:
+            layer.close()
+
+    def __str__(self):
+        with self._lock:
+            lines = [f"music: {self.music.value:.2f}"] + [str(layer) for layer in self.layers.values()]
+        return "\n".join(lines)
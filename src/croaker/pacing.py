@@ -0,0 +1,141 @@
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Callable, Optional
+
+logger = logging.getLogger("pacing")
+
+
+@dataclass
+class ChunkSizer:
+    """
+    Choose how much audio the streamer sends to icecast at a time, and measure the
+    latency that results: how long each chunk takes to read and send, which is how long
+    a control command can wait before the streamer notices it.
+
+    shout paces sends to real time, so a chunk holding more audio than the latency target
+    takes longer than the target to send, while smaller chunks cost more reads, sends and
+    syncs for the same audio. With a target, chunks are sized in whole frames: they grow
+    a frame at a time while each chunk is read and sent with a frame to spare, and are
+    halved whenever a chunk takes longer than the target (because the sink or the source
+    is falling behind) or a command arrives (because another is likely to follow, and
+    will wait behind the next chunk). Without a target, every chunk is chunk_size bytes.
+
+    A "frame" is 1152 samples' worth of audio at the stream's bit rate, which is an mp3
+    frame exactly, and about as much Ogg/Opus audio.
+
+    Usage:
+
+        >>> sizer = ChunkSizer(target=0.25, bit_rate=192000, sample_rate=44100)
+        >>> sizer.start()
+        >>> for chunk in stream:
+        ...     send(chunk)
+        ...     sizer.sent()
+        ...     stream.chunk_size = sizer.next_chunk_size()
+    """
+
+    chunk_size: int = 4096
+    target: Optional[float] = None
+    bit_rate: int = 192000
+    sample_rate: int = 44100
+    clock: Callable = monotonic
+
+    # how long each of the most recent chunks took to read and send
+    latencies: deque = field(default_factory=lambda: deque(maxlen=64), init=False)
+    _last: Optional[float] = field(default=None, init=False, repr=False)
+
+    # set from other threads when a command arrives; see command()
+    _commands: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.target:
+            # round the initial chunk_size up to whole frames, within the target
+            self.chunk_size = min(self.frames, self.max_frames) * self.frame_size
+
+    @property
+    def frame_size(self):
+        return self.bit_rate // 8 * 1152 // self.sample_rate
+
+    @property
+    def frame_duration(self):
+        return 1152 / self.sample_rate
+
+    @property
+    def max_frames(self):
+        return max(1, int(self.target / self.frame_duration))
+
+    @property
+    def frames(self):
+        """
+        The number of frames in each chunk; streams only yield whole frames, so a chunk_size
+        that isn't a multiple of the frame size is rounded up.
+        """
+        return max(1, -(-self.chunk_size // self.frame_size))
+
+    @frames.setter
+    def frames(self, frames: int):
+        self.chunk_size = max(1, min(frames, self.max_frames)) * self.frame_size
+
+    @property
+    def latency(self):
+        """
+        The average time, in seconds, it took to read and send the most recent chunks.
+        """
+        return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+    def start(self):
+        """
+        Start timing the next chunk from now, leaving out whatever happened since the last one was sent.
+        """
+        self._last = self.clock()
+
+    def sent(self):
+        """
+        Record that a chunk has been sent, and adapt the size of the next one.
+        """
+        now = self.clock()
+        if self._last is None:
+            self._last = now
+            return
+        elapsed, self._last = now - self._last, now
+        self.latencies.append(elapsed)
+        if not self.target:
+            return
+        if elapsed > self.target:
+            self.shrink()
+        elif elapsed + self.frame_duration <= self.target:
+            self.frames += 1
+
+    def command(self):
+        """
+        Note that a control command has arrived, so that the next chunk read is smaller. Safe to call from any thread.
+        """
+        self._commands.set()
+
+    def next_chunk_size(self):
+        """
+        Return the size of the next chunk to read, halving it first if a command has arrived since the last read.
+        """
+        if self._commands.is_set():
+            self._commands.clear()
+            self.shrink()
+        return self.chunk_size
+
+    def shrink(self):
+        """
+        Halve the size of the next chunk, if sizing is adaptive.
+        """
+        if self.target and self.frames > 1:
+            self.frames //= 2
+            logger.debug(f"Chunk size is now {self.frames} frames.")
+
+    def __str__(self):
+        lines = [
+            f"chunk size: {self.chunk_size} bytes ({self.frames} frames, {self.frames * self.frame_duration:.3f}s)"
+        ]
+        if self.latencies:
+            lines.append(f"latency: {self.latency:.3f}s average, {max(self.latencies):.3f}s max")
+        lines.append(f"latency target: {f'{self.target:.3f}s' if self.target else 'none'}")
+        return "\n".join(lines)
@@ -12,3 +12,7 @@ def root():
 def playlist_root():
     path = Path(os.environ.get("PLAYLIST_ROOT", root() / "playlists")).expanduser()
     return path
+
+
+def metadata_cache():
+    return Path(os.environ.get("METADATA_CACHE", root() / "metadata.db")).expanduser()
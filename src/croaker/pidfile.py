@@ -2,6 +2,7 @@ import logging
 import os
 import signal
 from pathlib import Path
+from time import monotonic, sleep
 
 from daemon import pidfile as _pidfile
 
@@ -19,3 +20,18 @@ def pidfile(pidfile_path: Path, sig=signal.SIGQUIT, terminate_if_running: bool =
             logger.debug(f"PID {pid} not running; breaking lock.")
             pf.break_lock()
     return pf
+
+
+def wait_for_exit(pid: int, timeout: float = 30):
+    """
+    Wait for the process with the specified PID to exit, returning False if it's still running after timeout seconds.
+    """
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        sleep(0.05)
+    logger.warning(f"PID {pid} is still running after {timeout}s.")
+    return False
@@ -1,5 +1,6 @@
 import logging
 import os
+from collections import OrderedDict
 from dataclasses import dataclass
 from functools import cached_property
 from itertools import chain
@@ -8,10 +9,14 @@ from random import shuffle
 from typing import List
 
 import croaker.path
+from croaker import metadata
 
 logger = logging.getLogger("playlist")
 
-playlists = {}
+# Playlists are cached so that each keeps the order it was shuffled into when it was
+# first loaded. Only playlists that exist are cached, and only the most recently used.
+playlists = OrderedDict()
+PLAYLIST_CACHE_SIZE = 64
 
 
 def _stripped(name):
@@ -86,11 +91,19 @@ class Playlist:
 
     def __repr__(self):
         lines = [f"Playlist {self.name}"]
-        lines += [f" * {track}" for track in self.tracks]
+        cache = metadata.cache()
+        # only tags that have already been parsed are shown, so listing a playlist never waits on the files
+        lines += [f" * {cache.lookup(track) or track.stem}" for track in self.tracks]
         return "\n".join(lines)
 
 
-def load_playlist(name: str):  # pragma: no cover
-    if name not in playlists:
-        playlists[name] = Playlist(name=name)
-    return playlists[name]
+def load_playlist(name: str):
+    if name in playlists:
+        playlists.move_to_end(name)
+        return playlists[name]
+    playlist = Playlist(name=name)
+    if playlist.path.exists():
+        playlists[name] = playlist
+        while len(playlists) > PLAYLIST_CACHE_SIZE:
+            playlists.popitem(last=False)
+    return playlist
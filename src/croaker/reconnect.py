@@ -0,0 +1,85 @@
+import logging
+import random
+from dataclasses import dataclass, field
+from time import time
+from typing import Callable, Optional
+
+logger = logging.getLogger("reconnect")
+
+
+@dataclass
+class Backoff:
+    """
+    Generate exponentially increasing delays between reconnection attempts, with jitter
+    so that several clients don't all retry in lockstep.
+
+    Usage:
+
+        >>> backoff = Backoff(base=1, cap=30)
+        >>> sleep(backoff.next())  # between 0.5 and 1 seconds
+        >>> sleep(backoff.next())  # between 1 and 2 seconds
+        >>> backoff.reset()
+    """
+
+    base: float = 0.5
+    factor: float = 2.0
+    cap: float = 30.0
+    jitter: float = 0.5
+    rand: Callable = random.random
+    attempts: int = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * self.factor**self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * self.rand())
+
+    def reset(self):
+        self.attempts = 0
+
+
+@dataclass
+class ConnectionStats:
+    """
+    Keep track of how often and for how long the connection to the icecast server was down.
+    """
+
+    clock: Callable = time
+    connections: int = 0
+    downtime: float = 0.0
+    last_error: Optional[str] = None
+    _down_since: Optional[float] = field(default=None, repr=False)
+
+    @property
+    def connected(self):
+        return self.connections > 0 and self._down_since is None
+
+    @property
+    def reconnects(self):
+        return max(0, self.connections - 1)
+
+    def up(self):
+        self.connections += 1
+        if self._down_since is not None:
+            outage = self.clock() - self._down_since
+            self.downtime += outage
+            self._down_since = None
+            logger.info(f"Connected after {outage:.1f}s; {self.reconnects} reconnects, {self.downtime:.1f}s downtime.")
+
+    def down(self, error: Exception = None):
+        if error:
+            self.last_error = str(error)
+        if self._down_since is None:
+            self._down_since = self.clock()
+
+    def __str__(self):
+        downtime = self.downtime
+        if self._down_since is not None:
+            downtime += self.clock() - self._down_since
+        lines = [
+            f"connected: {'yes' if self.connected else 'no'}",
+            f"reconnects: {self.reconnects}",
+            f"downtime: {downtime:.1f}s",
+        ]
+        if self.last_error:
+            lines.append(f"last error: {self.last_error}")
+        return "\n".join(lines)
@@ -0,0 +1,314 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import croaker.path
+
+logger = logging.getLogger("registry")
+
+# how much of each file is hashed at the start, middle and end
+SAMPLE_SIZE = 64 * 1024
+
+_registry = None
+
+
+def sampled_digest(path: Path, size: int, sample_size: int = SAMPLE_SIZE):
+    """
+    Hash the size of a file and three samples of its contents, from the start, middle
+    and end. Files no bigger than the three samples together are hashed whole.
+    """
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with path.open("rb") as f:
+        if size <= 3 * sample_size:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - sample_size) // 2, size - sample_size):
+                f.seek(offset)
+                digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def full_digest(path: Path, block_size: int = 1024 * 1024):
+    """
+    Hash the whole of a file's contents.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class TrackFile:
+    """
+    A physical audio file, however many playlist entries lead to it, and the digest of
+    its contents, which it shares with any copies of it.
+    """
+
+    path: Path
+    device: int
+    inode: int
+    size: int
+    mtime: int
+    digest: str
+
+    @property
+    def version(self):
+        """
+        The device and inode of the file, and its size and mtime, which change with its contents.
+        """
+        return (self.device, self.inode, self.size, self.mtime)
+
+
+@dataclass
+class Duplicate:
+    """
+    A track whose contents are reachable from more than one playlist entry, as the
+    physical files holding those contents and the entries that lead to them.
+    """
+
+    files: List[TrackFile]
+    entries: List[str]
+
+    @property
+    def size(self):
+        return self.files[0].size
+
+    @property
+    def copies(self):
+        """
+        The bytes of disk that would be freed by replacing every copy but one with a symlink.
+        """
+        return self.size * (len(self.files) - 1)
+
+    @property
+    def shared(self):
+        """
+        The bytes that every entry but one would read and transcode again, if entries didn't share their track.
+        """
+        return self.size * (len(self.entries) - 1)
+
+
+class TrackRegistry:
+    """
+    Keep one record per physical audio file, so that the work done for a track -- parsing
+    its tags, transcoding it -- is done once, however many playlists link to it.
+
+    Playlist entries are symlinks, which are resolved to the files they lead to. Each file
+    is identified by its device and inode, and its record is kept for as long as its size
+    and modification time don't change, so looking up a known file costs one stat. A new
+    or changed file is hashed, but only a sample of it; see sampled_digest(). Copies of the
+    same file have different records but the same digest. A sample can't tell apart files
+    that differ only between the samples, so before anything is shared between two files
+    with the same digest, like a transcode in the TranscoderPool's cache, same_contents()
+    confirms the match by hashing both files whole.
+
+    Records are dropped when their file can no longer be found, either because looking it
+    up fails or by prune().
+
+    Usage:
+
+        >>> track = registry().get(Path("playlists/battle/goblin_chase.mp3"))
+        >>> track.path, track.digest
+        (PosixPath('/music/goblin_chase.mp3'), '9c1e...')
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._entries = {}
+        self._contents = {}
+        self._lock = threading.Lock()
+        self.hashed = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, track: Path) -> TrackFile:
+        """
+        Return the record for the physical file the track leads to, hashing it if it is new or has changed.
+        """
+        # stat follows the links to the file, so a file that is already known never needs resolving
+        track = Path(track)
+        try:
+            stat = track.stat()
+        except OSError:
+            with self._lock:
+                self._forget(str(track))
+            raise
+        key = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            record = self._files.get(key)
+        if not record or record.size != stat.st_size or record.mtime != stat.st_mtime_ns:
+            path = track.resolve()
+            record = TrackFile(
+                path=path,
+                device=stat.st_dev,
+                inode=stat.st_ino,
+                size=stat.st_size,
+                mtime=stat.st_mtime_ns,
+                digest=sampled_digest(path, stat.st_size),
+            )
+            with self._lock:
+                old = self._files.get(key)
+                if old:
+                    self._contents.pop(old.version, None)
+                self._files[key] = record
+                self.hashed += 1
+        with self._lock:
+            previous = self._entries.get(str(track))
+            self._entries[str(track)] = key
+            if previous and previous != key:
+                self._drop_unused(previous)
+        return record
+
+    def _forget(self, entry: str):
+        """
+        Drop the entry, and the record of its file if no other entry leads to it. Must be called with the lock held.
+        """
+        key = self._entries.pop(entry, None)
+        if key:
+            self._drop_unused(key)
+
+    def _drop_unused(self, key: tuple):
+        if key in self._entries.values():
+            return
+        record = self._files.pop(key, None)
+        if record:
+            self._contents.pop(record.version, None)
+
+    def prune(self):
+        """
+        Drop the records of every entry that no longer leads to a file, and return the number dropped.
+        """
+        with self._lock:
+            entries = list(self._entries)
+        gone = [entry for entry in entries if not os.path.exists(entry)]
+        with self._lock:
+            for entry in gone:
+                self._forget(entry)
+        return len(gone)
+
+    def same_contents(self, one: TrackFile, other: TrackFile):
+        """
+        Return True if the two files hold the same contents. Files with different sampled
+        digests never do; otherwise both are hashed whole, once per version of each file.
+        """
+        if one.version == other.version:
+            return True
+        if one.digest != other.digest:
+            return False
+        digest = self._full_digest(one)
+        return digest is not None and digest == self._full_digest(other)
+
+    def _full_digest(self, record: TrackFile):
+        """
+        Return the digest of the whole file, or None if it has changed since the record was made.
+        """
+        with self._lock:
+            digest = self._contents.get(record.version)
+        if digest:
+            return digest
+        try:
+            stat = record.path.stat()
+        except OSError:
+            return None
+        if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) != record.version:
+            return None
+        digest = full_digest(record.path)
+        with self._lock:
+            self._contents[record.version] = digest
+        return digest
+
+    def cached(self, track: Path) -> Optional[TrackFile]:
+        """
+        Return the record for the track if it has already been looked up, without touching the disk.
+        """
+        with self._lock:
+            return self._files.get(self._entries.get(str(track)))
+
+    def scan(self, tracks: Iterable[Path]):
+        """
+        Look up every track, skipping any that can't be read, and return the number found.
+        """
+        count = 0
+        for track in tracks:
+            try:
+                self.get(track)
+            except OSError as exc:
+                logger.warning(f"Skipping {track}: {exc}")
+                continue
+            count += 1
+        return count
+
+    def duplicates(self) -> List[Duplicate]:
+        """
+        Return every track whose contents are reachable from more than one playlist entry, largest first.
+        """
+        with self._lock:
+            files = defaultdict(list)
+            for record in self._files.values():
+                files[record.digest].append(record)
+            entries = defaultdict(list)
+            for entry, key in self._entries.items():
+                entries[self._files[key].digest].append(entry)
+        found = [
+            Duplicate(files=sorted(files[digest], key=lambda f: str(f.path)), entries=sorted(entries[digest]))
+            for digest in entries
+            if len(entries[digest]) > 1
+        ]
+        return sorted(found, key=lambda duplicate: (-duplicate.shared, str(duplicate.files[0].path)))
+
+    def report(self):
+        """
+        Describe the duplicate content found so far, and the space saved by sharing it.
+        """
+        root = croaker.path.playlist_root()
+        duplicates = self.duplicates()
+        lines = []
+        for duplicate in duplicates:
+            lines.append(
+                f"{duplicate.files[0].path.name} ({_megabytes(duplicate.size)}): "
+                f"{len(duplicate.entries)} entries, {len(duplicate.files)} {_plural(len(duplicate.files), 'file')}"
+            )
+            lines += [f"    {record.path}" for record in duplicate.files]
+            lines += [f"      {_relative(entry, root)}" for entry in duplicate.entries]
+        if not duplicates:
+            lines.append("No duplicate tracks.")
+        lines += [
+            "",
+            f"{len(self._entries)} playlist entries, {len(self)} files, "
+            f"{len({record.digest for record in self._files.values()})} distinct tracks",
+            f"Sharing tracks between entries saves reading and transcoding "
+            f"{_megabytes(sum(d.shared for d in duplicates))}.",
+            f"Replacing copies with symlinks would free {_megabytes(sum(d.copies for d in duplicates))}.",
+        ]
+        return "\n".join(lines)
+
+
+def _megabytes(size: int):
+    return f"{size / 1024**2:.1f} MB"
+
+
+def _plural(count: int, word: str):
+    return word if count == 1 else f"{word}s"
+
+
+def _relative(entry: str, root: Path):
+    path = Path(entry)
+    return str(path.relative_to(root)) if path.is_relative_to(root) else entry
+
+
+def registry():
+    """
+    Return the TrackRegistry shared by everything in this process.
+    """
+    global _registry
+    if _registry is None:
+        _registry = TrackRegistry()
+    return _registry
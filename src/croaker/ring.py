@@ -0,0 +1,100 @@
+import struct
+from multiprocessing.shared_memory import SharedMemory
+
+# Record types
+FRAME = 0
+END = 1
+
+
+class FrameRing:
+    """
+    A single-producer, single-consumer ring buffer of records in shared memory, used to
+    hand frames of audio from a worker process to the streamer without pickling them.
+
+    The first 16 bytes of the shared memory hold the total number of bytes ever written
+    and read; since only the writer updates the first and only the reader updates the
+    second, no locking is needed. Each record is a header (payload length, generation,
+    record type and the number of audio samples in the payload) followed by the payload,
+    and may wrap around the end of the buffer.
+
+    Usage:
+
+        >>> ring = FrameRing(size=65536)
+        >>> other_end = FrameRing(size=65536, name=ring.name)
+        >>> ring.write(FRAME, 1, b"...", samples=1152)
+        True
+        >>> other_end.read()
+        (0, 1, b'...', 1152)
+    """
+
+    counters = struct.Struct("<QQ")
+    header = struct.Struct("<IIBI")
+
+    def __init__(self, size: int = 1024 * 1024, name: str = None):
+        self.size = size
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=self.counters.size + size)
+            self.counters.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = SharedMemory(name=name)
+        self._data = self.shm.buf[self.counters.size : self.counters.size + size]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _positions(self):
+        return self.counters.unpack_from(self.shm.buf, 0)
+
+    def used(self):
+        written, read = self._positions()
+        return written - read
+
+    def _put(self, pos: int, data: bytes):
+        start = pos % self.size
+        first = min(len(data), self.size - start)
+        self._data[start : start + first] = data[:first]
+        if first < len(data):
+            self._data[: len(data) - first] = data[first:]
+
+    def _get(self, pos: int, length: int):
+        start = pos % self.size
+        first = min(length, self.size - start)
+        data = bytes(self._data[start : start + first])
+        if first < length:
+            data += bytes(self._data[: length - first])
+        return data
+
+    def write(self, kind: int, generation: int, payload: bytes = b"", samples: int = 0):
+        """
+        Append a record, returning False if there isn't room for it yet.
+        """
+        length = self.header.size + len(payload)
+        if length > self.size:
+            raise ValueError(f"Record of {length} bytes will never fit in a {self.size} byte ring.")
+        written, read = self._positions()
+        if self.size - (written - read) < length:
+            return False
+        self._put(written, self.header.pack(len(payload), generation, kind, samples))
+        self._put(written + self.header.size, payload)
+        struct.pack_into("<Q", self.shm.buf, 0, written + length)
+        return True
+
+    def read(self):
+        """
+        Remove and return the oldest record as (kind, generation, payload, samples), or None if the ring is empty.
+        """
+        written, read = self._positions()
+        if written == read:
+            return None
+        length, generation, kind, samples = self.header.unpack(self._get(read, self.header.size))
+        payload = self._get(read + self.header.size, length)
+        struct.pack_into("<Q", self.shm.buf, 8, read + self.header.size + length)
+        return kind, generation, payload, samples
+
+    def close(self):
+        self._data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
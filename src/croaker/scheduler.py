@@ -0,0 +1,158 @@
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from time import time
+from typing import Callable, Optional
+
+logger = logging.getLogger("scheduler")
+
+
+@dataclass
+class Transition:
+    """
+    A playlist switch to be executed by the streamer, either at a specific wall-clock
+    time or, if at is None, at the next track boundary.
+    """
+
+    playlist: str
+    action: Callable
+    at: Optional[float] = None
+    position: Optional[float] = None
+
+    def __str__(self):
+        when = "next track" if self.at is None else datetime.fromtimestamp(self.at).strftime("%H:%M:%S.%f")[:-3]
+        return f"{self.playlist} @ {when}"
+
+
+class Scheduler:
+    """
+    Keep track of queued transitions and of how the stream timeline lines up with the
+    wall clock, so that transitions can be executed at frame boundaries.
+
+    The streamer calls advance() each time it has sent audio, with the total number of
+    seconds of audio sent so far. Since sending is paced to real time, that gives us an
+    anchor from which any wall-clock time can be mapped onto a stream position. Timed
+    transitions are mapped once, when they are scheduled, so that the position at which
+    the streamer cuts the current source is exactly the one at which the transition is due.
+
+    Usage:
+
+        >>> scheduler = Scheduler()
+        >>> scheduler.advance(0.0)
+        >>> scheduler.after(30, "battle", lambda: print("Roll initiative!"))
+        >>> scheduler.deadline()
+        30.0
+    """
+
+    # allowance for floating point error when comparing stream positions
+    tolerance = 1e-6
+
+    def __init__(self, clock: Callable = time):
+        self.clock = clock
+        self.elapsed = 0.0
+        self._anchor = None
+        self._timed = []
+        self._boundary = []
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return list(self._timed) + list(self._boundary)
+
+    def at(self, when: float, playlist: str, action: Callable):
+        """
+        Switch to the playlist at the specified wall-clock time.
+        """
+        transition = Transition(playlist=playlist, action=action, at=when, position=self.stream_time(when))
+        with self._lock:
+            self._timed.append(transition)
+            self._timed.sort(key=lambda t: t.position)
+        logger.debug(f"Scheduled {transition}")
+        return transition
+
+    def after(self, seconds: float, playlist: str, action: Callable):
+        """
+        Switch to the playlist after the specified number of seconds.
+        """
+        return self.at(self.clock() + seconds, playlist, action)
+
+    def next_track(self, playlist: str, action: Callable):
+        """
+        Switch to the playlist when the current track ends.
+        """
+        transition = Transition(playlist=playlist, action=action)
+        with self._lock:
+            self._boundary.append(transition)
+        logger.debug(f"Scheduled {transition}")
+        return transition
+
+    def cancel(self):
+        """
+        Discard all pending transitions and return them.
+        """
+        with self._lock:
+            cancelled = self._timed + self._boundary
+            self._timed = []
+            self._boundary = []
+        return cancelled
+
+    def advance(self, elapsed: float):
+        """
+        Record that elapsed seconds of audio have been sent as of now.
+        """
+        self.elapsed = elapsed
+        self._anchor = (elapsed, self.clock())
+
+    def stream_time(self, when: float):
+        """
+        Map a wall-clock time onto the stream timeline.
+        """
+        elapsed, now = self._anchor or (self.elapsed, self.clock())
+        return elapsed + (when - now)
+
+    def deadline(self):
+        """
+        Return the stream position of the earliest timed transition, if any.
+        """
+        with self._lock:
+            if not self._timed:
+                return None
+            return self._timed[0].position
+
+    def due(self, elapsed: float, boundary: bool = False):
+        """
+        Return the next transition that should be executed at the given stream position,
+        if any. Transitions waiting for the next track are only due at a track boundary.
+        """
+        with self._lock:
+            if self._timed and self._timed[0].position <= elapsed + self.tolerance:
+                return self._timed.pop(0)
+            if boundary and self._boundary:
+                return self._boundary.pop(0)
+        return None
+
+
+def parse_when(spec: str, clock: Callable = time):
+    """
+    Parse a transition time and return it as a wall-clock timestamp, or None for the
+    next track boundary. Accepts "next", "+SECONDS" or "HH:MM[:SS]" (today, local time).
+    """
+    spec = spec.strip().lower()
+    if not spec or spec == "next":
+        return None
+    if spec.startswith("+"):
+        seconds = float(spec[1:])
+        if seconds < 0:
+            raise ValueError(f"Cannot schedule a transition in the past: {spec}")
+        return clock() + seconds
+
+    now = datetime.fromtimestamp(clock())
+    parts = [int(p) for p in spec.split(":")]
+    if len(parts) not in (2, 3):
+        raise ValueError(f"Expected next, +SECONDS or HH:MM[:SS]; got {spec}")
+    when = now.replace(hour=parts[0], minute=parts[1], second=parts[2] if len(parts) == 3 else 0, microsecond=0)
+    if when < now:
+        raise ValueError(f"Cannot schedule a transition in the past: {spec}")
+    return when.timestamp()
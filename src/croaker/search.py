@@ -0,0 +1,264 @@
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic
+from typing import Iterable, List
+
+import croaker.path
+from croaker import metadata
+from croaker.playlist import Playlist
+
+logger = logging.getLogger("search")
+
+_words = re.compile(r"[^\W_]+")
+
+
+def words(text: str):
+    """
+    Split text into lowercase words, treating punctuation and underscores as spaces.
+    """
+    return _words.findall(text.casefold())
+
+
+def trigrams(word: str):
+    return {word[i : i + 3] for i in range(len(word) - 2)}
+
+
+@dataclass(frozen=True)
+class Match:
+    """
+    A track found by a search, and the playlist it was found in.
+    """
+
+    playlist: str
+    track: Path
+    title: str
+
+    def __str__(self):
+        return f"{self.playlist}: {self.title}"
+
+
+class TrackIndex:
+    """
+    An in-memory index of the tracks in every playlist, searchable by any part of the
+    tracks' playlist and file names, titles, artists and albums.
+
+    Each word of a track's text is broken into trigrams, and the index maps every trigram
+    to the tracks containing it, so a search term of three or more letters only has to
+    check the tracks that contain its rarest trigram. Shorter terms are looked up in an
+    index of one- and two-letter word prefixes. Every term in a query has to match.
+
+    The index is built and kept up to date a playlist at a time: refresh() re-indexes the
+    playlists in which a directory or a track has changed since it last looked, or whose
+    tracks' metadata has been parsed since, and search() starts a refresh in the background
+    when the index is more than refresh_interval seconds old, so searches never wait for
+    the disk. Tags are only indexed for tracks whose metadata has already been cached (see
+    MetadataCache.warm()), and tracks that have been changed since are parsed again, to be
+    indexed with their new tags by the next refresh.
+
+    Usage:
+
+        >>> index = TrackIndex()
+        >>> index.refresh()
+        >>> index.search("goblin chase")
+        [Match(playlist='battle', track=PosixPath('.../goblin_chase.mp3'), title='Goblin Chase')]
+    """
+
+    def __init__(self, refresh_interval: float = 10.0):
+        self.refresh_interval = refresh_interval
+        self._matches = {}
+        self._text = {}
+        self._trigrams = defaultdict(set)
+        self._prefixes = defaultdict(set)
+        self._playlists = {}
+        self._next_id = 0
+
+        # the directories and tracks of each playlist when it was indexed, and the number of
+        # changes the metadata cache had made when the index last looked at it
+        self._sources = {}
+        self._cache_changes = 0
+        self._refreshed = None
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._matches)
+
+    def add(self, playlist: str, tracks: Iterable[Path], version=None, tags: dict = None):
+        """
+        Index the tracks as the contents of the named playlist, replacing whatever was indexed for it before.
+        Tags are looked up in the tags dict, if given, by the track's path or the path of the file it
+        links to, and then in the metadata cache. Tags for a file that has changed since they were
+        stored aren't used, and the file is parsed again in the background.
+        """
+        cache = metadata.cache()
+        tags = tags or {}
+        entries = []
+        files = set()
+        stale = []
+        trigram_ids = defaultdict(list)
+        prefix_ids = defaultdict(list)
+        for track in tracks:
+            physical = os.path.realpath(track)
+            files.add(physical)
+            meta = tags.get(str(track)) or tags.get(physical)
+            if meta and meta.mtime != _mtime(track, meta.mtime):
+                stale.append(track)
+                meta = None
+            meta = meta or cache.cached(track)
+            title = meta.display if meta else track.stem
+            text = [playlist, track.stem] + ([meta.title, meta.artist or "", meta.album or ""] if meta else [])
+            entries.append((Match(playlist=playlist, track=track, title=title), " ".join(words(" ".join(text)))))
+
+        # work out the postings before taking the lock, so that searches wait as little as possible
+        with self._lock:
+            first_id = self._next_id
+            self._next_id += len(entries)
+        for doc_id, (_, text) in enumerate(entries, start=first_id):
+            for word in set(text.split()):
+                for trigram in trigrams(word):
+                    trigram_ids[trigram].append(doc_id)
+                prefix_ids[word[:1]].append(doc_id)
+                if len(word) > 1:
+                    prefix_ids[word[:2]].append(doc_id)
+
+        with self._lock:
+            self._remove(playlist)
+            for doc_id, (match, text) in enumerate(entries, start=first_id):
+                self._matches[doc_id] = match
+                self._text[doc_id] = text
+            for trigram, ids in trigram_ids.items():
+                self._trigrams[trigram].update(ids)
+            for prefix, ids in prefix_ids.items():
+                self._prefixes[prefix].update(ids)
+            self._playlists[playlist] = (version, range(first_id, first_id + len(entries)), files)
+        logger.debug(f"Indexed {len(entries)} tracks in {playlist}")
+        if stale:
+            logger.debug(f"{len(stale)} tracks in {playlist} have changed; parsing them again.")
+            cache.warm(stale)
+
+    def remove(self, playlist: str):
+        with self._lock:
+            self._remove(playlist)
+
+    def _remove(self, playlist: str):
+        if playlist not in self._playlists:
+            return
+        _, ids, _ = self._playlists.pop(playlist)
+        for doc_id in ids:
+            del self._matches[doc_id]
+            for word in set(self._text.pop(doc_id).split()):
+                for key, postings in [(t, self._trigrams) for t in trigrams(word)] + [
+                    (p, self._prefixes) for p in {word[:1], word[:2]}
+                ]:
+                    postings[key].discard(doc_id)
+                    if not postings[key]:
+                        del postings[key]
+
+    def refresh(self):
+        """
+        Index every playlist that has been added or changed since the last refresh, and forget those that are gone.
+        """
+        root = croaker.path.playlist_root()
+        found = []
+        if root.exists():
+            found = [path.name for path in root.iterdir() if path.is_dir()]
+        for name in set(self._playlists) - set(found):
+            logger.debug(f"Playlist {name} is gone; removing it from the index.")
+            self.remove(name)
+            self._sources.pop(name, None)
+
+        cache = metadata.cache()
+        changes = cache.changes
+        parsed = cache.changed_since(self._cache_changes)
+        changed = [name for name in found if self._changed(name, parsed)]
+        tags = cache.stored() if changed else {}
+        for name in changed:
+            self._sources[name] = (_directories(root / name), list(Playlist(name=name).get_audio_files()))
+            self.add(name, self._sources[name][1], version=_version(*self._sources[name]), tags=tags)
+        self._cache_changes = changes
+        self._refreshed = monotonic()
+
+    def _changed(self, playlist: str, parsed: set):
+        """
+        Return True if the playlist hasn't been indexed, or any of its directories or tracks have changed
+        since, or any of its tracks have been parsed since.
+        """
+        if playlist not in self._playlists or playlist not in self._sources:
+            return True
+        version, _, files = self._playlists[playlist]
+        return version != _version(*self._sources[playlist]) or not files.isdisjoint(parsed)
+
+    def refresh_in_background(self):
+        """
+        Start a refresh, unless one is already running.
+        """
+        with self._lock:
+            if self._refresher and self._refresher.is_alive():
+                return self._refresher
+            self._refresher = threading.Thread(target=self._refresh_safely, name="TrackIndex", daemon=True)
+            self._refresher.start()
+            return self._refresher
+
+    def _refresh_safely(self):
+        try:
+            self.refresh()
+        except Exception as exc:  # pragma: no cover
+            logger.error("Could not refresh the track index.", exc_info=exc)
+
+    def search(self, query: str, limit: int = 20) -> List[Match]:
+        """
+        Return up to limit tracks matching every word of the query.
+        """
+        if self._refreshed is None or monotonic() - self._refreshed > self.refresh_interval:
+            self.refresh_in_background()
+
+        terms = words(query)
+        if not terms:
+            return []
+        with self._lock:
+            postings = []
+            for term in terms:
+                if len(term) < 3:
+                    postings.append(self._prefixes.get(term, set()))
+                else:
+                    # each candidate's text is checked for the whole term below, so the rarest trigram will do
+                    postings.append(min((self._trigrams.get(t, set()) for t in trigrams(term)), key=len))
+            smallest, *rest = sorted(postings, key=len)
+
+            # Filter the candidates lazily rather than intersecting the sets, so the search stops at the limit.
+            candidates = iter(smallest)
+            for ids in rest:
+                candidates = filter(ids.__contains__, candidates)
+            found = []
+            long_terms = [term for term in terms if len(term) >= 3]
+            for doc_id in candidates:
+                text = self._text[doc_id]
+                if all(term in text for term in long_terms):
+                    found.append(doc_id)
+                    if len(found) == limit:
+                        break
+            return [self._matches[doc_id] for doc_id in sorted(found)]
+
+
+def _mtime(track: Path, default: int):
+    try:
+        return track.stat().st_mtime_ns
+    except OSError:
+        return default
+
+
+def _directories(path: Path):
+    return [path] + sorted(p for p in path.rglob("*") if p.is_dir())
+
+
+def _version(directories: List[Path], tracks: List[Path]):
+    """
+    Return the modification times of the playlist's directories and tracks, which change when a track is
+    added to or removed from any of the directories, or a track's file is changed.
+    """
+    return tuple(_mtime(path, None) for path in directories + tracks)
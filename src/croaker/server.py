@@ -1,6 +1,7 @@
 import logging
+import multiprocessing
 import os
-import queue
+import select
 import socketserver
 import threading
 from pathlib import Path
@@ -9,9 +10,15 @@ from time import sleep
 import daemon
 
 from croaker import path
-from croaker.pidfile import pidfile
+from croaker.channel import Channel, configured_channels, mount_format
+from croaker.handoff import HandoffListener, request_handoff
+from croaker.mixer import Mixer, parse_gain
+from croaker.pidfile import pidfile, wait_for_exit
 from croaker.playlist import load_playlist
-from croaker.streamer import AudioStreamer
+from croaker.scheduler import parse_when
+from croaker.search import TrackIndex
+from croaker.transcoder import TranscoderPool
+from croaker.worker import TranscodeWorker
 
 logger = logging.getLogger("server")
 
@@ -25,17 +32,36 @@ class RequestHandler(socketserver.StreamRequestHandler):
 
     supported_commands = {
         # command              # help text
+        "CHAN": "[CHANNEL]   - Control the specified channel, or list channels.",
         "PLAY": "PLAYLIST    - Switch to the specified playlist.",
+        "QUEU": "[PL [WHEN]] - Switch to PL at WHEN (next, +SECS or HH:MM[:SS]), or list switches.",
+        "CNCL": "            - Cancel all scheduled switches.",
+        "LAYR": "[PL [GAIN]] - Fade in playlist PL as a looping ambience layer, or list layers.",
+        "FADE": "LAYER GAIN  - Fade LAYER (or music) to GAIN over the default fade time.",
+        "DROP": "LAYER       - Fade out and remove LAYER.",
         "LIST": "[PLAYLIST]  - List playlists or contents of the specified list.",
+        "FIND": "QUERY       - Search every playlist for tracks matching QUERY.",
+        "PICK": "N           - Play track N from the last FIND right away.",
         "FFWD": "            - Skip to the next track in the playlist.",
         "HELP": "            - Display command help.",
         "KTHX": "            - Close the current connection.",
         "STOP": "            - Stop the current track and stream silence.",
+        "SUBS": "            - Subscribe to now-playing events.",
+        "STAT": "            - Display stream statistics.",
         "STFU": "            - Terminate the Croaker server.",
     }
 
+    # commands that change what the current channel plays; each waits for the streamer to
+    # finish sending a chunk, so they tell its ChunkSizer to keep the next chunk short
+    playback_commands = {"PLAY", "QUEU", "CNCL", "LAYR", "FADE", "DROP", "PICK", "FFWD", "STOP"}
+
     should_listen = True
 
+    def setup(self):
+        super().setup()
+        self.channel = self.server.default_channel
+        self.found = []
+
     def handle(self):
         """
         Start a command and control session. Commands are read one line at a
@@ -48,7 +74,11 @@ class RequestHandler(socketserver.StreamRequestHandler):
         5+       Arguments
         """
         while True:
-            self.data = self.rfile.readline().strip().decode()
+            line = self.rfile.readline()
+            if not line:
+                logger.debug("Client disconnected.")
+                return
+            self.data = line.strip().decode()
             logger.debug(f"Received: {self.data}")
             try:
                 cmd = self.data[0:4].strip().upper()
@@ -71,6 +101,8 @@ class RequestHandler(socketserver.StreamRequestHandler):
             handler = getattr(self, f"handle_{cmd}", None)
             if not handler:
                 self.send(f"ERR No handler for {cmd}.")
+            if cmd in self.playback_commands:
+                self.channel.streamer.chunks.command()
             handler(args)
             if not self.should_listen:
                 break
@@ -78,52 +110,201 @@ class RequestHandler(socketserver.StreamRequestHandler):
     def send(self, msg):
         return self.wfile.write(msg.encode() + b"\n")
 
+    def handle_CHAN(self, args):
+        name = args.strip()
+        if not name:
+            return self.send("\n".join(str(c) for c in self.server.channels.values()))
+        if name not in self.server.channels:
+            return self.send(f"ERR No such channel: {name}")
+        self.channel = self.server.channels[name]
+        return self.send("OK")
+
     def handle_PLAY(self, args):
-        self.server.load(args)
+        try:
+            self.channel.load(args)
+        except ValueError as e:
+            return self.send(f"ERR {e}")
+        return self.send("OK")
+
+    def handle_QUEU(self, args):
+        if not args.strip():
+            return self.send("\n".join(str(t) for t in self.channel.scheduled()) or "Nothing scheduled.")
+        playlist_name, _, when = args.strip().partition(" ")
+        try:
+            transition = self.channel.schedule(playlist_name, parse_when(when))
+        except ValueError as e:
+            return self.send(f"ERR {e}")
+        return self.send(f"OK {transition}")
+
+    def handle_CNCL(self, args):
+        self.channel.cancel()
+        return self.send("OK")
+
+    def handle_LAYR(self, args):
+        try:
+            if not args.strip():
+                return self.send(self.channel.layers())
+            playlist_name, _, gain = args.strip().partition(" ")
+            self.channel.add_layer(playlist_name, parse_gain(gain or "1.0"))
+        except ValueError as e:
+            return self.send(f"ERR {e}")
+        return self.send("OK")
+
+    def handle_FADE(self, args):
+        try:
+            name, _, gain = args.strip().partition(" ")
+            self.channel.fade_layer(name, parse_gain(gain))
+        except ValueError as e:
+            return self.send(f"ERR {e}")
+        return self.send("OK")
+
+    def handle_DROP(self, args):
+        try:
+            self.channel.remove_layer(args.strip())
+        except ValueError as e:
+            return self.send(f"ERR {e}")
         return self.send("OK")
 
     def handle_FFWD(self, args):
-        self.server.ffwd()
+        self.channel.ffwd()
         return self.send("OK")
 
     def handle_LIST(self, args):
-        return self.send(self.server.list(args))
+        try:
+            return self.send(self.server.list(args))
+        except ValueError as e:
+            return self.send(f"ERR {e}")
+
+    def handle_FIND(self, args):
+        self.found = self.server.index.search(args)
+        if not self.found:
+            return self.send("No matches.")
+        return self.send("\n".join(f"{i}. {match}" for i, match in enumerate(self.found, start=1)))
+
+    def handle_PICK(self, args):
+        number = args.strip()
+        if not number.isdigit() or not 0 < int(number) <= len(self.found):
+            return self.send(f"ERR Expected the number of a track from the last FIND; got {number!r}")
+        match = self.found[int(number) - 1]
+        self.channel.cue(match.track)
+        return self.send(f"OK {match}")
+
+    def handle_STAT(self, args):
+        return self.send(f"{self.channel.streamer.stats}\n{self.channel.streamer.chunks}")
 
     def handle_HELP(self, args):
         return self.send("\n".join(f"{cmd} {txt}" for cmd, txt in self.supported_commands.items()))
 
     def handle_STOP(self, args):
-        return self.server.stop_event.set()
+        return self.channel.stop()
+
+    def handle_SUBS(self, args):
+        """
+        Stream events to the client, one JSON object per line, until it disconnects.
+        """
+        sub = self.channel.events.subscribe()
+        self.send("OK")
+        try:
+            # check for a hang-up between events, so an idle subscriber doesn't linger until the next one
+            while not self._hung_up():
+                event = sub.get(timeout=0.5)
+                if event:
+                    self.send(str(event))
+        except (BrokenPipeError, ConnectionError):
+            pass
+        finally:
+            logger.debug("Subscriber disconnected.")
+            self.channel.events.unsubscribe(sub)
+            self.should_listen = False
+
+    def _hung_up(self):
+        """
+        Return True if the client has closed its end of the connection. Anything it sends is discarded.
+        """
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.connection.recv(4096)
+        except OSError:
+            return True
 
     def handle_STFU(self, args):
         self.send("Shutting down.")
         self.server.stop()
 
 
-class CroakerServer(socketserver.TCPServer):
+class CroakerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """
-    A Daemonized TCP Server that also starts a Shoutcast source client.
+    A Daemonized TCP Server that also starts a Shoutcast source client for each channel.
     """
 
     allow_reuse_address = True
+    daemon_threads = True
 
     def __init__(self):
         self._context = daemon.DaemonContext()
-        self._queue = queue.Queue()
-        self.skip_event = threading.Event()
-        self.stop_event = threading.Event()
-        self.load_event = threading.Event()
-        self._streamer = None
-        self.playlist = None
+        self._channels = None
+        self._transcoder = None
+        self._transcode_slots = None
+        self._index = None
 
     def _pidfile(self):
         return pidfile(path.root() / "croaker.pid")
 
     @property
-    def streamer(self):
-        if not self._streamer:
-            self._streamer = AudioStreamer(self._queue, self.skip_event, self.stop_event, self.load_event)
-        return self._streamer
+    def transcoder(self):
+        if not self._transcoder:
+            self._transcoder = TranscoderPool(max_workers=self.max_transcoders, slots=self.transcode_slots)
+        return self._transcoder
+
+    @property
+    def max_transcoders(self):
+        return int(os.environ.get("TRANSCODERS", 2))
+
+    @property
+    def transcode_slots(self):
+        """
+        In process mode, a semaphore shared by the pool and every channel's worker process,
+        so that together they run no more than TRANSCODERS ffmpeg processes.
+        """
+        if self._transcode_slots is None and os.environ.get("TRANSCODE_MODE", "thread") == "process":
+            self._transcode_slots = multiprocessing.get_context("spawn").BoundedSemaphore(self.max_transcoders)
+        return self._transcode_slots
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = TrackIndex()
+        return self._index
+
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = {name: self._channel(name, mount) for name, mount in configured_channels().items()}
+        return self._channels
+
+    def _channel(self, name: str, mount: str):
+        process_mode = os.environ.get("TRANSCODE_MODE", "thread") == "process"
+        mixing = os.environ.get("MIXER", "0") == "1"
+
+        # In process mode, each channel gets a worker process of its own to do the transcoding,
+        # sharing the bound on ffmpeg processes with the pool.
+        # The worker process and the mixer only produce mp3; other formats use the transcoder pool.
+        if mount_format(mount) != "mp3":
+            if process_mode or mixing:
+                logger.warning(f"Channel {name} isn't mp3, so it won't use TRANSCODE_MODE=process or MIXER.")
+            return Channel(name, mount, transcoder=self.transcoder)
+        return Channel(
+            name,
+            mount,
+            transcoder=TranscodeWorker(slots=self.transcode_slots) if process_mode else self.transcoder,
+            mixer=Mixer() if mixing else None,
+        )
+
+    @property
+    def default_channel(self):
+        return next(iter(self.channels.values()))
 
     def bind_address(self):
         return (os.environ["HOST"], int(os.environ["PORT"]))
@@ -143,48 +324,97 @@ class CroakerServer(socketserver.TCPServer):
         self._context.files_preserve = [self.fileno()]
         self._context.open()
 
-    def start(self, daemonize: bool = True) -> None:
+    def handoff_path(self):
+        return path.root() / "croaker.sock"
+
+    def start(self, daemonize: bool = True, handoff: bool = True) -> None:
         """
-        Start the shoutcast controller background thread, then begin listening for connections.
+        Start a shoutcast controller background thread for each channel, then begin listening for connections.
+
+        If handoff is True and another daemon is running, take over its listening socket
+        and pick up every channel where it left off instead of starting from scratch.
         """
-        logger.info(f"Starting controller on {self.bind_address()}.")
-        super().__init__(self.bind_address(), RequestHandler)
+        state, listener = self.take_over() if handoff else (None, None)
+        if state:
+            logger.info(f"Taking over from PID {state['pid']} on {listener.getsockname()}.")
+            super().__init__(self.bind_address(), RequestHandler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listener
+
+            # the previous daemon has to let go of the icecast mounts and the pidfile before we can use them.
+            wait_for_exit(state["pid"])
+        else:
+            logger.info(f"Starting controller on {self.bind_address()}.")
+            super().__init__(self.bind_address(), RequestHandler)
         if daemonize:
             self._daemonize()
         try:
-            logger.debug("Starting AudioStreamer...")
-            self.streamer.start()
-            self.load("session_start")
+            HandoffListener(self.handoff_path(), self).start()
+            self.index.refresh_in_background()
+            for name, channel in self.channels.items():
+                if state and name in state["channels"]:
+                    logger.debug(f"Restoring {channel}...")
+                    channel.restore(state["channels"][name])
+                    channel.streamer.start()
+                    continue
+                logger.debug(f"Starting AudioStreamer for {channel}...")
+                channel.streamer.start()
+                channel.load("session_start")
             self.serve_forever()
+            self.server_close()
         except KeyboardInterrupt:
             logger.info("Shutting down.")
             self.stop()
 
-    def stop(self):
-        self._pidfile()
+    def take_over(self):
+        """
+        Ask the running daemon, if there is one, to hand over to this process.
+        """
+        try:
+            return request_handoff(self.handoff_path())
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Could not take over from the running daemon: {exc}")
+            return None, None
 
-    def ffwd(self):
-        logger.debug("Sending SKIP signal to streamer...")
-        self.skip_event.set()
+    def handoff(self, timeout: float = 5.0):
+        """
+        Pause every channel at the end of the chunk it's sending and return the state of
+        the server, for handing over to another daemon.
+        """
+        for channel in self.channels.values():
+            channel.streamer.handoff_requested.set()
+        for channel in self.channels.values():
+            if not channel.streamer.paused.wait(timeout=timeout):
+                self._resume()
+                raise TimeoutError(f"Channel {channel.name} didn't pause within {timeout}s.")
+        return {"pid": os.getpid(), "channels": {name: channel.state() for name, channel in self.channels.items()}}
+
+    def finish_handoff(self, state: dict, succeeded: bool):
+        """
+        Stop streaming and shut down once another daemon has taken over, or carry on where we paused if it didn't.
+        """
+        if succeeded:
+            for channel in self.channels.values():
+                channel.streamer.finish()
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return
+        self._resume()
+
+    def _resume(self):
+        for channel in self.channels.values():
+            channel.streamer.handoff_requested.clear()
+            channel.streamer.resume()
 
-    def clear_queue(self):
-        logger.debug("Requesting a reload...")
-        self.streamer.load_requested.set()
-        sleep(0.5)
+    def stop(self):
+        self._pidfile()
 
     def list(self, playlist_name: str = None):
         if playlist_name:
-            return str(load_playlist(playlist_name))
+            playlist = load_playlist(playlist_name)
+            if not playlist.path.exists():
+                raise ValueError(f"No such playlist: {playlist_name}")
+            return str(playlist)
         return "\n".join([str(p.name) for p in path.playlist_root().iterdir()])
 
-    def load(self, playlist_name: str):
-        logger.debug(f"Switching to {playlist_name = }")
-        if self.playlist:
-            self.clear_queue()
-        self.playlist = load_playlist(playlist_name)
-        logger.debug(f"Loaded new playlist {self.playlist = }")
-        for track in self.playlist.tracks:
-            self._queue.put(str(track).encode())
-
 
 server = CroakerServer()
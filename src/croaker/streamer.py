@@ -2,13 +2,19 @@ import logging
 import os
 import queue
 import threading
+from collections import deque
 from functools import cached_property
 from pathlib import Path
-from time import sleep
+from time import sleep, time
 
 import shout
 
-from croaker.transcoder import FrameAlignedStream
+from croaker import metadata
+from croaker.events import EventBus
+from croaker.pacing import ChunkSizer
+from croaker.reconnect import Backoff, ConnectionStats
+from croaker.scheduler import Scheduler
+from croaker.transcoder import FORMATS
 
 logger = logging.getLogger("streamer")
 
@@ -19,46 +25,205 @@ class AudioStreamer(threading.Thread):
     those files to the icecast server.
     """
 
-    def __init__(self, queue, skip_event, stop_event, load_event, chunk_size=4096):
+    def __init__(
+        self,
+        queue,
+        skip_event,
+        stop_event,
+        load_event,
+        chunk_size=4096,
+        events=None,
+        scheduler=None,
+        backoff=None,
+        buffer_size=16,
+        resend_window=None,
+        mount=None,
+        transcoder=None,
+        mixer=None,
+        format=None,
+        latency_target=None,
+    ):
         super().__init__()
         self.queue = queue
         self.skip_requested = skip_event
         self.stop_requested = stop_event
         self.load_requested = load_event
-        self.chunk_size = chunk_size
+        self.mount = mount
+        self.transcoder = transcoder
+        self.mixer = mixer
+        self.format = format or os.environ.get("ICECAST_FORMAT", "mp3")
+        if self.format not in FORMATS:
+            raise ValueError(f"Unsupported stream format {self.format!r}; expected one of {', '.join(FORMATS)}")
+        self.stream_class = FORMATS[self.format]
+
+        # Commands are checked between chunks, so with a latency target (in seconds) the
+        # chunk size adapts to keep them waiting no longer than that; see ChunkSizer.
+        if latency_target is None:
+            latency_target = float(os.environ.get("CHUNK_LATENCY", 0)) or None
+        self.chunks = ChunkSizer(
+            chunk_size=chunk_size,
+            target=latency_target,
+            bit_rate=self.stream_class.bit_rate,
+            sample_rate=self.stream_class.sample_rate,
+        )
+        self.events = events or EventBus()
+        self.scheduler = scheduler or Scheduler()
+        self.backoff = backoff or Backoff()
+        self.stats = ConnectionStats()
+        self._next_source = None
+        self._stream = None
+        self._title = None
+
+        # a track to play as soon as possible, ahead of the queue; see cue()
+        self._cued = None
+        self._cue_lock = threading.Lock()
+
+        # Set by the server to hand this stream over to another daemon; see pause_for_handoff().
+        self.handoff_requested = threading.Event()
+        self.paused = threading.Event()
+        self.handoff_state = None
+        self.finished = False
+        self._resume = threading.Event()
+
+        # A chunk whose send or sync fails is kept and sent again after reconnecting, and
+        # the source isn't read any further while we're disconnected, so playback resumes
+        # where it stopped instead of skipping ahead. Chunks that shout did confirm may still
+        # have been in flight when the connection dropped; with a resend window (in seconds)
+        # the ones sent within it are sent again too, at the cost of listeners hearing them
+        # twice if they did arrive.
+        if resend_window is None:
+            resend_window = float(os.environ.get("RESEND_WINDOW", 0))
+        self.resend_window = resend_window
+        self._sent = deque(maxlen=buffer_size)
+        self._pending = deque()
+
+    @property
+    def chunk_size(self):
+        return self.chunks.chunk_size
 
     @property
     def silence(self):
-        return FrameAlignedStream.from_source(Path(__file__).parent / "silence.mp3", chunk_size=self.chunk_size)
+        return self.open(Path(__file__).parent / "silence.mp3")
+
+    def open(self, track: Path, start: float = 0.0):
+        """
+        Return a stream of the transcoded track, mixed with the ambience layers if there is a
+        mixer, or using the shared transcoder pool if there is one. A stream that starts
+        partway through the track always gets an ffmpeg of its own.
+        """
+        if self.mixer:
+            return self.mixer.open(track, chunk_size=self.chunk_size, start=start)
+        if start:
+            return self.stream_class.from_source(track, chunk_size=self.chunk_size, start=start)
+        if self.transcoder:
+            return self.transcoder.open(track, chunk_size=self.chunk_size, stream_class=self.stream_class)
+        return self.stream_class.from_source(track, chunk_size=self.chunk_size)
 
     @cached_property
     def _shout(self):
         s = shout.Shout()
         s.name = "Croaker Radio"
         s.url = os.environ["ICECAST_URL"]
-        s.mount = os.environ["ICECAST_MOUNT"]
+        s.mount = self.mount or os.environ["ICECAST_MOUNT"]
         s.host = os.environ["ICECAST_HOST"]
         s.port = int(os.environ["ICECAST_PORT"])
         s.password = os.environ["ICECAST_PASSWORD"]
         s.protocol = os.environ.get("ICECAST_PROTOCOL", "http")
-        s.format = os.environ.get("ICECAST_FORMAT", "mp3")
+        s.format = self.format
         return s
 
     def run(self):  # pragma: no cover
+        self.connect()
+        while not self.finished:
+            try:
+                self.stream_queued_audio()
+            except Exception as exc:
+                logger.error("Caught exception.", exc_info=exc)
+        self._shout.close()
+
+    def connect(self):
+        """
+        Open a new connection to the icecast server, retrying with exponential backoff until it succeeds.
+        """
         while True:
             try:
                 logger.debug(f"Connecting to shoutcast server at {self._shout.host}:{self._shout.port}")
                 self._shout.open()
+                self.stats.up()
+                return
             except shout.ShoutException as e:
-                logger.error("Error connecting to shoutcast server. Will sleep and try again.", exc_info=e)
-                sleep(3)
-                continue
+                self.stats.down(e)
+                self._discard_connection()
+                delay = self.backoff.next()
+                logger.error(f"Error connecting to shoutcast server. Will try again in {delay:.1f}s.", exc_info=e)
+                sleep(delay)
 
+    def _discard_connection(self):
+        """
+        Close the current connection, if it got far enough to need closing, so that the next
+        one is opened on a fresh Shout object instead of one left half open by a failure.
+        """
+        try:
+            self._shout.close()
+        except shout.ShoutException:
+            pass
+        del self._shout
+
+    def reconnect(self, error: Exception):
+        """
+        Discard the current connection and open a new one. If nothing was sent successfully
+        since the last reconnect, wait a while first, so that a server that accepts and then
+        drops the connection is retried with the same backoff as one that refuses it.
+        """
+        logger.warning(f"Lost connection to shoutcast server: {error}")
+        self.stats.down(error)
+        cutoff = time() - self.resend_window
+        lost = [chunk for sent_at, chunk in self._sent if sent_at >= cutoff] if self.resend_window else []
+        retrying = self.backoff.attempts > 0
+        delay = self.backoff.next()
+        if retrying:
+            logger.debug(f"Will reconnect in {delay:.1f}s.")
+            sleep(delay)
+        self._discard_connection()
+        self.connect()
+        logger.debug(f"Resending {len(lost)} buffered chunks.")
+        self._pending.extendleft(reversed(lost))
+        self._sent.clear()
+
+        # a new connection is a new stream as far as icecast is concerned, and an Ogg stream
+        # can't be decoded from partway through without its header pages.
+        headers = self._stream.headers if self._stream else b""
+        if headers and not (self._pending and self._pending[0].startswith(headers)):
+            self._pending.appendleft(headers)
+        if self._title:
+            self.set_metadata(self._title)
+
+    def send(self, chunk: bytes):
+        """
+        Send a chunk of audio to the icecast server, reconnecting and resending if the connection drops.
+        """
+        self._pending.append(chunk)
+        while self._pending:
             try:
-                self.stream_queued_audio()
-            except Exception as exc:
-                logger.error("Caught exception.", exc_info=exc)
-        self._shout.close()
+                self._shout.send(self._pending[0])
+                self._shout.sync()
+            except shout.ShoutException as e:
+                self.reconnect(e)
+                continue
+            self._sent.append((time(), self._pending.popleft()))
+            self.backoff.reset()
+
+    def set_metadata(self, title: str):
+        self._title = title
+
+        # Ogg streams carry their titles in each track's OpusTags header, which ffmpeg fills in
+        # from the track's own tags; icecast takes them from there, and has no way to update them.
+        if self.format != "mp3":
+            return
+        try:
+            self._shout.set_metadata({"song": title})
+        except shout.ShoutException as e:
+            logger.warning(f"Could not update metadata: {e}")
 
     def clear_queue(self):
         logger.debug("Clearing queue...")
@@ -70,47 +235,218 @@ class AudioStreamer(threading.Thread):
         Return a filehandle to the next queued audio source, or silence if the queue is empty.
         """
         try:
-            track = Path(self.queue.get(block=False).decode())
-            logger.debug(f"Streaming {track.stem = }")
-            return FrameAlignedStream.from_source(track, chunk_size=self.chunk_size), track.stem
+            return self._source(Path(self.queue.get(block=False).decode()))
         except queue.Empty:
             logger.debug("Nothing queued; enqueing silence.")
         except Exception as exc:
             logger.error("Caught exception; falling back to silence.", exc_info=exc)
-        return self.silence, "[NOTHING PLAYING]"
+        return self.silence, "[NOTHING PLAYING]", None
+
+    def _source(self, track: Path):
+        logger.debug(f"Streaming {track.stem = }")
+        cache = metadata.cache()
+        meta = cache.lookup(track)
+        if not meta:
+            # never parse while switching tracks; the title is corrected once the tags are in. See _retitle().
+            cache.warm([track])
+        title = meta.display if meta else track.stem
+        return self.open(track), title, track
+
+    def _retitle(self, track: Path, title: str):
+        """
+        Return the title of the track, updating the stream's if the track started before its tags were parsed.
+        """
+        if not track or title != track.stem:
+            return title
+        meta = metadata.cache().cached(track)
+        if not meta or meta.display == title:
+            return title
+        logger.debug(f"Retitling {title} as {meta.display}")
+        self.set_metadata(meta.display)
+        self.events.publish("track_title", title=meta.display)
+        return meta.display
+
+    def cue(self, track: Path):
+        """
+        Interrupt the current source to play the specified track, then carry on with the queue.
+        """
+        with self._cue_lock:
+            self._cued = track
+            self.skip_requested.set()
+
+    def _cued_source(self):
+        with self._cue_lock:
+            track, self._cued = self._cued, None
+            if not track:
+                return None
+            # if we got here at the end of a track, the skip that came with the cue would skip the cued track
+            self.skip_requested.clear()
+        try:
+            return self._source(track)
+        except Exception as exc:
+            logger.error(f"Could not play {track}; carrying on with the queue.", exc_info=exc)
+            return None
+
+    def interrupted(self):
+        """
+        Check for control requests from the server, and return the name of the one that
+        should interrupt the current track, if any.
+        """
+        # play the next source immediately
+        if self.skip_requested.is_set():
+            logger.debug("Skip was requested.")
+            self.skip_requested.clear()
+            self._sent.clear()
+            self.events.publish("skip")
+            return "skip"
+
+        # clear the queue
+        if self.load_requested.is_set():
+            logger.debug("Load was requested.")
+            self.clear_queue()
+            self._drop_next_source()
+            self._sent.clear()
+            self.load_requested.clear()
+            return "load"
+
+        # Stop streaming and clear the queue
+        if self.stop_requested.is_set():
+            logger.debug("Stop was requested.")
+            self.clear_queue()
+            self._drop_next_source()
+            self._sent.clear()
+            self.stop_requested.clear()
+            self.events.publish("stop")
+            return "stop"
+
+        # pause so that another daemon can take over
+        if self.handoff_requested.is_set():
+            logger.debug("Handoff was requested.")
+            self.handoff_requested.clear()
+            self._resume.clear()
+            return "handoff"
+
+    def _drop_next_source(self):
+        if self._next_source:
+            self._next_source[0].close()
+        self._next_source = None
 
     def stream_queued_audio(self):
-        stream = None
-        title = None
-        next_stream = None
-        next_title = None
+        """
+        Stream the next queued audio source (or silence) until it ends or is interrupted.
+        """
+        source = self._cued_source()
+        if not source:
+            source, self._next_source = self._next_source or self.queued_audio_source(), None
+        stream, title, track = source
+        logging.debug(f"Starting stream of {title = }, {stream = }")
 
-        while True:
-            stream, title = (next_stream, next_title) if next_stream else self.queued_audio_source()
-            logging.debug(f"Starting stream of {title = }, {stream = }")
-            self._shout.set_metadata({"song": title})
-            next_stream, next_title = self.queued_audio_source()
+        # never resend the end of the previous track under this one's title
+        self._sent.clear()
+        self.set_metadata(title)
+        self.events.publish("track_start", title=title)
+        started = time()
+        if not self._next_source:
+            self._next_source = self.queued_audio_source()
 
-            for chunk in stream:
-                self._shout.send(chunk)
-                self._shout.sync()
+        # the stream position at which this source started
+        offset = self.scheduler.elapsed
+        stream.stop_at = self._stop_at(offset)
+        stream.chunk_size = self.chunks.next_chunk_size()
+        self.chunks.start()
 
-                # play the next source immediately
-                if self.skip_requested.is_set():
-                    logger.debug("Skip was requested.")
-                    self.skip_requested.clear()
-                    break
+        # how much of the stream has actually been sent
+        played = 0.0
 
-                # clear the queue
-                if self.load_requested.is_set():
-                    logger.debug("Load was requested.")
-                    self.clear_queue()
-                    self.load_requested.clear()
+        reason = None
+        self._stream = stream
+        try:
+            for chunk in stream:
+                reason = self.interrupted()
+                if reason == "handoff":
+                    self.pause_for_handoff(track, title, stream.start + played)
+                    reason = "handoff" if self.finished else None
+                    self.chunks.start()
+                if reason:
+                    # end an Ogg stream properly, so the next track can start a new one
+                    end = stream.end_of_stream() if reason != "handoff" else b""
+                    if end:
+                        self.send(end)
                     break
+                self.send(chunk)
+                self.chunks.sent()
+                title = self._retitle(track, title)
+                played = stream.position
+                self.scheduler.advance(offset + stream.position)
+                stream.stop_at = self._stop_at(offset)
+                # a command that arrived while this chunk was sent shortens the next one
+                stream.chunk_size = self.chunks.next_chunk_size()
+        finally:
+            # don't leave the transcoder's pipe and process behind if sending fails
+            self._stream = None
+            stream.close()
+        self.scheduler.advance(offset + stream.position)
 
-                # Stop streaming and clear the queue
-                if self.stop_requested.is_set():
-                    logger.debug("Stop was requested.")
-                    self.clear_queue()
-                    self.stop_requested.clear()
-                    break
+        if reason == "handoff":
+            self._drop_next_source()
+            self.events.publish("track_end", title=title, duration=round(time() - started, 3), reason=reason)
+            return
+
+        transition = None
+        if reason not in ("load", "stop"):
+            transition = self.scheduler.due(self.scheduler.elapsed, boundary=True)
+            if transition:
+                reason = "scheduled"
+        self.events.publish("track_end", title=title, duration=round(time() - started, 3), reason=reason or "eof")
+        if transition:
+            self.transition(transition)
+
+    def pause_for_handoff(self, track: Path, title: str, position: float):
+        """
+        Record where the current track was interrupted and wait for the server to either
+        finish() this streamer, because another daemon has taken over, or resume() it.
+        """
+        following = self._next_source[2] if self._next_source else None
+        self.handoff_state = {
+            "track": str(track) if track else None,
+            "title": title,
+            "position": position,
+            "next": str(following) if following else None,
+        }
+        logger.debug(f"Paused for handoff at {self.handoff_state}")
+        self.paused.set()
+        self._resume.wait()
+        self.paused.clear()
+
+    def resume_from(self, track: Path, title: str, position: float):
+        """
+        Make the specified track, starting position seconds in, the next thing to be streamed.
+        """
+        logger.debug(f"Resuming {track} at {position:.3f}s")
+        self._drop_next_source()
+        self._next_source = (self.open(track, start=position), title, track)
+
+    def resume(self):
+        self._resume.set()
+
+    def finish(self):
+        self.finished = True
+        self._resume.set()
+
+    def _stop_at(self, offset):
+        """
+        Return the position in the current source at which the next scheduled transition is due.
+        """
+        deadline = self.scheduler.deadline()
+        if deadline is None:
+            return None
+        return deadline - offset
+
+    def transition(self, transition):
+        """
+        Execute a scheduled transition by replacing whatever is queued.
+        """
+        logger.debug(f"Executing scheduled transition to {transition}")
+        self.clear_queue()
+        self._drop_next_source()
+        transition.action()
@@ -1,11 +1,17 @@
 import logging
+import struct
 import subprocess
-from dataclasses import dataclass
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from io import BufferedReader
 from pathlib import Path
+from typing import Optional
 
 import ffmpeg
 
+from croaker.registry import TrackFile, registry
+
 logger = logging.getLogger("transcoder")
 
 
@@ -30,6 +36,24 @@ class FrameAlignedStream:
     bit_rate: int = 192000
     sample_rate: int = 44100
 
+    # the offset, in seconds, into the source at which the stream begins
+    start: float = 0.0
+
+    # the ffmpeg process writing to source, if the stream started one, to be reaped on close()
+    process: Optional[subprocess.Popen] = field(default=None, repr=False)
+
+    # the number of audio samples yielded so far, and the position (in seconds) at
+    # which iteration should stop. Both are counted in whole frames.
+    samples: int = field(default=0, init=False)
+    stop_at: Optional[float] = field(default=None, init=False)
+
+    @property
+    def position(self):
+        """
+        The offset, in seconds, of the end of the audio yielded so far.
+        """
+        return self.samples / self.sample_rate
+
     @property
     def frames(self):
         while True:
@@ -60,13 +84,11 @@ class FrameAlignedStream:
         # Decode the mp3 header. We could derive the bit_rate and sample_rate
         # here if we had the lookup tables etc. from the MPEG spec, but since
         # we control the input, we can rely on them being predefined.
-        version_code = (header[1] & 0b00011000) >> 3
         padding_code = (header[2] & 0b00000010) >> 1
-        version = version_code & 1 if version_code >> 1 else 2
         is_padded = bool(padding_code)
 
         # calculate the size of the whole frame
-        frame_size = 1152 if version == 1 else 576
+        frame_size = self.samples_per_frame(header)
         frame_size = self.bit_rate // 8 * frame_size // self.sample_rate
         if is_padded:
             frame_size += 1
@@ -80,10 +102,22 @@ class FrameAlignedStream:
         # return the entire frame
         return header + frame_data
 
+    @staticmethod
+    def samples_per_frame(header: bytes):
+        """
+        Return the number of audio samples encoded by the frame with the given header.
+        """
+        version_code = (header[1] & 0b00011000) >> 3
+        version = version_code & 1 if version_code >> 1 else 2
+        return 1152 if version == 1 else 576
+
     def __iter__(self):
         """
         Generate approximately chunk_size segments of audio data by iterating over the
         frames, buffering them, and then yielding several as a single bytes object.
+
+        If stop_at is set, iteration ends at the first frame boundary at or after that
+        position, so the stream can be cut without splitting a frame.
         """
         buf = b""
         for frame in self.frames:
@@ -92,17 +126,44 @@ class FrameAlignedStream:
                 buf = b""
             if not frame:
                 break
+            if self.stop_at is not None and self.position >= self.stop_at:
+                logger.debug(f"Stopping stream at {self.position:.3f}s.")
+                buf += self.end_of_stream()
+                break
             buf += frame
+            self.samples += self._samples_in(frame)
         if buf:
             yield buf
 
+    def _samples_in(self, frame: bytes):
+        return self.samples_per_frame(frame)
+
+    @property
+    def headers(self):
+        """
+        The data a listener needs before any of the audio, to be sent again on a new connection; mp3 has none.
+        """
+        return b""
+
+    def end_of_stream(self):
+        """
+        Return the data that marks the end of a stream that is cut short; mp3 has none.
+        """
+        return b""
+
+    def close(self):
+        self.source.close()
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+
     @classmethod
-    def from_source(cls, infile: Path, **kwargs):
+    def ffmpeg_args(cls, infile: Path, **kwargs):
         """
-        Create a FrameAlignedStream instance by transcoding an audio source on disk.
+        Return the ffmpeg command line that will transcode the source to a suitable stream on stdout.
         """
-        ffmpeg_args = (
-            ffmpeg.input(str(infile))
+        return (
+            ffmpeg.input(str(infile), **cls._seek(kwargs.get("start")))
             .output(
                 "pipe:",
                 map="a",
@@ -120,10 +181,449 @@ class FrameAlignedStream:
             .compile()
         )
 
+    @staticmethod
+    def _seek(start: float):
+        return {"ss": start} if start else {}
+
+    @classmethod
+    def from_source(cls, infile: Path, **kwargs):
+        """
+        Create a FrameAlignedStream instance by transcoding an audio source on disk.
+        """
+        ffmpeg_args = cls.ffmpeg_args(infile, **kwargs)
+
         # Force close STDIN to prevent ffmpeg from trying to read from it. silly ffmpeg.
         proc = subprocess.Popen(
             ffmpeg_args, bufsize=kwargs.get("chunk_size", cls.chunk_size), stdout=subprocess.PIPE, stdin=subprocess.PIPE
         )
         proc.stdin.close()
         logger.debug(f"Spawned ffmpeg (PID {proc.pid}) with args {ffmpeg_args = }")
-        return cls(proc.stdout, **kwargs)
+        return cls(proc.stdout, process=proc, **kwargs)
+
+
+@dataclass
+class OggPageStream(FrameAlignedStream):
+    """
+    Use ffmpeg to transcode a source audio file to Ogg/Opus and iterate over the result
+    in page-aligned chunks, so that a stream can be cut without splitting a page.
+
+    Positions are taken from the granule position of each page, which for Opus counts
+    samples at 48kHz from the start of the stream, less the pre-skip declared in the
+    OpusHead packet.
+
+    A decoder can't start on an Ogg/Opus stream without its OpusHead and OpusTags header
+    pages, so they are kept to be sent again on a new connection. A stream that is cut
+    short is ended with an empty end-of-stream page, so the next track can begin a new one.
+
+    Usage:
+
+        >>> stream = OggPageStream.from_source(Path('test.flac'))
+        >>> for segment in stream:
+            ...
+    """
+
+    bit_rate: int = 64000
+    sample_rate: int = 48000
+
+    # the Ogg page header, up to and including the number of segments
+    header = struct.Struct("<4sBBqIIIB")
+
+    # the end-of-stream flag in a page header
+    EOS = 0x04
+
+    _pre_skip: int = field(default=0, init=False)
+    _granule: int = field(default=0, init=False)
+    _headers: list = field(default_factory=list, init=False, repr=False)
+
+    # the header of the last page yielded, from which an end-of-stream page follows on
+    _last: Optional[tuple] = field(default=None, init=False, repr=False)
+
+    def _read_one_frame(self):
+        """
+        Read the next full page from the input source and return it.
+        """
+        # step through the source a byte at a time and look for the capture pattern.
+        buffer = b""
+        while True:
+            buffer += self.source.read(self.header.size - len(buffer))
+            if len(buffer) != self.header.size:
+                logging.debug("Reached the end of the source stream without finding another page.")
+                return None
+            if buffer.startswith(b"OggS"):
+                break
+            logging.debug(f"Expected a page but got {buffer[:4]} instead; moving fwd 1 byte.")
+            buffer = buffer[1:]
+
+        segments = self.source.read(buffer[-1])
+        body = self.source.read(sum(segments))
+        if len(segments) != buffer[-1] or len(body) != sum(segments):
+            logging.debug("Reached the end of the source stream without finding a full page.")
+            return None
+
+        if body.startswith(b"OpusHead"):
+            self._pre_skip = int.from_bytes(body[10:12], "little")
+            self._headers = []
+        if body.startswith((b"OpusHead", b"OpusTags")):
+            self._headers.append(buffer + segments + body)
+        return buffer + segments + body
+
+    @property
+    def headers(self):
+        return b"".join(self._headers)
+
+    def end_of_stream(self):
+        if not self._last or self._last[2] & self.EOS:
+            return b""
+        _, version, _, granule, serial, sequence, _, _ = self._last
+        page = bytearray(self.header.pack(b"OggS", version, self.EOS, granule, serial, sequence + 1, 0, 0))
+        page[22:26] = ogg_crc(page).to_bytes(4, "little")
+        self._last = self.header.unpack_from(page)
+        return bytes(page)
+
+    def _samples_in(self, page: bytes):
+        self._last = self.header.unpack_from(page)
+
+        # a granule position of -1 means no packet ends on this page
+        granule = self._last[3]
+        if granule < 0:
+            return 0
+        end = max(self._granule, granule - self._pre_skip)
+        samples, self._granule = end - self._granule, end
+        return samples
+
+    @classmethod
+    def ffmpeg_args(cls, infile: Path, **kwargs):
+        """
+        Return the ffmpeg command line that will transcode the source to an Ogg/Opus stream on stdout.
+        """
+        return (
+            ffmpeg.input(str(infile), **cls._seek(kwargs.get("start")))
+            .output(
+                "pipe:",
+                map="a",
+                format="ogg",
+                acodec="libopus",
+                # pages of 100ms rather than the default 1s, so chunks stay small
+                page_duration=100000,
+                **{
+                    "b:a": kwargs.get("bit_rate", cls.bit_rate),
+                    "ar": kwargs.get("sample_rate", cls.sample_rate),
+                },
+            )
+            .global_args("-hide_banner", "-vn")
+            .compile()
+        )
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+OGG_CRC_TABLE = _crc_table()
+
+
+def ogg_crc(page: bytes):
+    """
+    Return the checksum of an Ogg page whose checksum field is zeroed.
+    """
+    crc = 0
+    for byte in page:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+# The stream class for each icecast format
+FORMATS = {"mp3": FrameAlignedStream, "ogg": OggPageStream}
+
+
+# Transcode priorities; lower numbers are started first.
+CURRENT = 0
+PREFETCH = 1
+
+
+class Transcode:
+    """
+    Run ffmpeg to completion, collecting its output in memory so that any number of
+    readers can consume it, each at their own pace, while it is still being produced.
+
+    A transcode that nobody has read from yet is a prefetch; the first read promotes it,
+    because a reader waiting for audio is by definition playing it now. A transcode is
+    cancelled when the last of its readers is closed before it has finished.
+    """
+
+    def __init__(self, args: list, read_size: int = 65536, pool: "TranscoderPool" = None):
+        self.args = args
+        self.read_size = read_size
+        self.pool = pool
+        self.priority = PREFETCH
+        self.data = bytearray()
+        self.started = False
+        self.done = False
+        self.cancelled = False
+        self.returncode = None
+        self.readers = 0
+        self._proc = None
+        self._cond = threading.Condition()
+
+    def run(self):
+        try:
+            with self._cond:
+                if self.cancelled:
+                    return
+                self.started = True
+                self._proc = subprocess.Popen(self.args, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+            logger.debug(f"Spawned ffmpeg (PID {self._proc.pid}) with args {self.args = }")
+            with self._proc as proc:
+                while True:
+                    data = proc.stdout.read1(self.read_size)
+                    if not data:
+                        break
+                    with self._cond:
+                        self.data.extend(data)
+                        self._cond.notify_all()
+            self.returncode = proc.wait()
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    @property
+    def failed(self):
+        return self.cancelled or (self.done and self.returncode != 0)
+
+    def promote(self):
+        if self.priority != CURRENT:
+            self.priority = CURRENT
+            if self.pool:
+                self.pool.promoted(self)
+
+    def cancel(self):
+        with self._cond:
+            if self.done:
+                return
+            logger.debug(f"Cancelling transcode with args {self.args = }")
+            self.cancelled = True
+            if self._proc:
+                self._proc.kill()
+            else:
+                self.done = True
+            self._cond.notify_all()
+
+    def reader(self):
+        with self._cond:
+            self.readers += 1
+        return TranscodeReader(self)
+
+    def release(self):
+        with self._cond:
+            self.readers -= 1
+            abandoned = self.readers <= 0 and not self.done
+        if abandoned:
+            self.cancel()
+
+
+class TranscodeReader:
+    """
+    A file-like view of a Transcode's output, which blocks until the requested bytes
+    have been produced or the transcode has finished.
+    """
+
+    def __init__(self, transcode: Transcode):
+        self.transcode = transcode
+        self.pos = 0
+        self.closed = False
+
+    def read(self, size: int = -1):
+        t = self.transcode
+        t.promote()
+        with t._cond:
+            if size < 0:
+                t._cond.wait_for(lambda: t.done)
+            else:
+                t._cond.wait_for(lambda: t.done or len(t.data) >= self.pos + size)
+            end = len(t.data) if size < 0 else self.pos + size
+            data = bytes(t.data[self.pos : end])
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transcode.release()
+
+
+class TranscoderPool:
+    """
+    Transcode audio sources with a bounded number of ffmpeg processes, shared by every
+    channel in the server. Only the number of processes is bounded: every distinct track
+    that is playing still has to be transcoded, so CPU use grows with the number of
+    channels playing different tracks. Transcoded audio is kept in an LRU cache of at most
+    cache_size bytes, so a track that is playing on several channels at once (or silence,
+    which every idle channel plays) is only transcoded once. Sources are cached by the
+    physical file they lead to and its size and mtime (see TrackRegistry), so the same goes
+    for a track linked into several playlists. A copy of a track shares its transcode too,
+    once hashing both files whole has confirmed that they match.
+
+    Tracks that are being played are started before tracks that are only being
+    prefetched, and prefetches never occupy the last free worker, so that a channel
+    that skips or switches playlists doesn't wait behind other channels' prefetches.
+
+    Pools in different processes can share one bound by passing the same semaphore as
+    slots; each ffmpeg process then holds a slot while it runs.
+
+    Usage:
+
+        >>> pool = TranscoderPool(max_workers=2)
+        >>> for segment in pool.open(Path("test.flac")):
+            ...
+    """
+
+    def __init__(
+        self, max_workers: int = 2, cache_size: int = 256 * 1024 * 1024, stream_class=FrameAlignedStream, slots=None
+    ):
+        self.max_workers = max_workers
+        self.slots = slots
+        self.cache_size = cache_size
+        self.stream_class = stream_class
+        self.spawned = 0
+        self.hits = 0
+        self._cache = OrderedDict()
+        # the TrackFile each cached transcode was made from, by key
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._pending = []
+        self._prefetching = 0
+        self._workers = []
+        self._shutdown = False
+
+    def _copy_of(self, source: TrackFile, options: tuple):
+        """
+        Return the key of a cached transcode of another file with the same contents as the
+        source, or None. Candidates are found by their sampled digest, and hashed whole to
+        confirm the match outside the lock, since that reads both files.
+        """
+        with self._lock:
+            candidates = [
+                (key, other)
+                for key, other in self._sources.items()
+                if key[1] == options and other.digest == source.digest and not self._cache[key].failed
+            ]
+        for key, other in candidates:
+            if registry().same_contents(source, other):
+                return key
+        return None
+
+    def transcode(self, infile: Path, stream_class=None, **kwargs):
+        """
+        Return the Transcode of the specified source, starting one if it isn't already cached.
+        """
+        stream_class = stream_class or self.stream_class
+        encoding = {k: v for k, v in kwargs.items() if k in ("bit_rate", "sample_rate")}
+        source = registry().get(infile)
+        options = tuple(sorted(dict(format=stream_class.__name__, **encoding).items()))
+        key = (source.version, options)
+        with self._lock:
+            cached = key in self._cache and not self._cache[key].failed
+        copy = None if cached else self._copy_of(source, options)
+        with self._lock:
+            for candidate in (key, copy):
+                if candidate in self._cache and not self._cache[candidate].failed:
+                    self.hits += 1
+                    self._cache.move_to_end(candidate)
+                    return self._cache[candidate]
+            job = Transcode(stream_class.ffmpeg_args(infile, **encoding), pool=self)
+            self._cache[key] = job
+            self._sources[key] = source
+            self.spawned += 1
+            self._evict()
+            self._pending.append(job)
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._run, name=f"transcoder_{len(self._workers)}", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._work.notify()
+        return job
+
+    def _next_job(self):
+        """
+        Return the next pending job that may be started now, or None. Must be called with the lock held.
+        """
+        self._pending = [job for job in self._pending if not job.cancelled]
+        if not self._pending:
+            return None
+        job = min(self._pending, key=lambda job: job.priority)
+        if job.priority == PREFETCH and self._prefetching >= max(1, self.max_workers - 1):
+            return None
+        self._pending.remove(job)
+        return job
+
+    def _run(self):
+        while True:
+            with self._work:
+                job = self._next_job()
+                while not job:
+                    if self._shutdown:
+                        return
+                    self._work.wait()
+                    job = self._next_job()
+                prefetch = job.priority == PREFETCH
+                self._prefetching += prefetch
+            if self.slots:
+                self.slots.acquire()
+            try:
+                job.run()
+            except Exception as exc:
+                logger.error(f"Transcode failed: {job.args}", exc_info=exc)
+            finally:
+                if self.slots:
+                    self.slots.release()
+            with self._work:
+                self._prefetching -= prefetch
+                self._evict()
+                self._work.notify_all()
+
+    def promoted(self, job: Transcode):
+        with self._work:
+            self._work.notify_all()
+
+    @property
+    def cached_bytes(self):
+        return sum(len(job.data) for job in self._cache.values())
+
+    def _evict(self):
+        """
+        Drop the least recently used finished transcodes until the cache fits in cache_size
+        bytes. Transcodes still running can't be dropped, so this is also done whenever one
+        finishes. Must be called with the lock held.
+        """
+        size = self.cached_bytes
+        for key in list(self._cache):
+            if size <= self.cache_size:
+                return
+            job = self._cache[key]
+            if job.done:
+                size -= len(job.data)
+                del self._cache[key]
+                del self._sources[key]
+
+    def open(self, infile: Path, stream_class=None, **kwargs):
+        """
+        Return a stream of the transcoded source, in the pool's format unless another stream class is given.
+        """
+        stream_class = stream_class or self.stream_class
+        return stream_class(self.transcode(infile, stream_class=stream_class, **kwargs).reader(), **kwargs)
+
+    def shutdown(self):
+        with self._work:
+            self._shutdown = True
+            pending, self._pending = self._pending, []
+            self._work.notify_all()
+        for job in pending:
+            job.cancel()
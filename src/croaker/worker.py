@@ -0,0 +1,238 @@
+import io
+import logging
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from croaker.ring import END, FRAME, FrameRing
+from croaker.transcoder import FrameAlignedStream, TranscoderPool
+
+logger = logging.getLogger("worker")
+
+
+def work(conn, ring_name: str, ring_size: int, ready, slots=None):  # pragma: no cover
+    """
+    The worker process's main loop. Transcode sources in the order they were opened,
+    parse them into chunks of whole frames and write the chunks to the ring, tagged with
+    the generation of the source they came from, setting the ready event after each one
+    so the reader never has to poll.
+
+    ffmpeg is run by a TranscoderPool of the worker's own, holding one of the slots shared
+    with every other pool in the server while it runs, so that worker processes count
+    against the same bound on ffmpeg processes as the server's pool. Commands arrive over
+    the pipe:
+
+        ("open", generation, path, kwargs)  - transcode the source after the ones already queued
+        ("cancel", generation)              - stop transcoding the source, or drop it from the queue
+        ("quit",)                           - exit
+    """
+    ring = FrameRing(size=ring_size, name=ring_name)
+    pool = TranscoderPool(max_workers=1, cache_size=0, slots=slots)
+    queued = deque()
+    current = None
+    stream = None
+    record = None
+
+    def close_current():
+        nonlocal current, stream, record
+        if stream:
+            stream.close()
+        current = stream = record = None
+
+    try:
+        while True:
+            # block waiting for commands if there's nothing to do; otherwise just check for them.
+            timeout = None if not (current or queued) else 0
+            if record:
+                timeout = 0.002
+            while conn.poll(timeout):
+                cmd, *args = conn.recv()
+                if cmd == "quit":
+                    return
+                elif cmd == "open":
+                    queued.append(args)
+                elif cmd == "cancel":
+                    queued = deque(q for q in queued if q[0] != args[0])
+                    if current == args[0]:
+                        close_current()
+                timeout = 0
+
+            if not current:
+                if not queued:
+                    continue
+                current, path, kwargs = queued.popleft()
+                try:
+                    stream = pool.open(Path(path), **kwargs)
+                except Exception as exc:
+                    logger.error(f"Could not transcode {path}", exc_info=exc)
+                    record = (END, current, b"", 0)
+
+            if not record:
+                record = read_chunk(stream, current)
+
+            # if the ring is full, go back to waiting for commands; we'll try again shortly.
+            if not ring.write(*record):
+                continue
+            ready.set()
+            if record[0] == END:
+                close_current()
+            record = None
+    finally:
+        close_current()
+        pool.shutdown()
+        ring.close()
+
+
+def read_chunk(stream: FrameAlignedStream, generation: int):
+    """
+    Read approximately chunk_size bytes of whole frames from the stream and return them as a ring record.
+    """
+    chunk = b""
+    samples = 0
+    while len(chunk) < stream.chunk_size:
+        frame = stream._read_one_frame()
+        if not frame:
+            break
+        chunk += frame
+        samples += stream.samples_per_frame(frame)
+    if not chunk:
+        return (END, generation, b"", 0)
+    return (FRAME, generation, chunk, samples)
+
+
+@dataclass
+class RemoteStream(FrameAlignedStream):
+    """
+    A FrameAlignedStream whose audio is transcoded and parsed into chunks by a
+    TranscodeWorker in another process, and read from shared memory.
+    """
+
+    generation: int = 0
+
+    def _chunks(self):
+        worker = self.source
+        while True:
+            # clear the event before looking, so a record written after we look still wakes us up
+            worker.ready.clear()
+            record, worker._held = worker._held or worker.ring.read(), None
+            if record is None:
+                if not worker.is_alive():
+                    return
+                worker.ready.wait(timeout=0.1)
+                continue
+            kind, generation, chunk, samples = record
+
+            # discard anything left over from sources that were skipped or cancelled
+            if generation < self.generation:
+                continue
+
+            # Sources are transcoded in order, so audio from a later one before the end of this
+            # one means the worker and the streamer have lost track of each other. Keep the
+            # record for the stream it belongs to, and end this one.
+            if generation > self.generation:
+                logger.error(f"Transcode worker skipped from source {self.generation} to {generation}.")
+                worker._held = record
+                return
+            if kind == END:
+                return
+            yield chunk, samples
+
+    def __iter__(self):
+        """
+        Yield the chunks as the worker produced them. If stop_at falls within a chunk,
+        split it at the first frame boundary at or after that position and stop.
+        """
+        for chunk, samples in self._chunks():
+            if self.stop_at is not None and (self.samples + samples) / self.sample_rate > self.stop_at:
+                cut = FrameAlignedStream(
+                    io.BytesIO(chunk), chunk_size=len(chunk) + 1, bit_rate=self.bit_rate, sample_rate=self.sample_rate
+                )
+                cut.samples = self.samples
+                cut.stop_at = self.stop_at
+                chunk = b"".join(cut)
+                self.samples = cut.samples
+                if chunk:
+                    yield chunk
+                return
+            self.samples += samples
+            yield chunk
+
+    def close(self):
+        self.source.cancel(self.generation)
+
+
+class TranscodeWorker:
+    """
+    Transcode and parse audio in a separate process, so that the streamer thread only
+    has to copy frames out of shared memory and send them. This keeps the work of
+    transcoding and frame parsing from competing for the GIL with the control server.
+    Given slots, a multiprocessing semaphore, its ffmpeg processes count against the same
+    bound as every other transcoder holding them.
+
+    Usage:
+
+        >>> worker = TranscodeWorker()
+        >>> for segment in worker.open(Path("test.flac")):
+            ...
+        >>> worker.shutdown()
+    """
+
+    def __init__(self, ring_size: int = 1024 * 1024, slots=None):
+        self.ring_size = ring_size
+        self.slots = slots
+        self.ring = None
+        self.process = None
+        self.ready = None
+        self._conn = None
+        self._generation = 0
+
+        # a record read by a stream that it didn't belong to; see RemoteStream._chunks()
+        self._held = None
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.ring = FrameRing(size=self.ring_size)
+        self.ready = ctx.Event()
+        self._conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=work,
+            args=(child, self.ring.name, self.ring_size, self.ready, self.slots),
+            name="TranscodeWorker",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        logger.debug(f"Started transcode worker (PID {self.process.pid})")
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def open(self, infile: Path, stream_class=FrameAlignedStream, **kwargs):
+        """
+        Queue the source for transcoding and return a stream of its frames. Only mp3 is supported.
+        """
+        if stream_class is not FrameAlignedStream:
+            raise ValueError(f"The transcode worker can't produce {stream_class.__name__}.")
+        if not self.process:
+            self.start()
+        self._generation += 1
+        self._conn.send(("open", self._generation, str(infile), kwargs))
+        return RemoteStream(self, generation=self._generation, **kwargs)
+
+    def cancel(self, generation: int):
+        if self.is_alive():
+            self._conn.send(("cancel", generation))
+
+    def shutdown(self):
+        if not self.process:
+            return
+        if self.is_alive():
+            self._conn.send(("quit",))
+        self.process.join(timeout=5)
+        if self.process.is_alive():  # pragma: no cover
+            self.process.kill()
+            self.process.join()
+        self._conn.close()
+        self.ring.close()
+        self.process = None
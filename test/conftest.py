@@ -4,9 +4,10 @@ import pytest
 
 
 @pytest.fixture(autouse=True)
-def mock_env(monkeypatch):
+def mock_env(monkeypatch, tmp_path):
     fixtures = Path(__file__).parent / "fixtures"
     monkeypatch.setenv("CROAKER_ROOT", str(fixtures))
+    monkeypatch.setenv("METADATA_CACHE", str(tmp_path / "metadata.db"))
     monkeypatch.setenv("MEDIA_GLOB", "*.mp3,*.foo,*.bar")
     monkeypatch.setenv("ICECAST_URL", "http://127.0.0.1")
     monkeypatch.setenv("ICECAST_HOST", "localhost")
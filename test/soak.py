@@ -0,0 +1,349 @@
+"""
+Drive a CroakerServer through a long scripted session of PLAY, FFWD, STOP, QUEU, STAT,
+LIST, FIND and PICK commands, and fail if memory, open file descriptors or child
+processes grow over the course of it.
+
+Nothing waits for the wall clock. Time is simulated: the fake shout sink advances a
+fake clock by the duration of every chunk of audio sent, and the session only lets the
+streamer send as much audio as the script says should pass between commands, so the
+same seed always produces the same session. Tracks are "transcoded" by cat, so every
+track still runs a child process through FrameAlignedStream.from_source, but ffmpeg
+isn't needed.
+
+Usage:
+
+    % python test/soak.py [HOURS] [COMMANDS_PER_HOUR] [SEED]
+"""
+import functools
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+from unittest.mock import patch
+
+import shout
+
+from croaker import channel, events, playlist, scheduler, server, streamer, transcoder
+
+# how far each measure may grow between the end of the warm-up and the end of the session
+THRESHOLDS = {"rss_mb": 20.0, "traced_mb": 5.0, "fds": 4, "children": 2}
+
+
+class CatStream(transcoder.FrameAlignedStream):
+    @classmethod
+    def ffmpeg_args(cls, infile: Path, **kwargs):
+        return ["cat", str(infile)]
+
+
+class FakeTranscoder:
+    """
+    Stands in for the TranscoderPool, starting a cat process for every track.
+    """
+
+    def open(self, infile: Path, stream_class=None, **kwargs):
+        return CatStream.from_source(infile, **kwargs)
+
+
+class Session:
+    """
+    The simulated clock, shared by the fake shout sink (on the streamer's thread) and
+    the scripted commands (on the session's thread). The streamer may only send audio
+    while the session is sleeping, and the session sleeps until the streamer has sent
+    as much audio as it asked for.
+    """
+
+    def __init__(self, seconds_per_byte: float, start: float = 1_700_000_000.0):
+        self.seconds_per_byte = seconds_per_byte
+        self.now = start
+        self.finished = False
+        self._budget = 0.0
+        self._waiting = False
+        self._cond = threading.Condition()
+
+    def clock(self):
+        return self.now
+
+    def send(self, data: bytes):
+        with self._cond:
+            if self._budget <= 0:
+                self._waiting = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._budget > 0 or self.finished)
+                self._waiting = False
+            elapsed = len(data) * self.seconds_per_byte
+            self.now += elapsed
+            self._budget -= elapsed
+
+    def sleep(self, seconds: float):
+        with self._cond:
+            self._budget += seconds
+            self._cond.notify_all()
+            # wait until the streamer is blocked sending its next chunk, so that it never runs alongside a command
+            self._cond.wait_for(lambda: (self._budget <= 0 and self._waiting) or self.finished)
+
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+
+class FakeShout:
+    """
+    An icecast connection that drops, at random, drop_rate of the times audio is sent.
+    """
+
+    def __init__(self, session: Session, drop_rate: float = 0.0, rng: random.Random = None):
+        self.session = session
+        self.drop_rate = drop_rate
+        self.rng = rng or random.Random()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, data: bytes):
+        if self.rng.random() < self.drop_rate:
+            raise shout.ShoutException("Connection dropped")
+        self.session.send(data)
+
+    def sync(self):
+        pass
+
+    def set_metadata(self, metadata: dict):
+        pass
+
+
+@dataclass
+class Sample:
+    minutes: float
+    rss_mb: float
+    traced_mb: float
+    fds: int
+    children: int
+
+    def __str__(self):
+        return f"{self.minutes:>8.0f} {self.rss_mb:>8.1f} {self.traced_mb:>10.2f} {self.fds:>5} {self.children:>9}"
+
+
+@dataclass
+class Report:
+    samples: List[Sample] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    growth: dict = field(default_factory=dict)
+    failures: List[str] = field(default_factory=list)
+    top: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        lines = [f"{'minutes':>8} {'rss MB':>8} {'traced MB':>10} {'fds':>5} {'children':>9}"]
+        lines += [str(sample) for sample in self.samples]
+        lines += ["", f"{len(self.errors)} commands failed"] + [f"  {error}" for error in self.errors[:5]]
+        lines += ["", "Largest allocation growth after warm-up:"] + self.top
+        lines += [""] + ([f"FAIL {failure}" for failure in self.failures] or ["OK"])
+        return "\n".join(lines)
+
+
+def measure(minutes: float):
+    """
+    Record this process's resident memory, traced Python allocations, open file descriptors and child processes.
+    """
+    with open("/proc/self/statm") as statm:
+        rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    children = 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                # the parent PID is the second field after the parenthesized command name
+                ppid = int(stat.read().rpartition(")")[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children += ppid == os.getpid()
+    return Sample(
+        minutes=minutes,
+        rss_mb=rss / 1024**2,
+        traced_mb=tracemalloc.get_traced_memory()[0] / 1024**2,
+        fds=len(os.listdir("/proc/self/fd")),
+        children=children,
+    )
+
+
+def make_track(path: Path, seconds: float):
+    """
+    Write seconds of silent 192kbps, 44.1kHz mp3 frames to path.
+    """
+    header = bytes([0xFF, 0xFB, 0xB0, 0x00])
+    frame = header + bytes(192000 // 8 * 1152 // 44100 - len(header))
+    path.write_bytes(frame * int(seconds * 44100 / 1152))
+
+
+def make_library(root: Path, playlists: int = 8, tracks: int = 12):
+    """
+    Create playlists under root of symlinks to silent tracks between 20 seconds and 4 minutes long.
+    """
+    sources = root / "sources"
+    sources.mkdir()
+    lengths = [20, 45, 90, 150, 240]
+    for seconds in lengths:
+        make_track(sources / f"{seconds}s.mp3", seconds)
+    names = ["session_start"] + [f"playlist{i}" for i in range(1, playlists)]
+    for name in names:
+        path = root / "playlists" / name
+        path.mkdir(parents=True)
+        for i in range(tracks):
+            (path / f"track{i}.mp3").symlink_to(sources / f"{lengths[i % len(lengths)]}s.mp3")
+    return names
+
+
+def script(names: List[str], hours: float, commands_per_hour: int, seed: int):
+    """
+    Return a list of (seconds, command) pairs, sorted by the simulated time at which each is sent.
+    """
+    rng = random.Random(seed)
+    commands = []
+    for _ in range(int(hours * commands_per_hour)):
+        at = rng.uniform(0, hours * 3600)
+        kinds = ["PLAY", "FFWD", "STOP", "QUEU", "STAT", "LIST", "FIND", "PICK"]
+        kind = rng.choices(kinds, [8, 6, 2, 2, 1, 1, 2, 1])[0]
+        # one in ten playlist names is mistyped, as a fresh typo every time
+        name = rng.choice(names) if rng.random() > 0.1 else f"{rng.choice(names)}{rng.randint(0, 10**6)}"
+        if kind == "PLAY":
+            command = f"PLAY {name}"
+        elif kind == "QUEU":
+            command = f"QUEU {name} {rng.choice(['next', f'+{rng.randint(1, 600)}'])}"
+        elif kind == "LIST":
+            command = f"LIST {rng.choice([name, ''])}"
+        elif kind == "FIND":
+            command = f"FIND {rng.choice(['track', name[:2], f'{name} 1'])}"
+        elif kind == "PICK":
+            command = f"PICK {rng.randint(1, 5)}"
+        else:
+            command = kind
+        commands.append((at, command))
+    return sorted(commands)
+
+
+def handler(croaker: server.CroakerServer):
+    """
+    Return a function that sends one command through a RequestHandler and returns its response.
+    """
+    handler = server.RequestHandler.__new__(server.RequestHandler)
+    handler.server = croaker
+    handler.channel = croaker.default_channel
+    handler.found = []
+
+    def send(command: str):
+        handler.rfile = io.BytesIO(command.encode() + b"\n")
+        handler.wfile = io.BytesIO()
+        handler.should_listen = True
+        handler.handle()
+        return handler.wfile.getvalue().decode()
+
+    return send
+
+
+def soak(
+    hours: float = 6.0,
+    commands_per_hour: int = 100,
+    seed: int = 0,
+    sample_minutes: float = 15.0,
+    warmup_minutes: float = 30.0,
+    drop_rate: float = 0.001,
+    thresholds: dict = THRESHOLDS,
+):
+    """
+    Run a simulated session with its own croaker root and return a Report.
+    """
+    with ExitStack() as stack:
+        root = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        names = make_library(root)
+
+        session = Session(seconds_per_byte=8 / 192000)
+
+        stack.enter_context(
+            patch.dict(
+                os.environ,
+                {"CROAKER_ROOT": str(root), "METADATA_CACHE": str(root / "metadata.db"), "MEDIA_GLOB": "*.mp3"},
+            )
+        )
+        stack.enter_context(patch.dict(os.environ, {"CHANNELS": "", "ICECAST_MOUNT": "soak"}))
+        for var in ("ICECAST_URL", "ICECAST_HOST", "ICECAST_PASSWORD"):
+            stack.enter_context(patch.dict(os.environ, {var: os.environ.get(var, "soak")}))
+        stack.enter_context(patch.dict(os.environ, {"ICECAST_PORT": os.environ.get("ICECAST_PORT", "8000")}))
+        stack.enter_context(patch("shout.Shout", functools.partial(FakeShout, session, drop_rate, random.Random(seed))))
+        stack.enter_context(patch.object(streamer, "sleep", lambda seconds: None))
+        stack.enter_context(patch.object(channel, "sleep", session.sleep))
+        stack.enter_context(patch.object(streamer, "time", session.clock))
+        stack.enter_context(patch.object(events, "time", session.clock))
+        stack.enter_context(
+            patch.object(server, "parse_when", functools.partial(scheduler.parse_when, clock=session.clock))
+        )
+        stack.enter_context(patch.dict(playlist.playlists, clear=True))
+
+        croaker = server.CroakerServer()
+        croaker._transcoder = FakeTranscoder()
+        send = handler(croaker)
+        audio = croaker.default_channel.streamer
+        audio.scheduler.clock = session.clock
+        croaker.index.refresh()
+        croaker.default_channel.load("session_start")
+        audio.start()
+
+        tracemalloc.start()
+        report = Report()
+        baseline = None
+        started = session.now
+        next_sample = 0.0
+        try:
+            for at, command in script(names, hours, commands_per_hour, seed) + [(hours * 3600, None)]:
+                while next_sample <= at:
+                    session.sleep(started + next_sample - session.now)
+                    report.samples.append(measure(next_sample / 60))
+                    if baseline is None and next_sample >= warmup_minutes * 60:
+                        baseline = (report.samples[-1], tracemalloc.take_snapshot())
+                    next_sample += sample_minutes * 60
+                session.sleep(started + at - session.now)
+                if not command:
+                    continue
+                # a command that raises would have killed its client's connection
+                try:
+                    response = send(command)
+                except Exception as exc:
+                    response = f"ERR {command}: {exc!r}"
+                if response.startswith("ERR"):
+                    report.errors.append(response.strip())
+            final = measure((session.now - started) / 60)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            audio.finish()
+            audio.stop_requested.set()
+            session.finish()
+            audio.join(timeout=10)
+            tracemalloc.stop()
+
+    first, first_snapshot = baseline or (report.samples[0], snapshot)
+    for name, limit in thresholds.items():
+        growth = getattr(final, name) - getattr(first, name)
+        report.growth[name] = growth
+        if growth > limit:
+            report.failures.append(f"{name} grew by {growth:.2f} after warm-up (limit {limit})")
+    report.top = [f"  {stat}" for stat in snapshot.compare_to(first_snapshot, "lineno")[:10]]
+    return report
+
+
+def main(hours: float = 6.0, commands_per_hour: int = 100, seed: int = 0):
+    report = soak(hours, commands_per_hour, seed)
+    print(report)
+    return 1 if report.failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(main(*[float(args[0])] + [int(arg) for arg in args[1:]] if args else []))
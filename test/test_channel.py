@@ -0,0 +1,129 @@
+import json
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+from croaker import channel, metadata
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        ("", {"default": "mount"}),
+        ("main=stream", {"main": "stream"}),
+        ("table1=one, table2=two", {"table1": "one", "table2": "two"}),
+    ],
+)
+def test_configured_channels(monkeypatch, spec, expected):
+    monkeypatch.setenv("CHANNELS", spec)
+    assert channel.configured_channels() == expected
+
+
+@pytest.mark.parametrize("spec", ["main", "=stream", "main="])
+def test_configured_channels_errors(monkeypatch, spec):
+    monkeypatch.setenv("CHANNELS", spec)
+    with pytest.raises(ValueError):
+        channel.configured_channels()
+
+
+def test_channels_are_independent():
+    one = channel.Channel("one", "mount1")
+    two = channel.Channel("two", "mount2")
+    one.enqueue("test_playlist")
+    assert one.playlist.name == "test_playlist"
+    assert not one._queue.empty()
+    assert two.playlist is None
+    assert two._queue.empty()
+    assert one.streamer.mount == "mount1"
+    assert two.streamer.mount == "mount2"
+    assert one.streamer.queue is not two.streamer.queue
+
+
+def test_channels_share_transcoder():
+    pool = object()
+    channels = [channel.Channel(str(i), f"mount{i}", transcoder=pool) for i in range(2)]
+    assert all(c.streamer.transcoder is pool for c in channels)
+
+
+def test_enqueue_leaves_parsing_to_warm(monkeypatch):
+    parse = MagicMock(side_effect=metadata.parse)
+    warmed = []
+    monkeypatch.setattr(metadata, "parse", parse)
+    monkeypatch.setattr(metadata.MetadataCache, "warm", lambda self, tracks: warmed.append(tracks))
+    c = channel.Channel("one", "mount1")
+    c.enqueue("test_playlist")
+    parse.assert_not_called()
+    assert warmed == [c.playlist.tracks]
+
+
+def test_layers_require_a_mixer():
+    with pytest.raises(ValueError):
+        channel.Channel("one", "mount1").add_layer("test_playlist")
+
+
+def test_add_layer(monkeypatch):
+    mix = MagicMock()
+    c = channel.Channel("one", "mount1", mixer=mix)
+    sub = c.events.subscribe()
+    assert c.streamer.mixer is mix
+    c.add_layer("test_playlist", 0.5)
+    mix.add.assert_called_once()
+    assert sub.get(timeout=1).name == "layer_add"
+    with pytest.raises(ValueError):
+        c.add_layer("no_such_playlist")
+
+
+@pytest.mark.parametrize(
+    "mount, env, expected",
+    [("table1", "", "mp3"), ("table1.ogg", "", "ogg"), ("Table1.OPUS", "mp3", "ogg"), ("table1", "ogg", "ogg")],
+)
+def test_mount_format(monkeypatch, mount, env, expected):
+    if env:
+        monkeypatch.setenv("ICECAST_FORMAT", env)
+    else:
+        monkeypatch.delenv("ICECAST_FORMAT", raising=False)
+    assert channel.mount_format(mount) == expected
+    assert channel.Channel("one", mount).streamer.format == expected
+
+
+def test_state_and_restore(monkeypatch):
+    resumed = []
+    monkeypatch.setattr(channel.AudioStreamer, "resume_from", lambda self, *args: resumed.append(args))
+    old = channel.Channel("one", "mount1")
+    old.enqueue("test_playlist")
+    old.schedule("test_playlist", 2000000000.0)
+    old.schedule("test_playlist")
+    old.streamer.handoff_state = {"track": "/music/tavern.mp3", "title": "Tavern", "position": 12.5, "next": "next.mp3"}
+    state = old.state()
+    assert state["playlist"] == "test_playlist"
+    assert [t["at"] for t in state["scheduled"]] == [2000000000.0, None]
+
+    new = channel.Channel("one", "mount1")
+    new.restore(json.loads(json.dumps(state)))
+    assert new.playlist.name == "test_playlist"
+    assert list(new._queue.queue) == [b"next.mp3"] + list(old._queue.queue)
+    assert [(t.playlist, t.at) for t in new.scheduled()] == [("test_playlist", 2000000000.0), ("test_playlist", None)]
+    assert resumed == [(Path("/music/tavern.mp3"), "Tavern", 12.5)]
+
+
+def test_restore_layers(monkeypatch):
+    mix = MagicMock(**{"gains.return_value": {"test_playlist": 0.5, "music": 0.8}})
+    old = channel.Channel("one", "mount1", mixer=mix)
+    state = old.state()
+    assert state["layers"] == {"test_playlist": 0.5, "music": 0.8}
+
+    new = channel.Channel("one", "mount1", mixer=MagicMock())
+    new.restore(state)
+    new.mixer.add.assert_called_once()
+    assert new.mixer.add.call_args.kwargs == {"gain": 0.5, "seconds": 0}
+    new.mixer.fade.assert_called_once_with("music", 0.8, seconds=0)
+
+
+def test_load_missing_playlist():
+    c = channel.Channel("one", "mount1")
+    c.enqueue("test_playlist")
+    with pytest.raises(ValueError):
+        c.load("no_such_playlist")
+    assert not c.streamer.load_requested.is_set()
+    assert c.playlist.name == "test_playlist"
@@ -0,0 +1,67 @@
+import json
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from croaker import events, server
+
+
+@pytest.fixture
+def bus():
+    return events.EventBus(maxsize=3)
+
+
+def test_publish_to_all_subscribers(bus):
+    subs = [bus.subscribe() for _ in range(3)]
+    bus.publish("track_start", title="one")
+    for sub in subs:
+        event = sub.get(timeout=0)
+        assert event.name == "track_start"
+        assert event.data == {"title": "one"}
+
+
+def test_unsubscribe(bus):
+    sub = bus.subscribe()
+    bus.unsubscribe(sub)
+    bus.publish("stop")
+    assert sub.get(timeout=0) is None
+
+
+def test_slow_subscriber_drops_oldest(bus):
+    sub = bus.subscribe()
+    for i in range(5):
+        bus.publish("track_start", title=str(i))
+    assert sub.dropped == 2
+    assert [sub.get(timeout=0).data["title"] for _ in range(3)] == ["2", "3", "4"]
+    assert sub.get(timeout=0) is None
+
+
+def test_event_serialization(bus):
+    event = bus.publish("track_end", title="one", duration=1.5)
+    data = json.loads(str(event))
+    assert data["event"] == "track_end"
+    assert data["title"] == "one"
+    assert data["duration"] == 1.5
+    assert data["timestamp"] == event.timestamp
+
+
+def test_subscriber_hang_up_is_noticed_between_events(bus):
+    client, conn = socket.socketpair()
+    handler = server.RequestHandler.__new__(server.RequestHandler)
+    handler.connection = conn
+    handler.rfile = conn.makefile("rb")
+    handler.wfile = conn.makefile("wb", buffering=0)
+    handler.channel = SimpleNamespace(events=bus)
+    thread = threading.Thread(target=handler.handle_SUBS, args=("",))
+    thread.start()
+    assert client.recv(3) == b"OK\n"
+    assert len(bus._subscribers) == 1
+
+    # nothing is published, but the subscription is dropped as soon as the client goes away
+    client.close()
+    thread.join(timeout=2)
+    assert not thread.is_alive()
+    assert bus._subscribers == []
+    conn.close()
@@ -0,0 +1,78 @@
+import json
+import socket
+from unittest.mock import MagicMock
+
+import pytest
+
+from croaker import handoff
+
+
+@pytest.fixture
+def tcp_listener():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def server(tcp_listener):
+    return MagicMock(
+        **{
+            "handoff.return_value": {"pid": 1234, "channels": {"default": {"queue": ["one.mp3"]}}},
+            "fileno.return_value": tcp_listener.fileno(),
+        }
+    )
+
+
+@pytest.fixture
+def listener(tmp_path, server):
+    thread = handoff.HandoffListener(tmp_path / "croaker.sock", server, timeout=5)
+    thread.start()
+    yield thread
+    thread.close()
+
+
+def test_request_without_daemon(tmp_path):
+    assert handoff.request_handoff(tmp_path / "croaker.sock") == (None, None)
+
+
+def test_handoff(listener, server, tcp_listener):
+    state, sock = handoff.request_handoff(listener.path, timeout=5)
+    listener.join(timeout=5)
+    assert state == server.handoff.return_value
+    assert sock.getsockname() == tcp_listener.getsockname()
+    server.finish_handoff.assert_called_once_with(state, True)
+    assert not listener.path.exists()
+    sock.close()
+
+
+def test_handoff_large_state(listener, server):
+    server.handoff.return_value = {"pid": 1234, "channels": {"default": {"queue": ["track.mp3"] * 20000}}}
+    state, sock = handoff.request_handoff(listener.path, timeout=5)
+    assert state == server.handoff.return_value
+    sock.close()
+
+
+def test_handoff_not_acknowledged(listener, server):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(str(listener.path))
+    conn.sendall(handoff.REQUEST)
+    data = b""
+    while not data.endswith(b"\n"):
+        data += conn.recv(65536)
+    conn.close()
+    listener.join(timeout=1)
+
+    # the old daemon carries on, and can still be taken over later
+    assert listener.is_alive()
+    server.finish_handoff.assert_called_once_with(json.loads(data), False)
+
+
+def test_handoff_refused(listener, server):
+    server.handoff.side_effect = TimeoutError
+    with pytest.raises(ConnectionError):
+        handoff.request_handoff(listener.path, timeout=5)
+    server.finish_handoff.assert_not_called()
+    assert listener.is_alive()
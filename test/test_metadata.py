@@ -0,0 +1,114 @@
+import shutil
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from mutagen.easyid3 import EasyID3
+
+from croaker import metadata, playlist
+
+
+@pytest.fixture
+def tagged_track(tmp_path):
+    track = tmp_path / "goblin_chase.mp3"
+    shutil.copy(Path(metadata.__file__).parent / "silence.mp3", track)
+    tags = EasyID3(track)
+    tags["title"] = "Goblin Chase"
+    tags["artist"] = "The Bards"
+    tags.save()
+    return track
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = metadata.MetadataCache(tmp_path / "cache.db")
+    yield c
+    c.close()
+
+
+def test_parse_tags(tagged_track):
+    meta = metadata.parse(tagged_track)
+    assert meta.title == "Goblin Chase"
+    assert meta.artist == "The Bards"
+    assert meta.display == "The Bards - Goblin Chase"
+    assert meta.duration == pytest.approx(3.0, abs=0.1)
+    assert str(meta) == "The Bards - Goblin Chase (0:03)"
+
+
+def test_parse_untagged():
+    track = playlist.Playlist(name="test_playlist").path / "one.mp3"
+    meta = metadata.parse(track)
+    assert meta.title == "one"
+    assert meta.duration is None
+    assert str(meta) == "one (?:??)"
+
+
+def test_cache_parses_once(monkeypatch, cache, tagged_track):
+    parse = MagicMock(side_effect=metadata.parse)
+    monkeypatch.setattr(metadata, "parse", parse)
+    assert cache.cached(tagged_track) is None
+    assert cache.get(tagged_track).title == "Goblin Chase"
+    assert cache.cached(tagged_track).title == "Goblin Chase"
+
+    # a new cache backed by the same store doesn't need to parse the file again
+    fresh = metadata.MetadataCache(cache.path)
+    assert fresh.get(tagged_track) == cache.get(tagged_track)
+    assert parse.call_count == 1
+
+
+def test_cache_invalidated_by_mtime(cache, tagged_track):
+    cache.get(tagged_track)
+    tags = EasyID3(tagged_track)
+    tags["title"] = "Goblin Retreat"
+    tags.save()
+    assert cache.get(tagged_track).title == "Goblin Retreat"
+
+
+def test_warm(cache, tagged_track):
+    cache.warm([tagged_track]).join()
+    assert cache.cached(tagged_track).title == "Goblin Chase"
+
+
+def test_cache_parses_links_once(monkeypatch, cache, tagged_track, tmp_path):
+    parse = MagicMock(side_effect=metadata.parse)
+    monkeypatch.setattr(metadata, "parse", parse)
+    links = [tmp_path / "battle.mp3", tmp_path / "_theme.mp3"]
+    for link in links:
+        link.symlink_to(tagged_track)
+        assert cache.get(link).title == "Goblin Chase"
+        assert cache.cached(link).title == "Goblin Chase"
+    assert cache.get(links[1]).path == str(tagged_track)
+    assert parse.call_count == 1
+
+
+def test_cached_notices_changes(cache, tagged_track):
+    cache.get(tagged_track)
+    tags = EasyID3(tagged_track)
+    tags["title"] = "Goblin Retreat"
+    tags.save()
+    assert cache.cached(tagged_track) is None
+
+
+def test_lookup_reads_the_database_without_parsing(monkeypatch, cache, tagged_track):
+    assert cache.lookup(tagged_track) is None
+    cache.get(tagged_track)
+    parse = MagicMock(side_effect=metadata.parse)
+    monkeypatch.setattr(metadata, "parse", parse)
+    fresh = metadata.MetadataCache(cache.path)
+    assert fresh.cached(tagged_track) is None
+    assert fresh.lookup(tagged_track).title == "Goblin Chase"
+    assert fresh.cached(tagged_track).title == "Goblin Chase"
+    assert not parse.called
+
+
+def test_prune_deletes_rows_of_links_and_missing_files(cache, tagged_track, tmp_path):
+    link = tmp_path / "battle.mp3"
+    link.symlink_to(tagged_track)
+    cache.get(tagged_track)
+    with cache.db:
+        cache.db.executemany(
+            "INSERT INTO tracks VALUES (?, 0, 'Old', NULL, NULL, NULL)",
+            [(str(link),), (str(tmp_path / "gone.mp3"),)],
+        )
+    assert cache.prune() == 2
+    assert list(cache.stored()) == [str(tagged_track)]
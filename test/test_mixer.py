@@ -0,0 +1,259 @@
+import io
+import subprocess
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from croaker import mixer, transcoder
+
+
+def pcm(value, frames):
+    return np.full(frames * mixer.CHANNELS, value, dtype="<i2").tobytes()
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """
+    Decode "tracks" from a dict of PCM bytes instead of running ffmpeg.
+    """
+    data = {}
+    monkeypatch.setattr(mixer.Layer, "decode", lambda self, track: io.BytesIO(data[track]))
+    return data
+
+
+def test_gain_constant():
+    gain = mixer.Gain(0.5)
+    assert gain.envelope(4) == 0.5
+    gain.fade(0.25)
+    assert gain.envelope(4) == 0.25
+
+
+def test_gain_fade():
+    gain = mixer.Gain(0.0, sample_rate=4)
+    gain.fade(1.0, seconds=1)
+    assert gain.fading
+    assert list(gain.envelope(6).flatten()) == [0.25, 0.5, 0.75, 1.0, 1.0, 1.0]
+    assert not gain.fading
+    assert gain.value == 1.0
+
+
+def test_layer_loops(sources):
+    sources["one"] = pcm(1, 3)
+    sources["two"] = pcm(2, 2)
+    layer = mixer.Layer("rain", ["one", "two"])
+    assert list(layer.read(7)[:, 0]) == [1, 1, 1, 2, 2, 1, 1]
+    assert not layer.done
+
+
+def test_layer_ends(sources):
+    sources["one"] = pcm(1, 3)
+    layer = mixer.Layer("music", ["one"], loop=False)
+    assert list(layer.read(5)[:, 1]) == [1, 1, 1, 0, 0]
+    assert layer.done
+
+
+def test_layer_without_audio(sources):
+    sources["broken"] = b""
+    layer = mixer.Layer("rain", ["broken"])
+    assert not layer.read(4).any()
+    assert layer.done
+
+
+def test_mix(sources):
+    sources["music"] = pcm(1000, 4)
+    sources["rain"] = pcm(100, 4)
+    sources["wind"] = pcm(30000, 4)
+    mix = mixer.Mixer(fade_time=0)
+    mix.add("rain", ["rain"], gain=0.5)
+    mix.add("wind", ["wind"])
+    out = np.frombuffer(mix.mix(mixer.Layer("music", ["music"], loop=False), 4), dtype="<i2")
+    assert list(out) == [1000 + 50 + 30000] * 8
+
+
+def test_mix_clips(sources):
+    sources["music"] = pcm(-30000, 2)
+    sources["thunder"] = pcm(-30000, 2)
+    mix = mixer.Mixer(fade_time=0)
+    mix.add("thunder", ["thunder"])
+    out = np.frombuffer(mix.mix(mixer.Layer("music", ["music"], loop=False), 2), dtype="<i2")
+    assert list(out) == [-32768] * 4
+
+
+def test_fade_music(sources):
+    sources["music"] = pcm(1000, 4)
+    mix = mixer.Mixer(fade_time=0)
+    mix.fade("music", 0.5)
+    out = np.frombuffer(mix.mix(mixer.Layer("music", ["music"], loop=False), 4), dtype="<i2")
+    assert list(out) == [500] * 8
+
+
+def test_remove(sources):
+    sources["music"] = pcm(0, 8)
+    sources["rain"] = pcm(100, 8)
+    mix = mixer.Mixer(sample_rate=4)
+    mix.add("rain", ["rain"], gain=1.0, seconds=0)
+    mix.remove("rain", seconds=1)
+    assert "rain" in str(mix)
+    music = mixer.Layer("music", ["music"], loop=False)
+    out = np.frombuffer(mix.mix(music, 4), dtype="<i2")
+    assert list(out[::2]) == [75, 50, 25, 0]
+    assert "rain" not in mix.layers
+
+
+@pytest.mark.parametrize("method, args", [("fade", ("nope", 1.0)), ("remove", ("nope",)), ("remove", ("music",))])
+def test_no_such_layer(method, args):
+    with pytest.raises(ValueError):
+        getattr(mixer.Mixer(), method)(*args)
+
+
+class BlockingSource(io.BytesIO):
+    """
+    PCM that can't be read until it's released, like a decoder that hasn't caught up.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.reading = threading.Event()
+        self.released = threading.Event()
+
+    def read(self, size=-1):
+        self.reading.set()
+        assert self.released.wait(timeout=5)
+        return super().read(size)
+
+
+def test_commands_dont_wait_for_layers(monkeypatch, sources):
+    source = BlockingSource(pcm(100, 4))
+    monkeypatch.setattr(mixer.Layer, "decode", lambda self, track: source)
+    mix = mixer.Mixer(fade_time=0)
+    mix.add("rain", ["rain"])
+    mixing = threading.Thread(target=mix.mix, args=(mixer.Layer("music", ["music"], loop=False), 4))
+    mixing.start()
+    assert source.reading.wait(timeout=5)
+
+    # the mixing thread is stuck reading the layer, but the layers can still be changed
+    mix.fade("rain", 0.5)
+    mix.add("wind", ["wind"])
+    mix.remove("wind")
+    assert "rain" in str(mix)
+    source.released.set()
+    mixing.join()
+
+
+@pytest.fixture(scope="module")
+def silence():
+    return Path(transcoder.__file__).parent / "silence.mp3"
+
+
+@pytest.fixture(scope="module")
+def long_track(tmp_path_factory):
+    track = tmp_path_factory.mktemp("mixer") / "long.flac"
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "sine=duration=10", str(track)],
+        check=True,
+    )
+    return track
+
+
+def test_mixed_stream(silence):
+    mix = mixer.Mixer()
+    mix.add("more_silence", [silence], gain=0.5)
+    stream = mix.open(silence, chunk_size=4096)
+    expected = transcoder.FrameAlignedStream.from_source(silence)
+    assert b"".join(stream)
+    stream.close()
+    b"".join(expected)
+    assert stream.position == pytest.approx(expected.position, abs=0.2)
+    assert "more_silence" in mix.layers
+    mix.shutdown()
+    assert not mix.layers
+
+
+def test_mixed_stream_longer_than_lookahead(long_track, silence):
+    mix = mixer.Mixer(lookahead=0.5)
+    mix.add("silence", [silence])
+    stream = mix.open(long_track, chunk_size=4096)
+    assert b"".join(stream)
+    stream.close()
+    assert stream.position == pytest.approx(10.0, abs=0.2)
+    mix.shutdown()
+
+
+def test_mixed_stream_waits_to_be_played(long_track, silence):
+    mix = mixer.Mixer()
+    rain = mix.add("rain", [silence])
+    prefetched = mix.open(long_track)
+    assert not mix.running
+    assert rain._source is None
+    prefetched.close()
+    mix.shutdown()
+
+
+def test_mixed_streams_share_an_encoder(long_track, silence):
+    mix = mixer.Mixer()
+    mix.add("rain", [silence])
+    streams = [mix.open(silence, chunk_size=4096) for _ in range(2)]
+    encoders = []
+    for stream in streams:
+        assert b"".join(stream)
+        encoders.append(mix._encoder)
+        stream.close()
+
+    # the second track carries on from where the first ended, with the same encoder
+    assert encoders[0] is encoders[1]
+    assert streams[1].first == streams[0].end
+    assert streams[1].position == pytest.approx(streams[0].position, abs=0.2)
+    mix.shutdown()
+    assert not mix.running
+
+
+def test_mixed_stream_cut_off(long_track, silence):
+    mix = mixer.Mixer()
+    skipped = mix.open(long_track, chunk_size=4096)
+    following = mix.open(silence, chunk_size=4096)
+    next(iter(skipped))
+    skipped.close()
+    assert b"".join(following)
+    following.close()
+
+    # what was left of the skipped track is never heard
+    expected = transcoder.FrameAlignedStream.from_source(silence)
+    b"".join(expected)
+    assert following.position == pytest.approx(expected.position, abs=0.2)
+    mix.shutdown()
+
+
+def test_mixed_stream_rewound_for_a_cue(long_track, silence):
+    mix = mixer.Mixer()
+    first = mix.open(silence, chunk_size=4096)
+    queued = mix.open(long_track, chunk_size=4096)
+    assert b"".join(first)
+    first.close()
+
+    # the queued track was started when the first ended, but another is played instead
+    cued = mix.open(silence, chunk_size=4096)
+    assert b"".join(cued)
+    cued.close()
+    assert cued.position == pytest.approx(first.position, abs=0.2)
+    stream = iter(queued)
+    next(stream)
+    assert queued.first == cued.end
+    queued.close()
+    mix.shutdown()
+
+
+@pytest.mark.parametrize("value", ["nan", "-0.5", "inf"])
+def test_parse_gain_rejects(value):
+    with pytest.raises(ValueError):
+        mixer.parse_gain(value)
+
+
+def test_gains(sources):
+    mix = mixer.Mixer(fade_time=1)
+    mix.add("rain", ["rain"], gain=0.6)
+    mix.add("wind", ["wind"])
+    mix.remove("wind")
+    mix.fade("music", 0.7)
+    assert mix.gains() == {"rain": 0.6, "music": 0.7}
@@ -0,0 +1,114 @@
+import io
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from croaker import server
+from croaker.pacing import ChunkSizer
+
+
+@pytest.fixture
+def now():
+    return [0.0]
+
+
+@pytest.fixture
+def sizer(now):
+    sizer = ChunkSizer(target=0.25, clock=lambda: now[0])
+    sizer.start()
+    return sizer
+
+
+def send(sizer, now, seconds):
+    now[0] += seconds
+    sizer.sent()
+
+
+def test_fixed_chunk_size(now):
+    sizer = ChunkSizer(chunk_size=4096, clock=lambda: now[0])
+    sizer.start()
+    for _ in range(20):
+        send(sizer, now, 1.0)
+    assert sizer.chunk_size == 4096
+    sizer.shrink()
+    assert sizer.chunk_size == 4096
+    assert sizer.latency == 1.0
+    assert str(sizer) == "\n".join(
+        [
+            "chunk size: 4096 bytes (7 frames, 0.183s)",
+            "latency: 1.000s average, 1.000s max",
+            "latency target: none",
+        ]
+    )
+
+
+def test_chunks_are_whole_frames(sizer):
+    # 4096 bytes is six and a bit 192kbps frames, which streams would round up to seven
+    assert sizer.frame_size == 626
+    assert sizer.frames == 7
+    assert sizer.chunk_size == 7 * 626
+
+
+def test_grows_while_sink_is_healthy(sizer, now):
+    # a chunk that takes as long to send as the audio it holds leaves room for more, up to the target
+    for _ in range(10):
+        send(sizer, now, sizer.frames * sizer.frame_duration)
+    assert sizer.frames == 9 == sizer.max_frames
+    assert sizer.frames * sizer.frame_duration <= sizer.target
+
+
+def test_shrinks_when_sink_falls_behind(sizer, now):
+    send(sizer, now, 0.3)
+    assert sizer.frames == 3
+    send(sizer, now, 0.5)
+    assert sizer.frames == 1
+    send(sizer, now, 0.5)
+    assert sizer.frames == 1
+
+
+def test_holds_near_target(sizer, now):
+    # growing by another frame would take this chunk over the target
+    send(sizer, now, 0.24)
+    assert sizer.frames == 7
+
+
+def test_shrinks_when_commands_are_pending(sizer):
+    sizer.shrink()
+    assert sizer.frames == 3
+
+
+def test_shrinks_before_the_read_after_a_command(sizer):
+    sizer.command()
+    assert sizer.frames == 7
+    assert sizer.next_chunk_size() == 3 * sizer.frame_size
+
+    # each command shrinks the chunks once
+    assert sizer.next_chunk_size() == 3 * sizer.frame_size
+
+
+def test_playback_commands_signal_the_sizer(sizer):
+    handler = server.RequestHandler.__new__(server.RequestHandler)
+    handler.rfile = io.BytesIO(b"HELP\nFADE rain 0.5\n")
+    handler.wfile = io.BytesIO()
+    handler.should_listen = True
+    handler.channel = SimpleNamespace(streamer=SimpleNamespace(chunks=sizer), fade_layer=MagicMock())
+    handler.handle()
+
+    # HELP doesn't change what's playing; FADE does, and waits behind the chunk being sent
+    handler.channel.fade_layer.assert_called_once_with("rain", 0.5)
+    assert sizer.next_chunk_size() == 3 * sizer.frame_size
+
+
+def test_start_excludes_time_between_chunks(sizer, now):
+    now[0] += 5
+    sizer.start()
+    send(sizer, now, 0.1)
+    assert list(sizer.latencies) == [pytest.approx(0.1)]
+    assert sizer.frames == 8
+
+
+def test_ogg_frames():
+    sizer = ChunkSizer(target=0.25, bit_rate=64000, sample_rate=48000)
+    assert sizer.frame_size == 192
+    assert sizer.max_frames == 10
@@ -33,3 +33,14 @@ def test_pidfile(monkeypatch, pid, terminate, kill_result, broken):
 
     ret = pidfile.pidfile(pidfile_path=Path("/dev/null"), terminate_if_running=terminate)
     assert ret.break_lock.called == broken
+
+
+def test_wait_for_exit(monkeypatch):
+    monkeypatch.setattr(pidfile.os, "kill", MagicMock(side_effect=[None, None, ProcessLookupError]))
+    assert pidfile.wait_for_exit(1234, timeout=5)
+    assert pidfile.os.kill.call_count == 3
+
+
+def test_wait_for_exit_timeout(monkeypatch):
+    monkeypatch.setattr(pidfile.os, "kill", MagicMock())
+    assert not pidfile.wait_for_exit(1234, timeout=0.1)
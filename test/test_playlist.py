@@ -42,3 +42,20 @@ def test_playlist_creation(monkeypatch, paths, make_theme, expected_count):
 
     pl.add([croaker.path.playlist_root() / p for p in paths], make_theme)
     assert len(new_symlinks) == expected_count
+
+
+def test_load_playlist_cache(monkeypatch):
+    monkeypatch.setattr(croaker.playlist, "playlists", croaker.playlist.OrderedDict())
+    monkeypatch.setattr(croaker.playlist, "PLAYLIST_CACHE_SIZE", 1)
+    pl = croaker.playlist.load_playlist("test_playlist")
+    assert croaker.playlist.load_playlist("test_playlist") is pl
+
+    # missing playlists aren't cached, and the least recently used are forgotten
+    croaker.playlist.load_playlist("no_such_playlist")
+    assert list(croaker.playlist.playlists) == ["test_playlist"]
+    croaker.playlist.Path(croaker.path.playlist_root() / "other").mkdir()
+    try:
+        croaker.playlist.load_playlist("other")
+    finally:
+        (croaker.path.playlist_root() / "other").rmdir()
+    assert list(croaker.playlist.playlists) == ["other"]
@@ -0,0 +1,259 @@
+import queue
+import socketserver
+import subprocess
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+import shout
+
+from croaker import reconnect, streamer
+
+
+class IcecastHandler(socketserver.BaseRequestHandler):
+    """
+    Accept a source connection the way icecast does, then read audio until the client
+    disconnects or we've read enough to drop the connection.
+    """
+
+    def handle(self):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            data = self.request.recv(1024)
+            if not data:
+                return
+            request += data
+        self.request.sendall(b"HTTP/1.0 200 OK\r\n\r\n")
+
+        received = bytearray(request.split(b"\r\n\r\n", 1)[1])
+        self.server.connections.append(received)
+        drop = len(self.server.connections) <= self.server.drops
+        try:
+            while True:
+                data = self.request.recv(4096)
+                if not data:
+                    return
+                received.extend(data)
+                if drop and len(received) >= self.server.drop_after:
+                    return
+        finally:
+            self.server.closed.release()
+
+
+class IcecastStandIn(socketserver.ThreadingTCPServer):
+    """
+    A local stand-in for an icecast server that drops the first few source connections.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, drops=1, drop_after=8192, port=0):
+        super().__init__(("127.0.0.1", port), IcecastHandler)
+        self.drops = drops
+        self.drop_after = drop_after
+        self.connections = []
+        self.closed = threading.Semaphore(0)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def wait_closed(self, count):
+        for _ in range(count):
+            assert self.closed.acquire(timeout=5)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture
+def icecast(monkeypatch):
+    server = IcecastStandIn()
+    monkeypatch.setenv("ICECAST_HOST", "127.0.0.1")
+    monkeypatch.setenv("ICECAST_PORT", str(server.port))
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def audio_streamer():
+    return streamer.AudioStreamer(
+        queue.Queue(),
+        threading.Event(),
+        threading.Event(),
+        threading.Event(),
+        backoff=reconnect.Backoff(base=0.01, cap=0.05),
+    )
+
+
+@pytest.fixture
+def mock_shout(monkeypatch):
+    mm = MagicMock(spec=shout.Shout)
+    monkeypatch.setattr("shout.Shout", mm)
+    return mm.return_value
+
+
+def test_backoff():
+    backoff = reconnect.Backoff(base=1, factor=2, cap=5, jitter=0.5, rand=lambda: 1.0)
+    assert [backoff.next() for _ in range(5)] == [0.5, 1.0, 2.0, 2.5, 2.5]
+    backoff.reset()
+    assert backoff.next() == 0.5
+
+
+def test_backoff_jitter():
+    backoff = reconnect.Backoff(base=1, jitter=0.5)
+    delays = [backoff.next() for _ in range(3)]
+    assert 0.5 <= delays[0] <= 1.0
+    assert 1.0 <= delays[1] <= 2.0
+    assert 2.0 <= delays[2] <= 4.0
+
+
+def test_connection_stats():
+    now = [0.0]
+    stats = reconnect.ConnectionStats(clock=lambda: now[0])
+    assert not stats.connected
+    stats.up()
+    assert stats.connected
+    assert stats.reconnects == 0
+
+    now[0] = 10.0
+    stats.down(Exception("oops"))
+    now[0] = 12.5
+    assert "downtime: 2.5s" in str(stats)
+    stats.up()
+    assert stats.connected
+    assert stats.reconnects == 1
+    assert stats.downtime == 2.5
+    assert stats.last_error == "oops"
+
+
+def test_reconnect_resumes_stream(icecast, audio_streamer):
+    audio_streamer.connect()
+    audio_streamer.stream_queued_audio()
+    audio_streamer._shout.close()
+    icecast.wait_closed(2)
+
+    assert audio_streamer.stats.reconnects == 1
+    assert len(icecast.connections) == 2
+
+    # the new connection picks up at a frame boundary, from a point no later than
+    # where the dropped connection left off, and streams the rest of the track.
+    expected = b"".join(audio_streamer.silence)
+    dropped, resumed = icecast.connections
+    assert resumed[0] == 0xFF and resumed[1] >> 5 == 0b111
+    assert expected.startswith(dropped)
+    assert expected.endswith(resumed)
+    assert len(expected) - len(resumed) <= len(dropped)
+
+
+def test_reconnect_retries_until_server_is_up(monkeypatch, icecast, audio_streamer):
+    port = icecast.port
+    icecast.stop()
+    delays = []
+
+    def restart_after_three_attempts(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            monkeypatch.setattr(icecast, "restarted", IcecastStandIn(drops=0, port=port), raising=False)
+
+    monkeypatch.setattr(streamer, "sleep", restart_after_three_attempts)
+    audio_streamer.connect()
+    icecast.restarted.stop()
+
+    assert len(delays) == 3
+    assert delays[0] < delays[2]
+    assert audio_streamer.stats.connected
+    assert audio_streamer.stats.connections == 1
+
+
+def test_reconnect_resends_recent_chunks(monkeypatch, mock_shout, audio_streamer):
+    audio_streamer.resend_window = 1.0
+    now = [100.0]
+    monkeypatch.setattr(streamer, "time", lambda: now[0])
+    for chunk in (b"old", b"recent", b"latest"):
+        audio_streamer.send(chunk)
+        now[0] += 0.4
+    audio_streamer.reconnect(Exception("dropped"))
+
+    # only audio sent within the resend window is sent again
+    assert list(audio_streamer._pending) == [b"recent", b"latest"]
+
+
+def test_reconnect_resends_nothing_confirmed_by_default(mock_shout, audio_streamer):
+    for chunk in (b"old", b"recent", b"latest"):
+        audio_streamer.send(chunk)
+    audio_streamer.reconnect(Exception("dropped"))
+    assert not audio_streamer._pending
+
+
+def test_connect_starts_over_after_a_failure(monkeypatch, audio_streamer):
+    shouts = []
+
+    def new_shout():
+        s = MagicMock()
+        s.open.side_effect = shout.ShoutException("refused") if not shouts else None
+        shouts.append(s)
+        return s
+
+    monkeypatch.setattr("shout.Shout", new_shout)
+    monkeypatch.setattr(streamer, "sleep", lambda delay: None)
+    audio_streamer.connect()
+
+    # the half-open connection is closed, and the retry uses a new one
+    assert len(shouts) == 2
+    shouts[0].close.assert_called_once()
+    assert audio_streamer._shout is shouts[1]
+
+
+def test_reconnect_resends_ogg_headers(mock_shout, tmp_path):
+    tone = tmp_path / "tone.flac"
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "sine=duration=3", str(tone)], check=True
+    )
+    tracks = queue.Queue()
+    tracks.put(str(tone).encode())
+    ogg = streamer.AudioStreamer(
+        tracks, threading.Event(), threading.Event(), threading.Event(), format="ogg", chunk_size=1024
+    )
+    sent = []
+
+    def drop_the_third_chunk(chunk):
+        if len(sent) == 3:
+            sent.append(None)
+            raise shout.ShoutException("dropped")
+        sent.append(chunk)
+
+    mock_shout.send.side_effect = drop_the_third_chunk
+    ogg.stream_queued_audio()
+
+    # the new connection starts with the track's header pages, before the chunk that failed
+    resumed = sent[sent.index(None) + 1 :]
+    assert resumed[0].startswith(b"OggS")
+    assert resumed[0][27 + resumed[0][26] :].startswith(b"OpusHead")
+    assert resumed[0] == sent[0][: len(resumed[0])]
+    assert b"OpusHead" not in b"".join(resumed[1:])
+
+
+@pytest.mark.parametrize("event", ["skip_requested", "load_requested", "stop_requested"])
+def test_interruption_clears_resend_buffer(mock_shout, audio_streamer, event):
+    audio_streamer.send(b"stopped track")
+    getattr(audio_streamer, event).set()
+    assert audio_streamer.interrupted()
+    audio_streamer.reconnect(Exception("dropped"))
+    assert not audio_streamer._pending
+
+
+def test_backoff_grows_until_a_send_succeeds(monkeypatch, mock_shout, audio_streamer):
+    delays = []
+    monkeypatch.setattr(streamer, "sleep", delays.append)
+
+    # the server accepts the connection, then drops it before any audio gets through
+    mock_shout.send.side_effect = [shout.ShoutException("dropped")] * 4 + [None]
+    audio_streamer.send(b"audio")
+
+    assert len(delays) == 3
+    assert delays[0] < delays[2]
+    assert audio_streamer.backoff.attempts == 0
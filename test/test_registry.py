@@ -0,0 +1,144 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from croaker import registry
+
+
+@pytest.fixture
+def library(monkeypatch, tmp_path):
+    """
+    Two playlists linking to the same source, one of them through a copy, and a track of its own.
+    """
+    monkeypatch.setenv("PLAYLIST_ROOT", str(tmp_path / "playlists"))
+    sources = tmp_path / "sources"
+    sources.mkdir()
+    (sources / "goblin_chase.mp3").write_bytes(os.urandom(300 * 1024))
+    shutil.copy(sources / "goblin_chase.mp3", sources / "goblin_chase (copy).mp3")
+    (sources / "tavern.mp3").write_bytes(os.urandom(1024))
+    for playlist, links in {
+        "battle": {"goblin_chase.mp3": "goblin_chase.mp3", "_theme.mp3": "goblin_chase.mp3"},
+        "tavern": {"tavern.mp3": "tavern.mp3", "goblin_chase.mp3": "goblin_chase (copy).mp3"},
+    }.items():
+        (tmp_path / "playlists" / playlist).mkdir(parents=True)
+        for name, source in links.items():
+            (tmp_path / "playlists" / playlist / name).symlink_to(sources / source)
+    return tmp_path
+
+
+@pytest.fixture
+def tracks():
+    return registry.TrackRegistry()
+
+
+def test_sampled_digest(tmp_path):
+    data = os.urandom(registry.SAMPLE_SIZE * 4)
+    one, two = tmp_path / "one", tmp_path / "two"
+    one.write_bytes(data)
+    two.write_bytes(data)
+    assert registry.sampled_digest(one, len(data)) == registry.sampled_digest(two, len(data))
+
+    # a change in a sampled part of the file is noticed, but one between the samples isn't
+    changed = bytearray(data)
+    changed[-1] ^= 1
+    two.write_bytes(changed)
+    assert registry.sampled_digest(one, len(data)) != registry.sampled_digest(two, len(data))
+    changed = bytearray(data)
+    changed[registry.SAMPLE_SIZE + 1] ^= 1
+    two.write_bytes(changed)
+    assert registry.sampled_digest(one, len(data)) == registry.sampled_digest(two, len(data))
+
+
+def test_links_share_a_record(library, tracks):
+    battle = library / "playlists" / "battle"
+    record = tracks.get(battle / "goblin_chase.mp3")
+    assert record.path == library / "sources" / "goblin_chase.mp3"
+    assert tracks.get(battle / "_theme.mp3") is record
+    assert tracks.cached(battle / "_theme.mp3") is record
+    assert tracks.hashed == 1
+    assert len(tracks) == 1
+
+
+def test_copies_share_a_digest(library, tracks):
+    original = tracks.get(library / "playlists" / "battle" / "goblin_chase.mp3")
+    copy = tracks.get(library / "playlists" / "tavern" / "goblin_chase.mp3")
+    assert copy.path != original.path
+    assert copy.digest == original.digest
+    assert tracks.get(library / "playlists" / "tavern" / "tavern.mp3").digest != original.digest
+
+
+def test_changed_files_are_hashed_again(library, tracks):
+    track = library / "playlists" / "tavern" / "tavern.mp3"
+    record = tracks.get(track)
+    assert tracks.get(track) is record
+    (library / "sources" / "tavern.mp3").write_bytes(os.urandom(2048))
+    assert tracks.get(track).digest != record.digest
+    assert tracks.hashed == 2
+
+
+def test_cached_doesnt_touch_the_disk(tracks, tmp_path):
+    assert tracks.cached(tmp_path / "nothing.mp3") is None
+    with pytest.raises(OSError):
+        tracks.get(tmp_path / "nothing.mp3")
+
+
+def test_duplicates(library, tracks):
+    root = library / "playlists"
+    assert tracks.scan(sorted(root.rglob("*.mp3")) + [root / "missing.mp3"]) == 4
+    [duplicate] = tracks.duplicates()
+    assert [record.path.name for record in duplicate.files] == ["goblin_chase (copy).mp3", "goblin_chase.mp3"]
+    assert [Path(entry).relative_to(root) for entry in duplicate.entries] == [
+        Path("battle/_theme.mp3"),
+        Path("battle/goblin_chase.mp3"),
+        Path("tavern/goblin_chase.mp3"),
+    ]
+    assert duplicate.shared == 2 * 300 * 1024
+    assert duplicate.copies == 300 * 1024
+
+    report = tracks.report()
+    assert "goblin_chase (copy).mp3 (0.3 MB): 3 entries, 2 files" in report
+    assert "      battle/_theme.mp3" in report
+    assert "4 playlist entries, 3 files, 2 distinct tracks" in report
+    assert "Sharing tracks between entries saves reading and transcoding 0.6 MB." in report
+    assert "Replacing copies with symlinks would free 0.3 MB." in report
+
+
+def test_no_duplicates(tracks):
+    assert "No duplicate tracks." in tracks.report()
+
+
+def test_same_contents_hashes_lookalikes_whole(tracks, tmp_path):
+    data = os.urandom(registry.SAMPLE_SIZE * 4)
+    for name in ("one", "copy"):
+        (tmp_path / name).write_bytes(data)
+    changed = bytearray(data)
+    changed[registry.SAMPLE_SIZE + 1] ^= 1
+    (tmp_path / "lookalike").write_bytes(changed)
+    one, copy, lookalike = (tracks.get(tmp_path / name) for name in ("one", "copy", "lookalike"))
+    assert one.digest == lookalike.digest
+
+    assert tracks.same_contents(one, copy)
+    assert not tracks.same_contents(one, lookalike)
+    assert len(tracks._contents) == 3
+
+
+def test_records_of_missing_files_are_dropped(library, tracks):
+    root = library / "playlists"
+    tracks.scan(sorted(root.rglob("*.mp3")))
+    assert len(tracks) == 3
+
+    # looking up a track that's gone drops its entry, and its file once no other entry leads to it
+    (library / "sources" / "tavern.mp3").unlink()
+    with pytest.raises(OSError):
+        tracks.get(root / "tavern" / "tavern.mp3")
+    assert tracks.cached(root / "tavern" / "tavern.mp3") is None
+    assert len(tracks) == 2
+
+    # entries that are never looked up again are dropped by prune()
+    (root / "battle" / "_theme.mp3").unlink()
+    (root / "battle" / "goblin_chase.mp3").unlink()
+    assert tracks.prune() == 2
+    assert len(tracks) == 1
+    assert len(tracks._entries) == 1
@@ -0,0 +1,45 @@
+import pytest
+
+from croaker import ring
+
+
+@pytest.fixture
+def frame_ring():
+    r = ring.FrameRing(size=64)
+    yield r
+    r.close()
+
+
+def test_read_empty(frame_ring):
+    assert frame_ring.read() is None
+
+
+def test_write_and_read(frame_ring):
+    other = ring.FrameRing(size=64, name=frame_ring.name)
+    assert frame_ring.write(ring.FRAME, 1, b"one", samples=1152)
+    assert frame_ring.write(ring.END, 1)
+    assert other.read() == (ring.FRAME, 1, b"one", 1152)
+    assert other.read() == (ring.END, 1, b"", 0)
+    assert other.read() is None
+    other.close()
+
+
+def test_full(frame_ring):
+    record = b"x" * (64 - ring.FrameRing.header.size)
+    assert frame_ring.write(ring.FRAME, 1, record)
+    assert not frame_ring.write(ring.FRAME, 2, b"")
+    assert frame_ring.read() == (ring.FRAME, 1, record, 0)
+    assert frame_ring.write(ring.FRAME, 2, b"")
+
+
+def test_wraparound(frame_ring):
+    for i in range(100):
+        payload = bytes([i]) * (i % 20)
+        assert frame_ring.write(ring.FRAME, i, payload, samples=i)
+        assert frame_ring.read() == (ring.FRAME, i, payload, i)
+    assert frame_ring.used() == 0
+
+
+def test_record_too_large(frame_ring):
+    with pytest.raises(ValueError):
+        frame_ring.write(ring.FRAME, 1, b"x" * 64)
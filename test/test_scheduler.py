@@ -0,0 +1,85 @@
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from croaker import scheduler
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def sched(clock):
+    return scheduler.Scheduler(clock=clock)
+
+
+def test_wall_clock_maps_to_stream_time(sched, clock):
+    sched.advance(10.0)
+    clock.now += 2.5
+    transition = sched.after(5, "battle", MagicMock())
+    assert transition.at == clock.now + 5
+    assert sched.deadline() == pytest.approx(17.5)
+
+
+def test_timed_transitions_are_due_in_order(sched):
+    sched.advance(0.0)
+    late = sched.after(10, "late", MagicMock())
+    early = sched.after(5, "early", MagicMock())
+    assert sched.due(4.9) is None
+    assert sched.due(5.0) is early
+    assert sched.due(5.0) is None
+    assert sched.due(12.0) is late
+
+
+def test_boundary_transitions_wait_for_boundary(sched):
+    transition = sched.next_track("battle", MagicMock())
+    assert sched.due(100.0) is None
+    assert sched.due(100.0, boundary=True) is transition
+    assert not sched.pending
+
+
+def test_cancel(sched):
+    sched.after(5, "one", MagicMock())
+    sched.next_track("two", MagicMock())
+    assert len(sched.cancel()) == 2
+    assert sched.deadline() is None
+    assert sched.due(100.0, boundary=True) is None
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        ("", None),
+        ("next", None),
+        ("+30", 30),
+        ("+0.5", 0.5),
+        ("23:59:59", None),
+    ],
+)
+def test_parse_when(clock, spec, expected):
+    clock.now = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0).timestamp()
+    when = scheduler.parse_when(spec, clock)
+    if ":" in spec:
+        assert datetime.fromtimestamp(when).strftime("%H:%M:%S") == spec
+    elif expected is None:
+        assert when is None
+    else:
+        assert when == clock.now + expected
+
+
+@pytest.mark.parametrize("spec", ["+-1", "11:59", "soon", "1:2:3:4"])
+def test_parse_when_errors(clock, spec):
+    clock.now = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0).timestamp()
+    with pytest.raises(ValueError):
+        scheduler.parse_when(spec, clock)
@@ -0,0 +1,148 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from croaker import metadata, search
+
+
+@pytest.fixture
+def library(monkeypatch, tmp_path):
+    """
+    A playlist root with two playlists, and a track of the same name in both.
+    """
+    monkeypatch.setenv("PLAYLIST_ROOT", str(tmp_path / "playlists"))
+    for playlist, names in {
+        "battle": ["goblin_chase.mp3", "Dragon's Lair.mp3", "theme.mp3"],
+        "tavern": ["Goblin Shanty.mp3", "theme.mp3"],
+    }.items():
+        path = tmp_path / "playlists" / playlist
+        path.mkdir(parents=True)
+        for name in names:
+            (path / name).write_bytes(b"")
+    return tmp_path / "playlists"
+
+
+@pytest.fixture
+def index(library):
+    index = search.TrackIndex()
+    index.refresh()
+    return index
+
+
+def titles(matches):
+    return [str(match) for match in matches]
+
+
+def test_words():
+    assert search.words("Dragon's_Lair (Live!)") == ["dragon", "s", "lair", "live"]
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("goblin", ["battle: goblin_chase", "tavern: Goblin Shanty"]),
+        ("GOBLIN chase", ["battle: goblin_chase"]),
+        ("obli", ["battle: goblin_chase", "tavern: Goblin Shanty"]),
+        ("dragons", []),
+        ("dr la", ["battle: Dragon's Lair"]),
+        ("tavern theme", ["tavern: theme"]),
+        ("ch", ["battle: goblin_chase"]),
+        ("hase", ["battle: goblin_chase"]),
+        ("", []),
+        ("nothing", []),
+    ],
+)
+def test_search(index, query, expected):
+    assert titles(index.search(query)) == expected
+
+
+def test_search_limit(index):
+    assert len(index.search("theme", limit=1)) == 1
+
+
+def test_search_verifies_trigrams(index):
+    # "lai" and "air" are both in "lair", but "laira" isn't
+    assert index.search("laira") == []
+
+
+def test_search_tags(library, monkeypatch, tmp_path):
+    track = library / "tavern" / "theme.mp3"
+    tags = metadata.TrackMetadata(
+        path=str(track), mtime=track.stat().st_mtime_ns, title="Drunken Sailor", artist="The Crew"
+    )
+    monkeypatch.setattr(metadata.MetadataCache, "stored", lambda self: {str(track): tags})
+    index = search.TrackIndex()
+    index.refresh()
+    assert index.search("sailor") == [search.Match(playlist="tavern", track=track, title="The Crew - Drunken Sailor")]
+    assert titles(index.search("theme")) == ["battle: theme", "tavern: The Crew - Drunken Sailor"]
+
+
+def test_refresh(index, library):
+    # a new playlist is indexed, and a changed one is re-indexed
+    (library / "ambience").mkdir()
+    (library / "ambience" / "goblin_camp.mp3").write_bytes(b"")
+    (library / "battle" / "goblin_chase.mp3").unlink()
+    index.refresh()
+    assert titles(index.search("goblin")) == ["tavern: Goblin Shanty", "ambience: goblin_camp"]
+
+    # a playlist that's gone is forgotten, along with everything in the index that pointed at it
+    shutil.rmtree(library / "tavern")
+    index.refresh()
+    assert titles(index.search("goblin")) == ["ambience: goblin_camp"]
+    assert len(index) == 3
+    assert "shanty" not in str(dict(index._trigrams)) and "sh" not in index._prefixes
+
+
+def test_refresh_notices_nested_tracks(index, library):
+    (library / "battle" / "bosses").mkdir()
+    index.refresh()
+    (library / "battle" / "bosses" / "troll_fight.mp3").write_bytes(b"")
+    index.refresh()
+    assert titles(index.search("troll")) == ["battle: troll_fight"]
+
+
+def test_refresh_notices_new_and_changed_tags(library, monkeypatch):
+    track = library / "tavern" / "theme.mp3"
+    tagged = {str(track): "Drunken Sailor"}
+
+    def parse(path):
+        return metadata.TrackMetadata(path=str(path), mtime=path.stat().st_mtime_ns, title=tagged.get(str(path), "?"))
+
+    monkeypatch.setattr(metadata, "parse", parse)
+    index = search.TrackIndex()
+    index.refresh()
+    assert index.search("sailor") == []
+
+    # the track is parsed after its playlist was indexed
+    metadata.cache().get(track)
+    index.refresh()
+    assert titles(index.search("sailor")) == ["tavern: Drunken Sailor"]
+
+    # the track is re-tagged in place, so its stored tags are out of date and it is parsed again
+    tagged[str(track)] = "Sea Shanty"
+    mtime = track.stat().st_mtime_ns + 1_000_000_000
+    os.utime(track, ns=(mtime, mtime))
+    index.refresh()
+    assert index.search("sailor") == []
+    for _ in range(100):
+        if metadata.cache().changes == 2:
+            break
+        time.sleep(0.05)
+    index.refresh()
+    assert titles(index.search("sea shanty")) == ["tavern: Sea Shanty"]
+
+
+def test_search_refreshes_in_background(library):
+    index = search.TrackIndex(refresh_interval=0)
+    assert index.search("goblin") == []
+    index._refresher.join(timeout=5)
+    assert len(index.search("goblin")) == 2
+
+
+def test_missing_playlist_root(monkeypatch, tmp_path):
+    monkeypatch.setenv("PLAYLIST_ROOT", str(tmp_path / "nowhere"))
+    index = search.TrackIndex()
+    index.refresh()
+    assert index.search("goblin") == []
@@ -0,0 +1,7 @@
+import soak
+
+
+def test_soak():
+    report = soak.soak(hours=0.25, commands_per_hour=240, sample_minutes=5, warmup_minutes=5)
+    assert report.samples
+    assert not report.failures, str(report)
@@ -6,8 +6,10 @@ from unittest.mock import MagicMock
 
 import pytest
 import shout
+from mutagen.easyid3 import EasyID3
 
-from croaker import playlist, streamer
+from croaker import metadata, playlist, streamer, transcoder
+from croaker.scheduler import Scheduler
 
 
 def get_stream_output(stream):
@@ -130,3 +132,213 @@ def test_streamer_handles_load_interrupt(audio_streamer, input_queue, output_str
     audio_streamer.stream_queued_audio()
     assert get_stream_output(output_stream) == b""
     assert input_queue.empty
+
+
+def test_streamer_publishes_events(audio_streamer, skip_event):
+    sub = audio_streamer.events.subscribe()
+    skip_event.set()
+    audio_streamer.stream_queued_audio()
+    names = [sub.get(timeout=0).name for _ in range(3)]
+    assert names == ["track_start", "skip", "track_end"]
+
+
+@pytest.fixture
+def paced_streamer(audio_streamer, output_stream):
+    """
+    An AudioStreamer whose scheduler uses a fake clock that advances in real time with the audio sent.
+    """
+    start = 1_000_000.0
+    audio_streamer.scheduler = Scheduler(clock=lambda: start + len(output_stream.getvalue()) * 8 / 192000)
+    return audio_streamer
+
+
+def test_scheduled_transition_timing(paced_streamer):
+    cut_at = []
+    paced_streamer.scheduler.after(1.0, "battle", lambda: cut_at.append(paced_streamer.scheduler.elapsed))
+    paced_streamer.stream_queued_audio()
+
+    # the transition happens at the first frame boundary at or after the deadline
+    frame = 1152 / 44100
+    assert cut_at[0] == pytest.approx(1.0, abs=frame)
+    assert cut_at[0] >= 1.0 - Scheduler.tolerance
+    assert round(cut_at[0] * 44100) % 1152 == 0
+
+
+def test_scheduled_transition_at_boundary(paced_streamer, output_stream):
+    cut_at = []
+    paced_streamer.scheduler.next_track("battle", lambda: cut_at.append(paced_streamer.scheduler.elapsed))
+    paced_streamer.stream_queued_audio()
+    assert cut_at and cut_at[0] > 1.0
+    assert paced_streamer.scheduler.elapsed == cut_at[0]
+
+
+def test_streamer_ogg(mock_shout, input_queue, skip_event, stop_event, load_event, output_stream):
+    ogg = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event, format="ogg")
+    assert ogg._shout.format == "ogg"
+    ogg.stream_queued_audio()
+    assert output_stream.getvalue().startswith(b"OggS")
+    mock_shout.return_value.set_metadata.assert_not_called()
+
+
+def test_streamer_ends_interrupted_ogg_streams(
+    monkeypatch, mock_shout, input_queue, skip_event, stop_event, load_event
+):
+    sent = []
+
+    def skip_after_the_first_chunk(buf):
+        sent.append(buf)
+        skip_event.set()
+
+    monkeypatch.setattr(mock_shout.return_value.send, "side_effect", skip_after_the_first_chunk)
+    ogg = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event, format="ogg", chunk_size=64)
+    ogg.stream_queued_audio()
+    assert len(sent) == 2
+    assert sent[1].startswith(b"OggS") and sent[1][5] == transcoder.OggPageStream.EOS
+
+
+def test_streamer_unknown_format(input_queue, skip_event, stop_event, load_event):
+    with pytest.raises(ValueError):
+        streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event, format="aac")
+
+
+def test_streamer_pauses_for_handoff(audio_streamer, output_stream):
+    audio_streamer.handoff_requested.set()
+    thread = threading.Thread(target=audio_streamer.stream_queued_audio)
+    thread.start()
+    assert audio_streamer.paused.wait(timeout=5)
+    assert audio_streamer.handoff_state == {"track": None, "title": "[NOTHING PLAYING]", "position": 0.0, "next": None}
+    audio_streamer.finish()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert output_stream.getvalue() == b""
+
+
+def test_streamer_resumes_after_handoff(audio_streamer, output_stream):
+    audio_streamer.stream_queued_audio()
+    expected = len(output_stream.getvalue())
+    output_stream.seek(0)
+    output_stream.truncate()
+
+    audio_streamer.handoff_requested.set()
+    thread = threading.Thread(target=audio_streamer.stream_queued_audio)
+    thread.start()
+    assert audio_streamer.paused.wait(timeout=5)
+    audio_streamer.resume()
+    thread.join(timeout=5)
+    assert not audio_streamer.finished
+    assert len(output_stream.getvalue()) == expected
+
+
+def test_streamer_resume_from(monkeypatch, audio_streamer):
+    opened = []
+    monkeypatch.setattr(audio_streamer, "open", lambda track, start=0.0: opened.append((track, start)) or MagicMock())
+    track = Path("/music/tavern.mp3")
+    audio_streamer.resume_from(track, "Tavern", 42.5)
+    assert opened == [(track, 42.5)]
+    assert audio_streamer._next_source[1:] == ("Tavern", track)
+
+
+def test_streamer_closes_stream_on_error(monkeypatch, audio_streamer):
+    stream = MagicMock(**{"__iter__.return_value": iter([b"chunk"])})
+    audio_streamer._next_source = (stream, "title", None)
+    monkeypatch.setattr(audio_streamer, "send", MagicMock(side_effect=RuntimeError))
+    with pytest.raises(RuntimeError):
+        audio_streamer.stream_queued_audio()
+    stream.close.assert_called_once()
+    audio_streamer._drop_next_source()
+
+
+def test_streamer_cue(monkeypatch, audio_streamer, skip_event):
+    opened = []
+    monkeypatch.setattr(audio_streamer, "open", lambda track, start=0.0: opened.append(track) or MagicMock())
+    following = (MagicMock(), "next", Path("next.mp3"))
+    audio_streamer._next_source = following
+    audio_streamer.cue(Path("goblin_chase.mp3"))
+    assert skip_event.is_set()
+
+    # the cued track is played next without being skipped, and the queue carries on after it
+    audio_streamer.stream_queued_audio()
+    assert opened == [Path("goblin_chase.mp3")]
+    assert not skip_event.is_set()
+    assert audio_streamer._next_source is following
+    audio_streamer._drop_next_source()
+
+
+def test_streamer_adapts_chunk_size(mock_shout, input_queue, skip_event, stop_event, load_event, output_stream):
+    audio_streamer = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event, latency_target=0.25)
+    sizes = []
+    mock_shout.return_value.send.side_effect = lambda buf: sizes.append(len(buf))
+    audio_streamer.stream_queued_audio()
+
+    # sends that don't block are healthy, so chunks grow a frame at a time up to the target's worth of audio
+    assert audio_streamer.chunk_size == audio_streamer.chunks.max_frames * audio_streamer.chunks.frame_size
+    assert sizes[:3] == sorted(sizes[:3])
+    assert "latency target: 0.250s" in str(audio_streamer.chunks)
+
+    # an interrupting command halves the chunk size once, before the next read
+    audio_streamer.chunks.command()
+    skip_event.set()
+    audio_streamer.stream_queued_audio()
+    assert audio_streamer.chunks.frames == audio_streamer.chunks.max_frames // 2
+
+
+def test_streamer_shrinks_the_chunk_after_a_command(
+    mock_shout, input_queue, skip_event, stop_event, load_event, output_stream
+):
+    audio_streamer = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event, latency_target=0.25)
+    frame_size = audio_streamer.chunks.frame_size
+    sizes = []
+
+    def send(buf):
+        sizes.append(len(buf))
+        if len(sizes) == 1:
+            # a FADE, say, arrives while the first chunk is being sent; it doesn't interrupt the track
+            audio_streamer.chunks.command()
+
+    mock_shout.return_value.send.side_effect = send
+    audio_streamer.stream_queued_audio()
+
+    # the chunk read after the command is half what it would have grown to (in whole frames,
+    # some of which carry a padding byte)
+    assert [size // frame_size for size in sizes[:2]] == [7, 4]
+
+
+def test_streamer_chunk_latency_from_environment(monkeypatch, input_queue, skip_event, stop_event, load_event):
+    monkeypatch.setenv("CHUNK_LATENCY", "0.5")
+    audio_streamer = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event)
+    assert audio_streamer.chunks.target == 0.5
+    monkeypatch.delenv("CHUNK_LATENCY")
+    audio_streamer = streamer.AudioStreamer(input_queue, skip_event, stop_event, load_event)
+    assert audio_streamer.chunks.target is None
+    assert audio_streamer.chunk_size == 4096
+
+
+@pytest.fixture
+def tagged_track(tmp_path, silence_bytes):
+    track = tmp_path / "goblin_chase.mp3"
+    track.write_bytes(silence_bytes)
+    tags = EasyID3(track)
+    tags["title"] = "Goblin Chase"
+    tags.save()
+    return track
+
+
+def test_streamer_titles_from_stored_metadata(monkeypatch, audio_streamer, tagged_track):
+    # tags parsed by an earlier run of the server are used for the first track, before warm() gets to it
+    metadata.cache().get(tagged_track)
+    metadata.cache()._memory.clear()
+    monkeypatch.setattr(audio_streamer, "open", MagicMock())
+    assert audio_streamer._source(tagged_track)[1] == "Goblin Chase"
+
+
+def test_streamer_retitles_track_once_parsed(monkeypatch, audio_streamer, tagged_track):
+    monkeypatch.setattr(metadata.MetadataCache, "warm", MagicMock())
+    monkeypatch.setattr(audio_streamer, "open", MagicMock())
+    _, title, _ = audio_streamer._source(tagged_track)
+    assert title == "goblin_chase"
+    assert audio_streamer._retitle(tagged_track, title) == "goblin_chase"
+
+    sub = audio_streamer.events.subscribe()
+    metadata.cache().get(tagged_track)
+    assert audio_streamer._retitle(tagged_track, title) == "Goblin Chase"
+    assert sub.get(timeout=0).data == {"title": "Goblin Chase"}
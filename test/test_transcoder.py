@@ -1,9 +1,14 @@
+import io
+import os
+import shutil
+import subprocess
+from pathlib import Path
 from unittest.mock import MagicMock
 
 import ffmpeg
 import pytest
 
-from croaker import playlist, transcoder
+from croaker import playlist, registry, transcoder
 
 
 @pytest.fixture
@@ -41,3 +46,223 @@ def test_transcoder_open(monkeypatch, mock_mp3decoder, suffix, expected):
     track = [t for t in pl.tracks if t.suffix == suffix][0]
     with transcoder.open(track) as handle:
         assert handle.read() == expected
+
+
+@pytest.fixture
+def silence():
+    return transcoder.FrameAlignedStream.from_source(Path(transcoder.__file__).parent / "silence.mp3")
+
+
+def test_stream_position(silence):
+    data = b"".join(silence)
+    frames = len(data) // 626
+    assert silence.samples % 1152 == 0
+    assert silence.samples // 1152 == frames
+    assert silence.position == silence.samples / 44100
+
+
+def test_stream_stop_at(silence):
+    silence.stop_at = 0.5
+    b"".join(silence)
+    assert 0.5 <= silence.position < 0.5 + 1152 / 44100
+
+
+@pytest.mark.parametrize("read", [True, False])
+def test_stream_close_reaps_ffmpeg(silence, read):
+    if read:
+        b"".join(silence)
+    silence.close()
+    assert silence.process.returncode is not None
+
+
+@pytest.fixture
+def pool():
+    p = transcoder.TranscoderPool(max_workers=2)
+    yield p
+    p.shutdown()
+
+
+def test_pool_shares_transcodes(pool):
+    source = Path(transcoder.__file__).parent / "silence.mp3"
+    streams = [pool.open(source, chunk_size=4096) for _ in range(4)]
+    outputs = [b"".join(stream) for stream in streams]
+    assert pool.spawned == 1
+    assert pool.hits == 3
+    assert outputs[0] == b"".join(transcoder.FrameAlignedStream.from_source(source))
+    assert all(output == outputs[0] for output in outputs)
+
+
+def test_pool_shares_transcodes_of_links_and_copies(pool, tmp_path):
+    source = Path(transcoder.__file__).parent / "silence.mp3"
+    (tmp_path / "link.mp3").symlink_to(source)
+    shutil.copy(source, tmp_path / "copy.mp3")
+    for track in (source, tmp_path / "link.mp3", tmp_path / "copy.mp3"):
+        assert b"".join(pool.open(track))
+    assert pool.spawned == 1
+    assert pool.hits == 2
+
+
+def test_pool_doesnt_share_transcodes_of_lookalikes(pool, tmp_path):
+    silence = (Path(transcoder.__file__).parent / "silence.mp3").read_bytes()
+    data = silence * 20
+    one, two = tmp_path / "one.mp3", tmp_path / "two.mp3"
+    one.write_bytes(data)
+
+    # the same size and samples as one.mp3, but not the same contents
+    changed = bytearray(data)
+    changed[registry.SAMPLE_SIZE + 4096] ^= 1
+    two.write_bytes(changed)
+    assert registry.registry().get(one).digest == registry.registry().get(two).digest
+
+    for track in (one, two):
+        assert b"".join(pool.open(track))
+    assert pool.spawned == 2
+
+    # and a file edited in place is transcoded again, however little of it changed
+    changed[registry.SAMPLE_SIZE + 8192] ^= 1
+    one.write_bytes(changed)
+    os.utime(one, ns=(0, 0))
+    assert b"".join(pool.open(one))
+    assert pool.spawned == 3
+
+
+def test_pool_cache_eviction(pool, tmp_path):
+    sources = []
+    silence = (Path(transcoder.__file__).parent / "silence.mp3").read_bytes()
+    for i, name in enumerate(("one", "two"), start=1):
+        sources.append(tmp_path / f"{name}.mp3")
+        sources[-1].write_bytes(silence * i)
+    pool.cache_size = 1
+    for source in sources:
+        b"".join(pool.open(source))
+    pool.open(sources[0])
+    assert pool.spawned == 3
+
+
+def test_pool_cache_is_bounded_by_size(pool, tmp_path):
+    source = Path(transcoder.__file__).parent / "silence.mp3"
+    pool.cache_size = 1
+    job = pool.transcode(source)
+    assert job.reader().read()
+
+    # the transcode outgrew the cache while it ran, so it is dropped once it finishes
+    with pool._work:
+        assert pool._work.wait_for(lambda: pool.cached_bytes <= pool.cache_size, timeout=5)
+    assert pool.transcode(source) is not job
+
+
+def test_pool_retries_failed_transcodes(pool, tmp_path):
+    source = tmp_path / "broken.mp3"
+    source.write_bytes(b"not audio")
+    job = pool.transcode(source)
+    assert job.reader().read() == b""
+    assert job.failed
+    assert pool.transcode(source) is not job
+    assert pool.spawned == 2
+
+
+@pytest.fixture
+def long_tracks(tmp_path):
+    tracks = []
+    for i in range(4):
+        tracks.append(tmp_path / f"long{i}.flac")
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"sine=frequency={440 + i * 110}:duration=60", str(tracks[-1])],
+            check=True,
+        )
+    return tracks
+
+
+def test_pool_plays_current_tracks_before_prefetches(pool, long_tracks):
+    prefetches = [pool.transcode(track) for track in long_tracks]
+    current = pool.open(Path(transcoder.__file__).parent / "silence.mp3")
+    assert b"".join(current)
+
+    # only one prefetch runs at a time, leaving the other worker free for the current track
+    assert prefetches[0].started
+    assert not prefetches[2].started
+    assert not any(job.failed for job in prefetches)
+
+
+def test_pool_cancels_abandoned_transcodes(pool, long_tracks):
+    playing = pool.open(long_tracks[0])
+    next(iter(playing))
+    queued = [pool.open(track) for track in long_tracks[1:]]
+    for stream in [playing] + queued:
+        stream.close()
+
+    jobs = [stream.source.transcode for stream in [playing] + queued]
+    for job in jobs:
+        with job._cond:
+            assert job._cond.wait_for(lambda: job.done, timeout=5)
+        assert job.cancelled
+    assert not jobs[-1].started
+    assert pool.transcode(long_tracks[0]) is not jobs[0]
+
+
+def test_pool_keeps_transcodes_with_readers(pool, long_tracks):
+    streams = [pool.open(long_tracks[0]) for _ in range(2)]
+    streams[0].close()
+    assert not streams[1].source.transcode.cancelled
+    assert b"".join(streams[1])
+
+
+def ogg_page(body: bytes, granule: int = 0):
+    segments = [255] * (len(body) // 255) + [len(body) % 255]
+    header = transcoder.OggPageStream.header.pack(b"OggS", 0, 0, granule, 1, 0, 0, len(segments))
+    return header + bytes(segments) + body
+
+
+def test_ogg_pages():
+    head = ogg_page(b"OpusHead" + bytes([1, 2]) + (312).to_bytes(2, "little") + bytes(8))
+    pages = [ogg_page(b"x" * 300, granule=312 + 960 * i) for i in range(1, 4)]
+    continued = ogg_page(b"y" * 10, granule=-1)
+    stream = transcoder.OggPageStream(
+        io.BytesIO(b"junk" + head + pages[0] + continued + b"".join(pages[1:])), chunk_size=1
+    )
+    assert list(stream) == [head] + pages[:1] + [continued] + pages[1:]
+    assert stream.samples == 960 * 3
+    assert stream.position == 960 * 3 / 48000
+
+
+def test_ogg_stream_position(silence):
+    mp3 = b"".join(silence)
+    stream = transcoder.OggPageStream.from_source(Path(transcoder.__file__).parent / "silence.mp3", chunk_size=4096)
+    chunks = list(stream)
+    assert all(chunk.startswith(b"OggS") for chunk in chunks)
+    assert stream.position == pytest.approx(silence.position, abs=0.05)
+    assert sum(len(chunk) for chunk in chunks) < len(mp3) / 2
+
+
+def test_ogg_stream_stop_at():
+    stream = transcoder.OggPageStream.from_source(Path(transcoder.__file__).parent / "silence.mp3")
+    stream.stop_at = 1.0
+    pages = list(transcoder.OggPageStream(io.BytesIO(b"".join(stream))).frames)
+    assert 1.0 <= stream.position < 1.2
+
+    # the cut is marked with an empty end-of-stream page following on from the last one
+    header = transcoder.OggPageStream.header
+    last, end = header.unpack_from(pages[-2]), header.unpack_from(pages[-1])
+    assert end[2] == transcoder.OggPageStream.EOS and end[-1] == 0
+    assert (end[3], end[4], end[5]) == (last[3], last[4], last[5] + 1)
+    check = bytearray(pages[-1])
+    check[22:26] = bytes(4)
+    assert transcoder.ogg_crc(check) == end[6]
+
+
+def test_ogg_stream_headers():
+    stream = transcoder.OggPageStream.from_source(Path(transcoder.__file__).parent / "silence.mp3")
+    data = b"".join(stream)
+    assert data.startswith(stream.headers)
+    pages = list(transcoder.OggPageStream(io.BytesIO(stream.headers)).frames)
+    assert [page[28:36] for page in pages] == [b"OpusHead", b"OpusTags"]
+
+
+def test_pool_caches_formats_separately(pool):
+    source = Path(transcoder.__file__).parent / "silence.mp3"
+    mp3 = b"".join(pool.open(source))
+    ogg = b"".join(pool.open(source, stream_class=transcoder.OggPageStream))
+    assert pool.spawned == 2
+    assert mp3.startswith(b"\xff")
+    assert ogg.startswith(b"OggS")
@@ -0,0 +1,81 @@
+import multiprocessing
+import threading
+from pathlib import Path
+
+import pytest
+
+from croaker import ring, transcoder, worker
+
+
+@pytest.fixture(scope="module")
+def silence():
+    return Path(transcoder.__file__).parent / "silence.mp3"
+
+
+@pytest.fixture
+def transcode_worker():
+    w = worker.TranscodeWorker(ring_size=16384)
+    yield w
+    w.shutdown()
+
+
+def test_worker_stream(transcode_worker, silence):
+    expected = transcoder.FrameAlignedStream.from_source(silence, chunk_size=4096)
+    stream = transcode_worker.open(silence, chunk_size=4096)
+    assert list(stream) == list(expected)
+    assert stream.position == expected.position
+
+
+def test_worker_streams_in_order(transcode_worker, silence):
+    streams = [transcode_worker.open(silence) for _ in range(3)]
+    outputs = [b"".join(stream) for stream in streams]
+    assert outputs[0]
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_worker_cancel(transcode_worker, silence):
+    expected = b"".join(transcoder.FrameAlignedStream.from_source(silence))
+    skipped = transcode_worker.open(silence, chunk_size=4096)
+    dropped = transcode_worker.open(silence)
+    following = transcode_worker.open(silence)
+
+    # stop reading one stream partway through and cancel the one queued after it
+    next(iter(skipped))
+    skipped.close()
+    dropped.close()
+    assert b"".join(following) == expected
+
+
+def test_worker_stop_at(transcode_worker, silence):
+    stream = transcode_worker.open(silence)
+    stream.stop_at = 1.0
+    b"".join(stream)
+    assert 1.0 <= stream.position < 1.0 + 1152 / 44100
+
+
+def test_remote_stream_keeps_records_of_later_sources():
+    # the end of the first source went missing, so its stream ends and the second still gets all of its audio
+    w = worker.TranscodeWorker()
+    w.ring = ring.FrameRing(size=16384)
+    w.ready = threading.Event()
+    w.ring.write(ring.FRAME, 1, b"first", 1152)
+    w.ring.write(ring.FRAME, 2, b"second", 1152)
+    w.ring.write(ring.END, 2)
+    try:
+        assert list(worker.RemoteStream(w, generation=1)) == [b"first"]
+        assert list(worker.RemoteStream(w, generation=2)) == [b"second"]
+    finally:
+        w.ring.close()
+
+
+def test_worker_waits_for_a_transcoder_slot(silence):
+    slots = multiprocessing.get_context("spawn").BoundedSemaphore(1)
+    w = worker.TranscodeWorker(ring_size=16384, slots=slots)
+    slots.acquire()
+    try:
+        stream = w.open(silence)
+        assert not w.ready.wait(timeout=1)
+        slots.release()
+        assert b"".join(stream) == b"".join(transcoder.FrameAlignedStream.from_source(silence))
+    finally:
+        w.shutdown()